@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+offline benchmark and regression test of the provisioning flow: run `create_single_vm.py --topology` end to end on a
+fake host for topologies of 1, 10 and 50 VMs, report the wall time of each phase and the number of forked commands,
+and check the run against the expected flow:
+- the traced phases and their number of calls (see 'get_expected_phases')
+- the number of host commands, which must not exceed its budget (see 'get_max_host_cmds')
+- no vCPU is pinned to a hyperthread sibling of a juniper VFP core
+the benchmark fails (exits with 1) if a run fails or doesn't pass its checks.
+
+the fake host (see 'fake_host.py') stands in for KVM, the vendor images and the host network: `virsh`, `ip`,
+`qemu-img`, `telnet` and `vmx.sh` are fake tools on the PATH, the sysfs, images and run folders of the script are
+temporary folders (see the CREATE_VM_* variables of the script), and the consoles of the VMs play back IOS-XR and Junos
+boot transcripts. the fixed waits of the script for the VMs to settle are scaled by the time scale as well
+(CREATE_VM_SLEEP_SCALE). the CPUs of the fake host have 2 hyperthreads per core by default, so the VFP cores of the
+juniper VMs are placed on whole cores. nothing on the host is changed, but the script still has to run as root.
+
+    sudo ./bench/bench_provisioning.py --sizes 1 10 50 --vm_type cisco --time_scale 0.01
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import xml.etree.ElementTree as ElementTree
+from time import monotonic
+
+import yaml
+
+import fake_host
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(os.path.dirname(BENCH_DIR), 'create_single_vm.py')
+FAKE_HOST_PATH = os.path.join(BENCH_DIR, 'fake_host.py')
+CISCO_IMAGE_NAME = 'cisco_vm_base.qcow2'
+JUNIPER_BUNDLE_NAME = 'vmx-bundle-20.4R1.12.tgz'
+# the images of the vMX bundle, the routing engine image is a qcow2 image
+JUNIPER_BUNDLE_IMAGES = ('junos-vmx-x86-64-20.4R1.12.qcow2', 'vmxhdd.img', 'metadata-usb-re.img', 'vFPC-20201209.img')
+CISCO_HUGEPAGES = 4096  # the 8G of memory of a cisco VM, in 2M pages
+NUMA_NODES = 2
+# the traced phases of a run, by what they are called once for
+RUN_PHASES = ('run', 'install_prereqs_and_delete', 'validate_cpus', 'plan_hugepages', 'create_missing_bridges')
+CISCO_PHASES = ('config_and_start_cisco_vm', 'clone_cisco_vm', 'configure_cisco_vm', 'start_cisco_vm',
+                'wait_for_cisco_boot_and_set_base_config', 'wait_for_cisco_boot', 'set_cisco_base_config')
+JUNIPER_PHASES = ('config_and_start_juniper_vm', 'clone_juniper_vm', 'wait_for_juniper_boot_and_set_base_config',
+                  'wait_for_juniper_boot', 'set_juniper_base_config', '_install_juniper_license')
+JUNIPER_INSTALLER_PHASES = {'native': ('install_juniper_vm_native',),
+                            'vmx.sh': ('configure_juniper_vm', 'install_juniper_vm', 'bind_juniper_dev_interfaces',
+                                       'set_juniper_cpu_binding')}
+JUNIPER_BASE_CONFIG_PASTES = 3  # the base config is pasted until it was seen applied 3 times
+# the budget of host commands: per run, per VM type in the run (the juniper bundle is extracted once), and per VM by
+# type and juniper installer
+MAX_HOST_CMDS_PER_RUN = 5
+MAX_HOST_CMDS_PER_VM_TYPE = {'cisco': 0, 'juniper': 2}
+MAX_HOST_CMDS_PER_VM = {'cisco': 6, 'juniper-native': 18, 'juniper-vmx.sh': 21}
+
+
+def get_vm_types(size, vm_type):
+    if vm_type == 'mixed':
+        return ['cisco' if i % 2 == 0 else 'juniper' for i in range(size)]
+    return [vm_type] * size
+
+
+def get_vm_cpus(vm_type, threads_per_core):
+    """
+    the CPUs a VM takes: the VFP cores of a juniper are whole cores, their other hyperthreads are kept free
+    """
+    return 2 if vm_type == 'cisco' else 1 + 3 * threads_per_core
+
+
+def get_expected_phases(vm_types, juniper_installer):
+    """
+    :return: {phase: number of calls} of the run of a topology
+    """
+    cisco_count, juniper_count = vm_types.count('cisco'), vm_types.count('juniper')
+    # the images are fetched once per VM type before the VMs are created, and again by each VM
+    fetches = len(vm_types) + len(set(vm_types))
+    phases = dict.fromkeys(RUN_PHASES, 1)
+    phases.update({'define_virsh_networks': 1 + len(vm_types), 'define_networks': len(vm_types),
+                   'fetch_images': fetches, 'get_image': fetches})
+    phases.update(dict.fromkeys(CISCO_PHASES, cisco_count))
+    phases.update(dict.fromkeys(JUNIPER_PHASES + JUNIPER_INSTALLER_PHASES[juniper_installer], juniper_count))
+    phases.update({'get_juniper_bundle_cache': juniper_count + 1 if juniper_count else 0,
+                   '_set_juniper_base_config': juniper_count * JUNIPER_BASE_CONFIG_PASTES})
+    return {phase: calls for phase, calls in phases.items() if calls}
+
+
+def get_max_host_cmds(vm_types, juniper_installer):
+    return (MAX_HOST_CMDS_PER_RUN + sum(MAX_HOST_CMDS_PER_VM_TYPE[vm_type] for vm_type in set(vm_types)) +
+            sum(MAX_HOST_CMDS_PER_VM['cisco' if vm_type == 'cisco' else f"juniper-{juniper_installer}"]
+                for vm_type in vm_types))
+
+
+def create_images(images_dir):
+    """
+    create the cisco base image and the vMX bundle, with the fake `vmx.sh` as the installation script of the bundle
+    """
+    with open(os.path.join(images_dir, CISCO_IMAGE_NAME), 'wb') as f:
+        f.write(fake_host.QCOW2_MAGIC + bytes(64 * 1024))
+    with tempfile.TemporaryDirectory(dir=images_dir) as bundle_dir:
+        for sub_dir in ('config', 'images'):
+            os.makedirs(os.path.join(bundle_dir, 'vmx', sub_dir))
+        for image in JUNIPER_BUNDLE_IMAGES:
+            with open(os.path.join(bundle_dir, 'vmx', 'images', image), 'wb') as f:
+                f.write((fake_host.QCOW2_MAGIC if image.endswith('.qcow2') else b'') + bytes(64 * 1024))
+        os.symlink(FAKE_HOST_PATH, os.path.join(bundle_dir, 'vmx', 'vmx.sh'))
+        with tarfile.open(os.path.join(images_dir, JUNIPER_BUNDLE_NAME), 'w:gz') as tar:
+            tar.add(os.path.join(bundle_dir, 'vmx'), arcname='vmx')
+
+
+def write_topology(path, vm_types):
+    """
+    a topology of VMs that are connected in pairs, each pair on its own bridge
+    """
+    vms = []
+    for i, vm_type in enumerate(vm_types):
+        vms.append({'name': f"vm{i + 1}", 'type': vm_type, 'mgmt_ip': f"10.0.{i // 250}.{i % 250 + 1}/16",
+                    'interfaces': [f"br:brBench{i // 2}"]})
+    topology = {'mgmt_br': 'br0', 'mgmt_gw': '10.0.255.254', 'group': 'bench',
+                'bridges': sorted({vm['interfaces'][0][3:] for vm in vms}), 'vms': vms}
+    with open(path, 'w') as f:
+        yaml.safe_dump(topology, f)
+
+
+def read_trace(path):
+    try:
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+    except OSError:
+        return []
+
+
+def summarize_phases(spans):
+    """
+    :return: {phase: (calls, wall seconds from the first start to the last end, max seconds)}, in start order. the
+             phases of parallel VMs overlap, so the wall time of a phase is less than the sum of its calls
+    """
+    phases = {}
+    for span in sorted(spans, key=lambda _span: _span['ts']):
+        if span['cat'] in ('phase', 'run'):
+            phase = phases.setdefault(span['name'], [0, span['ts'], 0, 0])
+            phase[0] += 1
+            phase[2] = max(phase[2], span['ts'] + span['dur'])
+            phase[3] = max(phase[3], span['dur'])
+    return {name: (calls, (end - start) / 1e6, longest / 1e6) for name, (calls, start, end, longest) in phases.items()}
+
+
+def count_tool_calls(root):
+    """
+    :return: {fake tool and command, e.g 'virsh define': executions}
+    """
+    calls = {}
+    try:
+        with open(os.path.join(root, 'calls.log')) as f:
+            for line in f:
+                calls[line.strip()] = calls.get(line.strip(), 0) + 1
+    except OSError:
+        pass
+    return calls
+
+
+def get_pinned_cpus(root):
+    """
+    :return: {domain: [the CPUs its vCPUs are pinned to]} of the domains of the fake host
+    """
+    pinned = {}
+    domains_dir = os.path.join(root, 'virsh/domains')
+    for file_name in os.listdir(domains_dir):
+        with open(os.path.join(domains_dir, file_name)) as f:
+            xml = ElementTree.fromstring(json.load(f)['xml'])
+        pinned[file_name[:-len('.json')]] = [int(vcpupin.get('cpuset').split(',')[0])
+                                             for vcpupin in xml.findall('cputune/vcpupin')]
+    return pinned
+
+
+def check_run(result, vm_types, juniper_installer, root, threads_per_core):
+    """
+    :return: list of the failed checks of a run
+    """
+    failures = []
+    expected_phases = get_expected_phases(vm_types, juniper_installer)
+    for phase, calls in expected_phases.items():
+        if phase not in result['phases']:
+            failures.append(f"phase '{phase}' is missing")
+        elif result['phases'][phase][0] != calls:
+            failures.append(f"phase '{phase}' was called {result['phases'][phase][0]} times instead of {calls}")
+    for phase in result['phases']:
+        if phase not in expected_phases:
+            failures.append(f"unexpected phase '{phase}'")
+    max_host_cmds = get_max_host_cmds(vm_types, juniper_installer)
+    if result['host_cmds'] > max_host_cmds:
+        failures.append(f"{result['host_cmds']} host commands, more than the budget of {max_host_cmds}")
+    pinned = get_pinned_cpus(root)
+    cpu_domains = {cpu: domain for domain, cpus in pinned.items() for cpu in cpus}
+    for domain, cpus in pinned.items():
+        if not domain.startswith('vfp-'):
+            continue
+        for cpu in cpus:
+            core = cpu - cpu % threads_per_core
+            for sibling in range(core, core + threads_per_core):
+                if sibling != cpu and sibling in cpu_domains:
+                    failures.append(f"cpu {sibling} of '{cpu_domains[sibling]}' is a hyperthread sibling of vfp core "
+                                    f"{cpu} of '{domain}'")
+    return failures
+
+
+def run_benchmark(size, vm_type, time_scale, juniper_installer, work_dir, threads_per_core=2):
+    """
+    create a fake host and provision a topology of 'size' VMs on it
+
+    :return: dict of the results
+    """
+    vm_types = get_vm_types(size, vm_type)
+    root = tempfile.mkdtemp(prefix=f"bench-{size}-{vm_type}-", dir=work_dir)
+    # the VMs of a node take whole cores, leave room for the cores that the placement of each node splits
+    cpus = sum(get_vm_cpus(_vm_type, threads_per_core) for _vm_type in vm_types) + 8 * threads_per_core
+    cpus += -cpus % (NUMA_NODES * threads_per_core)
+    fake_host.create_fake_host(root, cpus=cpus, nodes=NUMA_NODES, threads_per_core=threads_per_core,
+                               hugepages=CISCO_HUGEPAGES * vm_types.count('cisco'))
+    bin_dir = os.path.join(root, 'bin')
+    os.mkdir(bin_dir)
+    for tool in fake_host.TOOLS:
+        if tool != 'vmx.sh':
+            os.symlink(FAKE_HOST_PATH, os.path.join(bin_dir, tool))
+    images_dir = os.path.join(root, 'images')
+    run_dir = os.path.join(root, 'run')
+    for path in (images_dir, run_dir):
+        os.mkdir(path)
+    create_images(images_dir)
+    topology_path = os.path.join(root, 'topology.yaml')
+    write_topology(topology_path, vm_types)
+
+    trace_path = os.path.join(root, 'trace.jsonl')
+    log_path = os.path.join(root, 'run.log')
+    env = dict(os.environ, PATH=f"{bin_dir}:{os.environ['PATH']}", FAKE_HOST_ROOT=root,
+               FAKE_HOST_TIME_SCALE=str(time_scale), CREATE_VM_SLEEP_SCALE=str(time_scale),
+               CREATE_VM_SYSFS_ROOT=os.path.join(root, 'sysfs'), CREATE_VM_IMAGES_DIR=images_dir + '/',
+               CREATE_VM_RUN_DIR=run_dir, CREATE_VM_NET_BACKEND='ip')
+    cmd = [sys.executable, SCRIPT_PATH, '--topology', topology_path, '--virt_backend', 'virsh', '--no_daemon',
+           '--dont_save_br_config', '--juniper_installer', juniper_installer, '--trace', trace_path]
+    print(f"provisioning {size} vms ({vm_type}) on fake host '{root}'", flush=True)
+    start = monotonic()
+    with open(log_path, 'w') as log:
+        status = subprocess.run(cmd, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT).returncode
+    spans = read_trace(trace_path)
+    result = {'size': size, 'vm_type': vm_type, 'status': status, 'seconds': monotonic() - start, 'root': root,
+              'log': log_path, 'phases': summarize_phases(spans),
+              'host_cmds': sum(1 for span in spans if span['cat'] == 'cmd'), 'tool_calls': count_tool_calls(root)}
+    result['failed_checks'] = []
+    if status == 0:
+        result['failed_checks'] = check_run(result, vm_types, juniper_installer, root, threads_per_core)
+    return result
+
+
+def is_ok(result):
+    return result['status'] == 0 and not result['failed_checks']
+
+
+def print_result(result):
+    print(f"\n{result['size']} vms ({result['vm_type']}): {'ok' if is_ok(result) else 'FAILED'} in "
+          f"{result['seconds']:.1f} seconds, log: '{result['log']}'")
+    if result['status'] != 0:
+        with open(result['log']) as f:
+            print(''.join(f.readlines()[-15:]))
+    width = max([len(name) for name in result['phases']] + [5])
+    print(f"{'phase':<{width}}  {'calls':>6}  {'wall(s)':>8}  {'max(s)':>8}")
+    for name, (calls, wall, longest) in result['phases'].items():
+        print(f"{name:<{width}}  {calls:>6}  {wall:>8.2f}  {longest:>8.2f}")
+    tool_calls = sorted(result['tool_calls'].items(), key=lambda _item: -_item[1])
+    print(f"forks: {result['host_cmds']} host commands, {sum(result['tool_calls'].values())} fake tool executions "
+          f"({', '.join(f'{name}: {count}' for name, count in tool_calls)})")
+    for failure in result['failed_checks']:
+        print(f"CHECK FAILED: {failure}")
+
+
+def print_results_table(results):
+    print(f"\n{'vms':>4}  {'type':<8}  {'status':<6}  {'wall(s)':>8}  {'host cmds':>9}  {'tool execs':>10}")
+    for result in results:
+        print(f"{result['size']:>4}  {result['vm_type']:<8}  {'ok' if is_ok(result) else 'failed':<6}  "
+              f"{result['seconds']:>8.1f}  {result['host_cmds']:>9}  {sum(result['tool_calls'].values()):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the provisioning flow of 'create_single_vm.py' on a fake "
+                                                 "host, without KVM or vendor images")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1, 10, 50],
+                        help="the numbers of VMs of the benchmarked topologies (default: 1 10 50)")
+    parser.add_argument("--vm_type", choices=['cisco', 'juniper', 'mixed'], default='cisco',
+                        help="the type of the VMs, 'mixed' alternates cisco and juniper (default: cisco)")
+    parser.add_argument("--time_scale", type=float, default=0.01,
+                        help="multiplier of the boot and commit delays of the console transcripts and of the fixed "
+                             "waits of the script, 1 is the time of a real boot (default: 0.01)")
+    parser.add_argument("--juniper_installer", choices=['native', 'vmx.sh'], default='native',
+                        help="the '--juniper_installer' of the script (default: native)")
+    parser.add_argument("--threads_per_core", type=int, default=2,
+                        help="hyperthreads per core of the fake host CPUs (default: 2)")
+    parser.add_argument("--work_dir", type=str, default=None,
+                        help="the folder of the fake hosts, which are kept for inspection (default: a temporary "
+                             "folder)")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this json file")
+    args = parser.parse_args()
+    if os.geteuid() != 0:
+        exit("the benchmark runs 'create_single_vm.py', which requires root privileges")
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench-provisioning-')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    for size in args.sizes:
+        result = run_benchmark(size, args.vm_type, args.time_scale, args.juniper_installer, work_dir,
+                               args.threads_per_core)
+        print_result(result)
+        results.append(result)
+    print_results_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    exit(0 if all(is_ok(result) for result in results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+the fake host of the provisioning benchmark (see 'bench_provisioning.py'). a single multi-call script that acts as
+`virsh`, `ip`, `qemu-img`, `telnet` and the `vmx.sh` of the vMX bundle, by the name it was called with, and plays the
+serial consoles of the fake VMs from the boot transcripts in 'transcripts/'.
+
+the state of the fake host is kept in the FAKE_HOST_ROOT folder:
+- sysfs/: the '/sys' of the host (CPUs, NUMA nodes, hugepages and network interfaces), see 'create_fake_host'
+- virsh/domains/<name>.json, virsh/networks/<name>.json: the defined domains and networks
+- consoles/<domain>.json: the console of each domain: its prompt state and the pid of the attached session
+- calls.log: a line per execution of a fake tool, to count the forks of a run
+
+FAKE_HOST_TIME_SCALE multiplies the delays of the transcripts (default: 1, the time of a real boot).
+"""
+import fcntl
+import json
+import os
+import re
+import select
+import shutil
+import signal
+import sys
+import termios
+import tty
+import xml.etree.ElementTree as ElementTree
+from contextlib import contextmanager
+from time import sleep, time
+
+import yaml
+
+ROOT = os.environ.get('FAKE_HOST_ROOT', '')
+TIME_SCALE = float(os.environ.get('FAKE_HOST_TIME_SCALE', '1'))
+TRANSCRIPTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'transcripts')
+QCOW2_MAGIC = b'QFI\xfb'
+
+
+def create_fake_host(root, cpus=16, nodes=2, hugepages=4096, bridges=('br0',), threads_per_core=1):
+    """
+    create an empty fake host in 'root': a sysfs with 'cpus' online CPUs split over 'nodes' NUMA nodes, each node with
+    'hugepages' free 2MiB hugepages, and the existing 'bridges'. the CPUs of a core are 'threads_per_core' consecutive
+    hyperthreads, e.g 0-1, 2-3 for 2 threads per core
+    """
+    sysfs = os.path.join(root, 'sysfs')
+    _write(sysfs, 'devices/system/cpu/online', f"0-{cpus - 1}")
+    node_cpus = cpus // nodes
+    for node in range(nodes):
+        node_dir = f'devices/system/node/node{node}'
+        _write(sysfs, node_dir, 'cpulist', f"{node * node_cpus}-{(node + 1) * node_cpus - 1}")
+        for name in ('nr_hugepages', 'free_hugepages'):
+            _write(sysfs, node_dir, 'hugepages/hugepages-2048kB', name, str(hugepages))
+    for cpu in range(cpus):
+        core = cpu - cpu % threads_per_core
+        _write(sysfs, f'devices/system/cpu/cpu{cpu}/topology/thread_siblings_list',
+               f"{core}-{core + threads_per_core - 1}" if threads_per_core > 1 else str(cpu))
+    for name in ('nr_hugepages', 'free_hugepages'):
+        _write(sysfs, 'kernel/mm/hugepages/hugepages-2048kB', name, str(hugepages * nodes))
+    for name in ('virsh/domains', 'virsh/networks', 'consoles', 'sysfs/class/net'):
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+    global ROOT
+    ROOT = root
+    for bridge in bridges:
+        ip_link_add(bridge)
+
+
+def _write(*path_and_content):
+    path = os.path.join(*path_and_content[:-1])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(path_and_content[-1] + '\n')
+
+
+def fail(message):
+    sys.stderr.write(f"error: {message}\n")
+    sys.exit(1)
+
+
+@contextmanager
+def host_lock():
+    """
+    hold the lock of the fake host state, so parallel calls don't lose each other's changes
+    """
+    with open(os.path.join(ROOT, 'lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def load(kind, name):
+    try:
+        with open(os.path.join(ROOT, kind, f"{name}.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save(kind, name, obj):
+    path = os.path.join(ROOT, kind, f"{name}.json")
+    with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+        json.dump(obj, f)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+
+def remove(kind, name):
+    try:
+        os.remove(os.path.join(ROOT, kind, f"{name}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def list_names(kind):
+    return sorted(name[:-5] for name in os.listdir(os.path.join(ROOT, kind)) if name.endswith('.json'))
+
+
+def get_domain(name):
+    domain = load('virsh/domains', name)
+    if not domain:
+        fail(f"failed to get domain '{name}'")
+    return domain
+
+
+def get_option(args, option, default=None):
+    return args[args.index(option) + 1] if option in args else default
+
+
+def get_console_transcript(name):
+    return 'junos' if name.startswith('vcp-') else 'iosxr'
+
+
+def disconnect_console(name):
+    """
+    end the console session that is attached to a domain, as `virsh console --force` does
+    """
+    console = load('consoles', name) or {}
+    if console.get('pid') and console['pid'] != os.getpid():
+        try:
+            os.kill(console['pid'], signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    return console
+
+
+def virsh(args):
+    if not args:
+        fail("command is required")
+    cmd, args = args[0], args[1:]
+    positional = [arg for arg in args if not arg.startswith('--')]
+    with host_lock():
+        if cmd in ('define', 'net-define'):
+            with open(positional[0]) as f:
+                xml = f.read()
+            name = ElementTree.fromstring(xml).find('name').text
+            kind = 'virsh/domains' if cmd == 'define' else 'virsh/networks'
+            obj = load(kind, name) or {'active': False, 'autostart': False}
+            obj['xml'] = xml
+            save(kind, name, obj)
+            print(f"{'Domain' if cmd == 'define' else 'Network'} '{name}' defined from {positional[0]}")
+        elif cmd == 'start':
+            domain = get_domain(positional[0])
+            if domain['active']:
+                fail("Requested operation is not valid: domain is already running")
+            disconnect_console(positional[0])
+            remove('consoles', positional[0])
+            domain.update(active=True, started=time())
+            save('virsh/domains', positional[0], domain)
+            print(f"Domain '{positional[0]}' started")
+        elif cmd == 'destroy':
+            domain = get_domain(positional[0])
+            if not domain['active']:
+                fail("Requested operation is not valid: domain is not running")
+            disconnect_console(positional[0])
+            domain['active'] = False
+            save('virsh/domains', positional[0], domain)
+            print(f"Domain '{positional[0]}' destroyed")
+        elif cmd == 'undefine':
+            get_domain(positional[0])
+            remove('virsh/domains', positional[0])
+            print(f"Domain '{positional[0]}' has been undefined")
+        elif cmd in ('autostart', 'net-autostart', 'net-start'):
+            kind = 'virsh/domains' if cmd == 'autostart' else 'virsh/networks'
+            obj = load(kind, positional[0]) or fail(f"failed to get '{positional[0]}'")
+            obj['autostart' if cmd.endswith('autostart') else 'active'] = True
+            save(kind, positional[0], obj)
+        elif cmd == 'list':
+            for name in list_names('virsh/domains'):
+                if '--all' in args or load('virsh/domains', name)['active']:
+                    print(name)
+        elif cmd == 'net-list':
+            for name in list_names('virsh/networks'):
+                if '--no-autostart' not in args or not load('virsh/networks', name)['autostart']:
+                    print(name)
+        elif cmd == 'dumpxml':
+            print(get_domain(positional[0])['xml'])
+        elif cmd == 'vcpuinfo':
+            domain = ElementTree.fromstring(get_domain(positional[0])['xml'])
+            for vcpupin in domain.findall('cputune/vcpupin'):
+                print(f"VCPU:           {vcpupin.get('vcpu')}\nCPU:            {vcpupin.get('cpuset').split(',')[0]}\n"
+                      f"State:          running\n")
+        elif cmd == 'vcpupin':
+            domain = get_domain(positional[0])
+            xml = ElementTree.fromstring(domain['xml'])
+            cputune = xml.find('cputune')
+            if cputune is None:
+                cputune = ElementTree.SubElement(xml, 'cputune')
+            vcpu = get_option(args, '--vcpu')
+            vcpupin = cputune.find(f"vcpupin[@vcpu='{vcpu}']")
+            if vcpupin is None:
+                vcpupin = ElementTree.SubElement(cputune, 'vcpupin', vcpu=vcpu)
+            vcpupin.set('cpuset', positional[-1])
+            domain['xml'] = ElementTree.tostring(xml, encoding='unicode')
+            save('virsh/domains', positional[0], domain)
+        elif cmd in ('emulatorpin', 'numatune'):
+            get_domain(positional[0])
+        elif cmd == 'metadata':
+            uri = get_option(args, '--uri')
+            metadata = ElementTree.fromstring(get_domain(positional[0])['xml']).find('metadata')
+            element = metadata.find(f"{{{uri}}}*") if metadata is not None else None
+            if element is None:
+                fail("metadata not found: Requested metadata element is not present")
+            print(ElementTree.tostring(element, encoding='unicode'))
+        elif cmd == 'attach-device':
+            domain = get_domain(positional[0])
+            xml = ElementTree.fromstring(domain['xml'])
+            with open(positional[1]) as f:
+                xml.find('devices').append(ElementTree.fromstring(f.read()))
+            domain['xml'] = ElementTree.tostring(xml, encoding='unicode')
+            save('virsh/domains', positional[0], domain)
+        elif cmd != 'console':
+            fail(f"unknown command: '{cmd}'")
+    if cmd == 'console':
+        if not get_domain(positional[0])['active']:
+            fail("The domain is not running")
+        ConsoleSimulator(positional[0]).run(f"Connected to domain '{positional[0]}'\r\n"
+                                            f"Escape character is ^] (Ctrl + ])\r\n")
+
+
+def ip_link_add(name):
+    if_dir = os.path.join(ROOT, 'sysfs/class/net', name)
+    if os.path.exists(if_dir):
+        fail("RTNETLINK answers: File exists")
+    for sub_dir in ('bridge', 'brif'):
+        os.makedirs(os.path.join(if_dir, sub_dir))
+    _write(if_dir, 'operstate', 'down')
+    _write(if_dir, 'mtu', '1500')
+
+
+def ip(args):
+    """
+    `ip -batch -` with the link commands of the script: add a bridge, attach a port, set up and delete
+    """
+    if args[:2] != ['-batch', '-']:
+        fail(f"unsupported arguments: {' '.join(args)}")
+    net_dir = os.path.join(ROOT, 'sysfs/class/net')
+    with host_lock():
+        for line in sys.stdin.read().splitlines():
+            words = line.split()
+            if not words:
+                continue
+            if words[:3] == ['link', 'add', 'name']:
+                ip_link_add(words[3])
+                continue
+            if_name = words[3]
+            if_dir = os.path.join(net_dir, if_name)
+            if not os.path.isdir(if_dir):
+                fail(f"Cannot find device \"{if_name}\"")
+            if words[:2] == ['link', 'del']:
+                shutil.rmtree(if_dir)
+            elif words[4:] == ['up']:
+                _write(if_dir, 'operstate', 'up')
+            elif words[4] == 'master':
+                os.symlink(os.path.join('..', words[5]), os.path.join(if_dir, 'master'))
+                os.symlink(os.path.join('../..', if_name), os.path.join(net_dir, words[5], 'brif', if_name))
+            else:
+                fail(f"unsupported command: {line}")
+
+
+def qemu_img(args):
+    """
+    `qemu-img create`: an empty qcow2 image, which records its backing file
+    """
+    if args[:1] != ['create']:
+        fail(f"unsupported arguments: {' '.join(args)}")
+    with open(args[-1], 'wb') as f:
+        f.write(QCOW2_MAGIC + (get_option(args, '-b') or '').encode())
+
+
+def telnet(args):
+    """
+    telnet to the serial console port of a domain (the tcp consoles of the vMX VMs)
+    """
+    port = args[-1]
+    for name in list_names('virsh/domains'):
+        domain = load('virsh/domains', name)
+        if domain['active'] and re.search(rf"<source [^>]*service=['\"]{port}['\"]", domain['xml']):
+            ConsoleSimulator(name).run(f"Trying {args[0]}...\r\nConnected to {args[0]}.\r\n"
+                                       f"Escape character is '^]'.\r\n")
+            return
+    fail("Unable to connect to remote host: Connection refused")
+
+
+def vmx_sh(args):
+    """
+    the installation script of the vMX bundle, run from the folder of the vMX. '--install' defines and starts the vcp
+    and vfp domains with the console ports of 'config/vmx.conf'
+    """
+    vm_name = os.path.basename(os.getcwd())
+    if '--console' in args:
+        name = f"vcp-{args[-1]}"
+        ConsoleSimulator(name).run(f"--\r\nConsole connected to {name}\r\nPress Ctrl-] to exit anytime\r\n--\r\n")
+    elif '--install' in args:
+        with open(os.path.join('config', 'vmx.conf')) as f:
+            sections = [section for section in yaml.safe_load_all(f) if section]
+        ports = {name: section[name]['console_port'] for section in sections for name in section
+                 if name in ('CONTROL_PLANE', 'FORWARDING_PLANE')}
+        with host_lock():
+            for prefix, section in (('vcp', 'CONTROL_PLANE'), ('vfp', 'FORWARDING_PLANE')):
+                name = f"{prefix}-{vm_name}"
+                save('virsh/domains', name, {
+                    'active': True, 'autostart': False, 'started': time(),
+                    'xml': f"<domain type='kvm'><name>{name}</name><devices><serial type='tcp'><source mode='bind' "
+                           f"host='127.0.0.1' service='{ports[section]}'/><protocol type='telnet'/></serial>"
+                           f"</devices></domain>"})
+        print(f"Installation of vmx '{vm_name}' is complete")
+    elif '--cleanup' in args:
+        with host_lock():
+            for prefix in ('vcp', 'vfp'):
+                disconnect_console(f"{prefix}-{vm_name}")
+                remove('virsh/domains', f"{prefix}-{vm_name}")
+    elif '--bind-dev' not in args:
+        fail(f"unsupported arguments: {' '.join(args)}")
+
+
+class ConsoleSimulator:
+    """
+    the serial console of a fake domain. plays back the boot transcript from the time the domain was started (output
+    that was due before the console was attached is written at once), then answers each input line by the prompt
+    states of the transcript. the prompt state is kept between sessions, as the console of a real VM is.
+    input is echoed as a terminal would, a Ctrl-D is the input line '^D'
+    """
+    def __init__(self, name):
+        self.name = name
+        with open(os.path.join(TRANSCRIPTS_DIR, f"{get_console_transcript(name)}.yaml")) as f:
+            self.transcript = yaml.safe_load(f)
+        self.console = None
+
+    def run(self, banner):
+        """
+        :param banner: the connection message of the console client, written once the input is read as typed
+        """
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        with host_lock():
+            self.console = disconnect_console(self.name)
+            self.console['pid'] = os.getpid()
+            self._save()
+        attributes = termios.tcgetattr(0) if os.isatty(0) else None
+        if attributes:
+            tty.setraw(0, termios.TCSANOW)  # keep input that was typed already
+        self._write(banner)
+        try:
+            if not self.console.get('state'):
+                self._boot()
+            line = ''
+            while True:
+                data = os.read(0, 1024).decode(errors='replace')
+                if not data:
+                    return
+                for char in data:
+                    if char in '\r\n':
+                        self._write('\r\n')
+                        self._answer(line)
+                        line = ''
+                    elif char == '\x04':
+                        self._answer('^D')
+                    else:
+                        line += char
+                        self._write(char)
+        except OSError:
+            pass  # the console was closed
+        finally:
+            if attributes:
+                termios.tcsetattr(0, termios.TCSADRAIN, attributes)
+
+    def _boot(self):
+        """
+        write the boot lines when they are due, ignoring the input meanwhile
+        """
+        started = get_domain(self.name).get('started', time())
+        due = started
+        for delay, text in self.transcript['boot']:
+            due += delay * TIME_SCALE
+            while time() < due:
+                if select.select([0], [], [], due - time())[0] and not os.read(0, 1024):
+                    sys.exit(0)
+            self._write(text)
+        self.console['state'] = self.transcript['start_state']
+        self._save()
+
+    def _answer(self, line):
+        for rule in self.transcript['states'][self.console['state']]:
+            if re.fullmatch(rule['match'], line.strip()):
+                sleep(rule.get('delay', 0) * TIME_SCALE)
+                self._write(rule['reply'])
+                if rule.get('next'):
+                    self.console['state'] = rule['next']
+                    self._save()
+                return
+
+    def _save(self):
+        save('consoles', self.name, self.console)
+
+    @staticmethod
+    def _write(text):
+        os.write(1, text.encode())
+
+
+TOOLS = {'virsh': virsh, 'ip': ip, 'qemu-img': qemu_img, 'telnet': telnet, 'vmx.sh': vmx_sh}
+
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    if tool not in TOOLS or not ROOT:
+        fail(f"'{tool}' is not a fake host tool, or FAKE_HOST_ROOT is not set")
+    with open(os.path.join(ROOT, 'calls.log'), 'a') as f:
+        f.write(f"{tool} {' '.join(sys.argv[1:2])}\n")
+    TOOLS[tool](sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,117 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import collections
+import fcntl
+import hashlib
 import ipaddress
+import json
 import os
 import re
+import select
+import shutil
+import signal
+import socket
+import socketserver
 import subprocess
 import sys
-from time import monotonic, sleep
+import termios
+import threading
+import traceback
+import tty
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import wraps
+from time import monotonic, sleep, time
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
 from uuid import uuid4
 
 import yaml
 
 try:
     import pexpect as pexpect
+    import pexpect.fdpexpect
 except ModuleNotFoundError as e:
+    pexpect = None
     print("WARNING: missing python dependencies, please run the script with the '--install_prereq' flag")
 
+try:
+    import libvirt
+except ModuleNotFoundError:
+    libvirt = None  # fall back to the `virsh` command line
+
+try:
+    from pyroute2 import IPRoute
+    from pyroute2.netlink.exceptions import NetlinkError
+except ModuleNotFoundError:
+    IPRoute = None  # fall back to the `ip` command line
+
+
+HOST_CMD_WORKERS = 8  # max number of host commands that `send_host_cmds` runs at the same time
+# host locations, overridable from the environment so the script can run against a fake host (see 'bench/')
+SYSFS_ROOT = os.environ.get('CREATE_VM_SYSFS_ROOT', '/sys')
+IMAGES_DIR = os.environ.get('CREATE_VM_IMAGES_DIR', '/var/lib/libvirt/images/')
+RUN_DIR = os.environ.get('CREATE_VM_RUN_DIR', '/run')
+NET_BACKEND = os.environ.get('CREATE_VM_NET_BACKEND', 'auto')  # one of 'auto', 'ip' ('ip' never uses pyroute2)
+# multiplier of the fixed waits for the VMs to settle (see 'vm_sleep'), the fake host of 'bench/' runs them faster
+VM_SLEEP_SCALE = float(os.environ.get('CREATE_VM_SLEEP_SCALE', '1'))
+
+
+def vm_sleep(seconds):
+    """
+    a fixed wait for a VM to settle, e.g before configuring a juniper that just booted. scaled by VM_SLEEP_SCALE
+    """
+    sleep(seconds * VM_SLEEP_SCALE)
+
+
+async def _run_host_cmd(cmd, timeout, stream=False, stderr=None, **kwargs):
+    """
+    run a shell command on the host. stdout (and stderr, if piped) are read as they arrive, so a command with a large
+    output never blocks on a full pipe. on timeout or cancellation the whole process group of the command is killed.
+
+    :param stream: also print the command output while it runs
+    :return: tuple of (status_code, stdout)
+    """
+    process = await asyncio.create_subprocess_shell(cmd, stdout=subprocess.PIPE, stderr=stderr,
+                                                    start_new_session=True, **kwargs)
+    stdout = []
+
+    async def _read(pipe, chunks=None):
+        while True:
+            chunk = await pipe.read(64 * 1024)
+            if not chunk:
+                return
+            if chunks is not None:
+                chunks.append(chunk)
+            if stream:
+                sys.stdout.write(chunk.decode(errors='replace'))
+                sys.stdout.flush()
+
+    readers = [_read(process.stdout, stdout)]
+    if stderr == subprocess.PIPE:
+        readers.append(_read(process.stderr))
+    try:
+        await asyncio.wait_for(asyncio.gather(*readers, process.wait()), timeout)
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(cmd, timeout, output=b''.join(stdout))
+    finally:
+        if process.returncode is None:
+            os.killpg(process.pid, signal.SIGKILL)
+            await process.wait()
+    return process.returncode, b''.join(stdout).decode().strip()
+
+
+def _check_host_cmd_result(cmd, status_code, stdout, strict, return_status_code):
+    if strict and status_code != 0:
+        print(f"ERROR: failed to execute command '{cmd}' on host")
+        exit(1)
+    if return_status_code:
+        return status_code
+    return stdout
+
 
 def send_host_cmd(cmd, strict=True, timeout=30, return_status_code=False, **kwargs) -> str or int:
     """
@@ -23,16 +120,709 @@ def send_host_cmd(cmd, strict=True, timeout=30, return_status_code=False, **kwar
     :param strict: if True, stop execution on failure
     :param timeout: time to wait for process to exit
     :param return_status_code: return status code instead of stdout
+    :param kwargs: 'stream' to print the output while the command runs, 'cwd', 'stderr', etc. for the subprocess
     """
-    child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, **kwargs)
-    status_code = child.wait(timeout)
-    if strict and status_code != 0:
-        print(f"ERROR: failed to execute command '{cmd}' on host")
+    with trace_span(get_cmd_span_name(cmd), 'cmd', cmd=cmd):
+        status_code, stdout = asyncio.run(_run_host_cmd(cmd, timeout, **kwargs))
+    return _check_host_cmd_result(cmd, status_code, stdout, strict, return_status_code)
+
+
+def send_host_cmds(cmds, strict=True, timeout=30, return_status_code=False, max_workers=HOST_CMD_WORKERS, **kwargs):
+    """
+    send independent commands to the local host and run them concurrently, at most 'max_workers' at a time.
+    same arguments as `send_host_cmd`. when 'strict', execution stops after all commands are done if any of them failed.
+
+    :return: list of the results, in the order of 'cmds'
+    """
+    async def _run_all():
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def _run(cmd):
+            async with semaphore:
+                with trace_span(get_cmd_span_name(cmd), 'cmd', cmd=cmd):
+                    return await _run_host_cmd(cmd, timeout, **kwargs)
+
+        return await asyncio.gather(*[_run(cmd) for cmd in cmds])
+
+    results = asyncio.run(_run_all())
+    failed = [cmd for cmd, (status_code, _) in zip(cmds, results) if status_code != 0]
+    if strict and failed:
+        for cmd in failed:
+            print(f"ERROR: failed to execute command '{cmd}' on host")
         exit(1)
-    if return_status_code:
-        return status_code
-    # noinspection PyUnresolvedReferences
-    return child.communicate()[0].decode().strip()
+    return [_check_host_cmd_result(cmd, status_code, stdout, False, return_status_code)
+            for cmd, (status_code, stdout) in zip(cmds, results)]
+
+
+class Tracer:
+    """
+    records timed spans of a run: the VM creation phases, the host commands and the console expects.
+    the spans are written as a chrome trace (chrome://tracing or ui.perfetto.dev), or as json lines if the trace file
+    ends with '.jsonl', and summarized as a table of the time spent per span name.
+    """
+    def __init__(self):
+        self.start = monotonic()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            span = {'name': name, 'cat': cat, 'ph': 'X', 'ts': int((start - self.start) * 1e6),
+                    'dur': int((monotonic() - start) * 1e6), 'pid': os.getpid(), 'tid': threading.get_native_id(),
+                    'args': {key: value for key, value in args.items() if value is not None}}
+            with self.lock:
+                self.spans.append(span)
+
+    def write(self, path):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda _span: _span['ts'])
+        with open(path, 'w') as f:
+            if path.endswith('.jsonl'):
+                f.writelines(json.dumps(span) + '\n' for span in spans)
+            else:
+                json.dump({'traceEvents': spans, 'displayTimeUnit': 'ms'}, f)
+        print(f"trace written to '{path}'")
+
+    def print_summary(self, limit=30):
+        """
+        print the total time, call count and max time of each span name, longest total first. the time of nested
+        spans is also part of the time of their parents
+        """
+        totals = {}
+        with self.lock:
+            for span in self.spans:
+                total = totals.setdefault((span['cat'], span['name']), [0, 0, 0])
+                total[0] += span['dur']
+                total[1] += 1
+                total[2] = max(total[2], span['dur'])
+        rows = sorted(totals.items(), key=lambda _row: -_row[1][0])[:limit]
+        width = max([len(name) for (_, name), _ in rows] + [4])
+        print(f"{'span':<{width}}  {'type':<6}  {'calls':>6}  {'total(s)':>9}  {'max(s)':>8}")
+        for (cat, name), (total, count, longest) in rows:
+            print(f"{name:<{width}}  {cat:<6}  {count:>6}  {total / 1e6:>9.2f}  {longest / 1e6:>8.2f}")
+
+
+_tracers = {}  # {request output stream (None out of the daemon): Tracer} of the traced runs
+
+
+def trace_span(name, cat, **args):
+    """
+    a span of the traced run of the current thread, or a no-op context if the run is not traced
+    """
+    tracer = _tracers.get(ThreadOutput.current())
+    return tracer.span(name, cat, **args) if tracer else nullcontext()
+
+
+def traced(func):
+    """
+    decorator that records a 'phase' span for each call of a function, with the VM name of InteropEnv methods
+    """
+    @wraps(func)
+    def _traced(*args, **kwargs):
+        with trace_span(func.__name__, 'phase', vm=getattr(args[0], 'vm_name', None) if args else None):
+            return func(*args, **kwargs)
+    return _traced
+
+
+def get_cmd_span_name(cmd):
+    """
+    the span name of a host command: its program and first argument, e.g 'virsh define'
+    """
+    return ' '.join(cmd.split()[:2])
+
+
+class TracedExpect:
+    """
+    mixin for pexpect children that records an 'expect' span for each expect call
+    """
+    def expect(self, pattern, *args, **kwargs):
+        with trace_span(f"expect {str(pattern)[:40]}", 'expect'):
+            return super().expect(pattern, *args, **kwargs)
+
+
+if pexpect:
+    class TracedSpawn(TracedExpect, pexpect.spawn):
+        """
+        a pexpect child of a command, with traced expect calls
+        """
+
+
+class VirshBackend:
+    """
+    libvirt domain and network operations using the `virsh` command line.
+    this is the fallback backend, used when libvirt-python is not installed or the connection to libvirtd failed.
+    """
+    name = 'virsh'
+
+    @staticmethod
+    def _define_from_file(cmd, xml, prefix):
+        xml_path = f'/tmp/{prefix}_{uuid4()}.xml'
+        with open(xml_path, 'w') as f:
+            f.write(xml)
+        send_host_cmd(f"{cmd} {xml_path}", timeout=60 * 5)
+        os.remove(xml_path)
+
+    def define_domain(self, xml):
+        self._define_from_file("virsh define", xml, 'domain_xml')
+
+    def start_domain(self, name):
+        send_host_cmd(f"virsh start {name}")
+
+    def set_autostart(self, name):
+        send_host_cmd(f"virsh autostart {name}")
+
+    def pin_vcpu(self, name, vcpu, cpu):
+        send_host_cmd(f"virsh vcpupin {name} --vcpu {vcpu} {cpu} --config --live")
+
+    def pin_emulator(self, name, cpus):
+        send_host_cmd(f"virsh emulatorpin {name} {','.join(str(cpu) for cpu in cpus)} --config --live")
+
+    def set_memory_node(self, name, node):
+        send_host_cmd(f"virsh numatune {name} --mode preferred --nodeset {node} --config")
+
+    def get_domain_xml(self, name):
+        return send_host_cmd(f"virsh dumpxml {name}")
+
+    def destroy_domain(self, name):
+        """
+        :return: True on success
+        """
+        return send_host_cmd(f"virsh destroy {name}", strict=False, return_status_code=True,
+                             stderr=subprocess.PIPE) == 0
+
+    def undefine_domain(self, name):
+        """
+        :return: True on success
+        """
+        return send_host_cmd(f"virsh undefine {name} --nvram", strict=False, return_status_code=True,
+                             stderr=subprocess.PIPE) == 0
+
+    def list_domains(self, active_only=False):
+        return send_host_cmd(f"virsh list {'' if active_only else '--all'} --name").split()
+
+    def get_domains_metadata(self):
+        """
+        :return: {domain: the <vax:vm> metadata XML of the domain, or '' if it has none}, of all the domains
+        """
+        output = send_host_cmd(f"for vm in $(virsh list --all --name); do echo \"domain: $vm\"; "
+                               f"virsh metadata $vm --uri {VM_METADATA_NS} 2>/dev/null; done", strict=False)
+        metadata = {}
+        for domain_output in re.split(r'^domain: ', output or '', flags=re.MULTILINE)[1:]:
+            name, _, xml = domain_output.partition('\n')
+            metadata[name.strip()] = xml.strip()
+        return metadata
+
+    def is_domain_active(self, name):
+        return name in self.list_domains(active_only=True)
+
+    def attach_device(self, name, xml):
+        """
+        attach a device to the running vm and to its persistent config
+        """
+        self._define_from_file(f"virsh attach-device {name} --config --live", xml, 'device_xml')
+
+    def save_domain(self, name, state_path):
+        """
+        save the memory state of a running vm to a file and stop it
+        """
+        send_host_cmd(f"virsh save {name} {state_path}", timeout=60 * 5)
+
+    def get_saved_state_xml(self, state_path):
+        return send_host_cmd(f"virsh save-image-dumpxml {state_path}")
+
+    def restore_domain(self, state_path, xml):
+        """
+        start a vm from a saved memory state, using an updated XML (name, disks, pinning, etc.)
+        """
+        self._define_from_file(f"virsh restore {state_path} --xml", xml, 'restore_xml')
+
+    def list_networks(self, no_autostart_only=False):
+        return send_host_cmd(f"virsh net-list {'--no-autostart' if no_autostart_only else '--all'} --name").split()
+
+    def define_network(self, xml):
+        self._define_from_file("virsh net-define", xml, 'net_xml')
+
+    def start_network(self, name):
+        send_host_cmd(f"virsh net-start {name}")
+
+    def set_network_autostart(self, name):
+        send_host_cmd(f"virsh net-autostart {name}")
+
+    def get_used_cpus(self):
+        """
+        get the physical CPUs that the vCPUs of all running domains are using
+        """
+        cmd = 'virsh list --name | xargs -I {} virsh vcpuinfo {} | grep -E "^CPU:" | cut -d ":" -f2'
+        used_cpus = send_host_cmd(cmd, strict=False)
+        return {int(cpu) for cpu in used_cpus.split()}
+
+
+class LibvirtBackend:
+    """
+    libvirt domain and network operations using libvirt-python over a single persistent connection, instead of
+    forking a `virsh` process per operation.
+    """
+    name = 'libvirt'
+
+    def __init__(self, uri='qemu:///system'):
+        self.conn = libvirt.open(uri)
+
+    @staticmethod
+    def _call(description, func, *args, strict=True):
+        """
+        run a libvirt call. on failure, stop execution if 'strict', else return None
+        """
+        try:
+            return func(*args)
+        except libvirt.libvirtError as e:
+            if strict:
+                print(f"ERROR: failed to {description}: {e}")
+                exit(1)
+            return None
+
+    def is_alive(self):
+        return bool(self._call("", self.conn.isAlive, strict=False))
+
+    def _domain(self, name):
+        return self._call(f"find vm '{name}'", self.conn.lookupByName, name)
+
+    def _network(self, name):
+        return self._call(f"find network '{name}'", self.conn.networkLookupByName, name)
+
+    def define_domain(self, xml):
+        self._call("define vm", self.conn.defineXML, xml)
+
+    def start_domain(self, name):
+        self._call(f"start vm '{name}'", self._domain(name).create)
+
+    def set_autostart(self, name):
+        self._call(f"set autostart for vm '{name}'", self._domain(name).setAutostart, 1)
+
+    def _cpumap(self, cpus):
+        return tuple(i in cpus for i in range(self.conn.getCPUMap()[0]))
+
+    @staticmethod
+    def _affect_flags(domain):
+        flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        if domain.isActive():
+            flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+        return flags
+
+    def pin_vcpu(self, name, vcpu, cpu):
+        domain = self._domain(name)
+        self._call(f"pin vcpu {vcpu} of vm '{name}' to cpu {cpu}", domain.pinVcpuFlags, vcpu, self._cpumap({cpu}),
+                   self._affect_flags(domain))
+
+    def pin_emulator(self, name, cpus):
+        domain = self._domain(name)
+        self._call(f"pin the emulator of vm '{name}' to cpus {cpus}", domain.pinEmulator, self._cpumap(set(cpus)),
+                   self._affect_flags(domain))
+
+    def set_memory_node(self, name, node):
+        params = {libvirt.VIR_DOMAIN_NUMA_MODE: libvirt.VIR_DOMAIN_NUMATUNE_MEM_PREFERRED,
+                  libvirt.VIR_DOMAIN_NUMA_NODESET: str(node)}
+        self._call(f"set the memory node of vm '{name}'", self._domain(name).setNumaParameters, params,
+                   libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
+    def get_domain_xml(self, name):
+        return self._call(f"get the xml of vm '{name}'", self._domain(name).XMLDesc, 0)
+
+    def destroy_domain(self, name):
+        domain = self._call(f"find vm '{name}'", self.conn.lookupByName, name, strict=False)
+        return domain is not None and self._call("", domain.destroy, strict=False) is not None
+
+    def undefine_domain(self, name):
+        domain = self._call(f"find vm '{name}'", self.conn.lookupByName, name, strict=False)
+        return domain is not None and self._call("", domain.undefineFlags, libvirt.VIR_DOMAIN_UNDEFINE_NVRAM,
+                                                 strict=False) is not None
+
+    def list_domains(self, active_only=False):
+        flags = libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE if active_only else 0
+        return [domain.name() for domain in self.conn.listAllDomains(flags)]
+
+    def get_domains_metadata(self):
+        """
+        :return: {domain: the <vax:vm> metadata XML of the domain, or '' if it has none}, of all the domains
+        """
+        return {domain.name(): self._call("", domain.metadata, libvirt.VIR_DOMAIN_METADATA_ELEMENT, VM_METADATA_NS,
+                                          strict=False) or ''
+                for domain in self.conn.listAllDomains(0)}
+
+    def is_domain_active(self, name):
+        domain = self._call(f"find vm '{name}'", self.conn.lookupByName, name, strict=False)
+        return bool(domain and domain.isActive())
+
+    def attach_device(self, name, xml):
+        self._call(f"attach a device to vm '{name}'", self._domain(name).attachDeviceFlags, xml,
+                   libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_AFFECT_LIVE)
+
+    def save_domain(self, name, state_path):
+        self._call(f"save the state of vm '{name}'", self._domain(name).save, state_path)
+
+    def get_saved_state_xml(self, state_path):
+        return self._call(f"read the saved state '{state_path}'", self.conn.saveImageGetXMLDesc, state_path, 0)
+
+    def restore_domain(self, state_path, xml):
+        self._call(f"restore the saved state '{state_path}'", self.conn.restoreFlags, state_path, xml, 0)
+
+    def list_networks(self, no_autostart_only=False):
+        flags = libvirt.VIR_CONNECT_LIST_NETWORKS_NO_AUTOSTART if no_autostart_only else 0
+        return [network.name() for network in self.conn.listAllNetworks(flags)]
+
+    def define_network(self, xml):
+        self._call("define network", self.conn.networkDefineXML, xml)
+
+    def start_network(self, name):
+        self._call(f"start network '{name}'", self._network(name).create)
+
+    def set_network_autostart(self, name):
+        self._call(f"set autostart for network '{name}'", self._network(name).setAutostart, 1)
+
+    def get_used_cpus(self):
+        """
+        get the physical CPUs that the vCPUs of all running domains are using, with a single domain listing
+        """
+        used_cpus = set()
+        for domain in self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE):
+            vcpus_info = self._call("", domain.vcpus, strict=False)
+            if vcpus_info:
+                used_cpus.update(vcpu_info[3] for vcpu_info in vcpus_info[0])
+        return used_cpus
+
+
+VIRT_BACKEND = 'auto'  # one of 'auto', 'libvirt', 'virsh'
+_virt_backend = None
+_virt_backend_lock = threading.Lock()
+
+
+def get_virt_backend():
+    """
+    get the shared libvirt backend. libvirt-python is used when available, with `virsh` as the fallback.
+    a libvirt connection that was lost (e.g libvirtd was restarted under the daemon) is opened again.
+    """
+    global _virt_backend
+    with _virt_backend_lock:
+        if _virt_backend and _virt_backend.name == 'libvirt' and not _virt_backend.is_alive():
+            print("WARNING: the libvirt connection was lost, reconnecting")
+            _virt_backend = None
+        if _virt_backend:
+            return _virt_backend
+        if VIRT_BACKEND != 'virsh' and libvirt:
+            try:
+                _virt_backend = LibvirtBackend()
+            except libvirt.libvirtError as e:
+                print(f"WARNING: failed to connect to libvirt, falling back to virsh: {e}")
+        elif VIRT_BACKEND == 'libvirt':
+            print("WARNING: libvirt-python is not installed, falling back to virsh")
+        if not _virt_backend:
+            _virt_backend = VirshBackend()
+        return _virt_backend
+
+
+IMAGE_STORE_QUOTA_GB = 100  # default max size of the image store, see --image_store_quota_gb
+
+
+class ImageStore:
+    """
+    local store of VM images, keyed by their sha256 checksum.
+    - downloads are chunked and written to a partial file, so an interrupted download is resumed on the next run
+    - an image is verified against its checksum before it is used, and published to its local path atomically, so a
+      partial image is never used
+    - concurrent runs lock the image while fetching it, so they share a single download instead of racing
+    - images that are not published anymore are evicted, least recently used first, when the store exceeds the quota
+      of the run
+
+    layout under 'root':
+    - objects/sha256/<checksum>: verified images. the published local path is a hardlink to its object
+    - partial/<local_name>.part: downloads in progress
+    - locks/<local_name>.lock
+    - index.json: {local_name: {'sha256': checksum, 'size': bytes, 'last_used': timestamp}}
+    """
+    CHUNK_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects', 'sha256')
+        self.partial_dir = os.path.join(root, 'partial')
+        self.locks_dir = os.path.join(root, 'locks')
+        self.index_path = os.path.join(root, 'index.json')
+        for path in (self.objects_dir, self.partial_dir, self.locks_dir):
+            os.makedirs(path, exist_ok=True)
+
+    def _lock(self, name):
+        lock_file = open(os.path.join(self.locks_dir, f"{name}.lock"), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _update_index(self, name, entry):
+        with self._lock('index'):
+            index = self._read_index()
+            if entry:
+                index[name] = entry
+            else:
+                index.pop(name, None)
+            tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f, indent=2)
+            os.replace(tmp_path, self.index_path)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def fetch(self, image_info, quota_gb=IMAGE_STORE_QUOTA_GB):
+        """
+        make sure a verified copy of the image is published at its local path, then evict unused images above
+        'quota_gb'.
+        """
+        name = image_info['local_name']
+        local_path = image_info['local_path']
+        with self._lock(name):
+            entry = self._read_index().get(name)
+            if entry and self._is_published(entry, local_path):
+                print(f"using image at local path '{local_path}' for vm creation")
+                self._update_index(name, dict(entry, last_used=time()))
+                return local_path
+            expected_digest = self._get_expected_digest(image_info)
+            if os.path.exists(local_path):
+                # an image that was fetched before the store was used, verify it once and adopt it
+                print(f"verifying image at local path '{local_path}'")
+                digest = self._sha256(local_path)
+                if not expected_digest or digest == expected_digest:
+                    self._publish(name, local_path, digest, local_path)
+                    return local_path
+                print(f"WARNING: checksum mismatch for image at local path '{local_path}', fetching it again")
+            part_path = os.path.join(self.partial_dir, f"{name}.part")
+            self._download(image_info, part_path)
+            digest = self._sha256(part_path)
+            if expected_digest and digest != expected_digest:
+                os.remove(part_path)
+                exit(f"ERROR: checksum mismatch for image '{name}', expected '{expected_digest}' got '{digest}'")
+            self._publish(name, part_path, digest, local_path)
+        self.evict(quota_gb)
+        return local_path
+
+    def _is_published(self, entry, local_path):
+        object_path = self._object_path(entry['sha256'])
+        return (os.path.exists(local_path) and os.path.exists(object_path) and
+                os.path.samefile(local_path, object_path) and os.path.getsize(local_path) == entry['size'])
+
+    def _publish(self, name, path, digest, local_path):
+        """
+        move a verified image into the store and hardlink it to its local path, replacing the local path atomically
+        """
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            if path == local_path:
+                os.link(path, object_path)
+            else:
+                os.rename(path, object_path)
+        if not (os.path.exists(local_path) and os.path.samefile(local_path, object_path)):
+            tmp_link = f"{local_path}.{os.getpid()}.tmp"
+            os.link(object_path, tmp_link)
+            os.replace(tmp_link, local_path)
+        if path not in (local_path, object_path) and os.path.exists(path):
+            os.remove(path)
+        print(f"image '{name}' published to local path '{local_path}' (sha256 {digest})")
+        self._update_index(name, {'sha256': digest, 'size': os.path.getsize(object_path), 'last_used': time()})
+
+    @staticmethod
+    def _get_expected_digest(image_info):
+        """
+        get the expected checksum from the image info, or from a '<url>.sha256' file next to the image
+        """
+        if image_info.get('sha256') or not image_info.get('url'):
+            return image_info.get('sha256')
+        try:
+            with urlopen(f"{image_info['url']}.sha256", timeout=30) as response:
+                return response.read().decode().split()[0]
+        except (OSError, IndexError):
+            return None
+
+    def _download(self, image_info, part_path):
+        """
+        download an image to 'part_path', resuming from the data that is already there
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        source = image_info.get('url') or image_info['src']
+        print(f"copying image '{source}' to '{part_path}'" + (f", resuming from byte {offset}" if offset else ""))
+        if not image_info.get('url'):
+            return self._download_rsync(image_info, part_path)
+        if image_info['url'].startswith('file://'):
+            with open(urlparse(image_info['url']).path, 'rb') as response:
+                response.seek(offset)
+                self._write_chunks(response, part_path, offset)
+            return
+        request = Request(image_info['url'], headers={'Range': f"bytes={offset}-"} if offset else {})
+        with urlopen(request, timeout=60) as response:
+            if offset and response.status != 206:
+                offset = 0  # the server doesn't support ranges, start over
+            self._write_chunks(response, part_path, offset)
+
+    def _write_chunks(self, response, part_path, offset):
+        with open(part_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            for chunk in iter(lambda: response.read(self.CHUNK_SIZE), b''):
+                f.write(chunk)
+
+    @staticmethod
+    def _download_rsync(image_info, part_path):
+        copy_cmd = (f"rsync --partial --append-verify "
+                    f"-e 'ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no' "
+                    f"{image_info['user']}@{image_info['src']} {part_path}")
+        child = TracedSpawn(copy_cmd, timeout=None)
+        if child.expect(["password:", pexpect.EOF]) == 0:
+            child.sendline(image_info['pass'])
+            child.expect(pexpect.EOF)
+        child.close()
+        if child.exitstatus != 0:
+            exit(f"ERROR: failed to copy image '{image_info['src']}', run again to resume the download")
+
+    def _sha256(self, path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def evict(self, quota_gb):
+        """
+        delete the least recently used objects until the store is within 'quota_gb'. objects that are still published
+        (hardlinked to a local path) are in use and are never evicted.
+        """
+        with self._lock('index'):
+            index = self._read_index()
+        last_used = {entry['sha256']: entry['last_used'] for entry in index.values()}
+        objects = [os.path.join(self.objects_dir, digest) for digest in os.listdir(self.objects_dir)]
+        total_size = sum(os.path.getsize(path) for path in objects)
+        evictable = sorted((path for path in objects if os.stat(path).st_nlink == 1),
+                           key=lambda path: last_used.get(os.path.basename(path), 0))
+        for path in evictable:
+            if total_size <= quota_gb * 1024 ** 3:
+                break
+            print(f"evicting unused image '{path}' from the image store")
+            total_size -= os.path.getsize(path)
+            os.remove(path)
+            for name, entry in index.items():
+                if entry['sha256'] == os.path.basename(path):
+                    self._update_index(name, None)
+
+
+_image_store = None
+_run_args = {}  # {request output stream (None out of the daemon): parsed arguments of the run}
+
+
+def get_image_store():
+    global _image_store
+    if not _image_store:
+        _image_store = ImageStore(os.path.join(InteropEnv.CISCO_IMAGE['local_dir'], 'image-store'))
+    return _image_store
+
+
+PROGRESS_DIR = os.path.join(IMAGES_DIR, 'vm-progress')
+
+
+class VmProgress:
+    """
+    the progress file of the creation of a VM: the phases of the creation flow that were completed (see
+    'checkpointed') and their results, so a failed run can be run again and resume from the first incomplete phase.
+    the file is removed once the VM is ready, when the VM is deleted, or by '--fresh'.
+
+    layout of '<PROGRESS_DIR>/<vm name>.json':
+    - 'settings': the VM type and the creation options. a resumed run must use the same ones
+    - 'placement': the CPU placement of the VM, kept by a resumed run once the VM is defined (see
+      'get_resumed_placements')
+    - 'phases': {phase: the result it returned}
+    """
+    def __init__(self, vm_name):
+        self.vm_name = vm_name
+        self.path = os.path.join(PROGRESS_DIR, f"{vm_name}.json")
+        try:
+            with open(self.path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        self.resumed = False  # True if a previous run of the VM was started and did not complete
+
+    def start(self, settings, placement):
+        """
+        start or resume the creation of the VM
+        """
+        self.resumed = 'settings' in self.state
+        if self.state.get('settings', settings) != settings:
+            changed = ', '.join(f"{key} '{value}'" for key, value in self.state['settings'].items()
+                                if settings.get(key) != value)
+            exit(f"ERROR: a previous run of vm '{self.vm_name}' failed with other settings ({changed}), use --fresh to "
+                 f"create it from the start")
+        if self.state.get('phases'):
+            print(f"resuming vm '{self.vm_name}' after the phases completed by a previous run: "
+                  f"{', '.join(self.state['phases'])}")
+        self.state = {'settings': settings, 'placement': vars(placement), 'phases': self.state.get('phases', {})}
+        self._write()
+
+    def get_placement(self):
+        """
+        :return: the CpuPlacement of the previous run, or None
+        """
+        if not self.state.get('placement'):
+            return None
+        fields = dict(self.state['placement'])
+        hugepage_kb = fields.pop('hugepage_kb', None)
+        placement = CpuPlacement(**fields)
+        placement.hugepage_kb = hugepage_kb
+        return placement
+
+    def is_done(self, phase):
+        return phase in self.state.get('phases', {})
+
+    def get_result(self, phase):
+        return self.state['phases'][phase]
+
+    def complete(self, phase, result):
+        self.state['phases'][phase] = result
+        self._write()
+
+    def _write(self):
+        os.makedirs(PROGRESS_DIR, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def checkpointed(func):
+    """
+    decorator of the phases of the VM creation flow that are recorded in the progress file of the VM (see
+    'VmProgress'): a phase that a previous run completed is skipped, and returns the result it returned then.
+    phases must be safe to run again after a failure in the middle. out of the creation flow (e.g the golden VM),
+    phases always run
+    """
+    @wraps(func)
+    def _checkpointed(self, *args, **kwargs):
+        if not self.progress:
+            return func(self, *args, **kwargs)
+        if self.progress.is_done(func.__name__):
+            print(f"skipping phase '{func.__name__}' of vm '{self.vm_name}', it was completed by a previous run")
+            return self.progress.get_result(func.__name__)
+        result = func(self, *args, **kwargs)
+        self.progress.complete(func.__name__, result)
+        return result
+    return _checkpointed
 
 
 class InteropEnv:  # TODO: move the images files to a more stable location, not a lab server
@@ -41,41 +831,79 @@ class InteropEnv:  # TODO: move the images files to a more stable location, not
         'src': "kvm95:/var/lib/libvirt/images/cisco_vm_base.qcow2",
         'user': "dn",
         'pass': "drive1234!",
-        'local_dir': "/var/lib/libvirt/images/",
+        'local_dir': IMAGES_DIR,
         'local_name': 'cisco_vm_base.qcow2',
+        'url': None,  # optional http(s):// or file:// source, used instead of 'src' when set
+        'sha256': None,  # expected checksum. if not set, the checksum of the first fetch is trusted and recorded
         'image_size_gb': 6.2,
-        'memory_kb': 8388608
+        'overlay_size_gb': 2,  # space budget for the blocks a single overlay clone writes
+        'memory_kb': 8388608,
+        'cpus': 2
     }
     CISCO_IMAGE['local_path'] = os.path.join(CISCO_IMAGE['local_dir'], CISCO_IMAGE['local_name'])
     JUNIPER_IMAGE = {
         'src': "dn111:/opt/vmx/vmx-bundle-20.4R1.12.tgz",
         'user': "dn",
         'pass': "drive1234!",
-        'local_dir': "/var/lib/libvirt/images/",
+        'local_dir': IMAGES_DIR,
         'local_name': 'vmx-bundle-20.4R1.12.tgz',
+        'url': None,
+        'sha256': None,
+        'version': '20.4R1.12',
         're_image_name': 'junos-vmx-x86-64-20.4R1.12.qcow2',
+        're_hdd_name': 'vmxhdd.img',
+        're_metadata_name': 'metadata-usb-re.img',
+        'fpc_image_name': 'vFPC-20201209.img',
         'license': [
             "19 222 Ni LONG NORMAL STANDALONE AGGR 1_KEYS INFINITE_KEYS 3 FEB 2021 0 0 4 MAR 2022 23 59 NiL SLM_CODE DEMO NiL NiL Ni NiL NiL 15_MINS NiL 0 fW5lRxt9Pg8W25TAFQhPcDG+uv5yCd+507k2il0nIixUZ86ZO0P7MFm7VB1LKmlqWb1nV/rissgJyMKWruPc7xRTjln60mt4n5+2MqdCsr/b3+HOEquRRiLJpawUgIpTl8aK+bVsTCaLreB+zpmNRnzfVbQZWXrEs6mmTF8/ZwY+pGbVTbMl1w+WOJM1MsmW+ZlSHdAiQxZihxVBZIkIH7jk2tT8LeniXQvIJexUkHFXOFxcP06kJQ5grQiJxA18loQ11CWLzOLU6byIW1bC1rBfRKTOf15AN9RTKdJbSgYBLIoRpo/i5fk+60rP7ePK8/ssL4Xsodwanb5wChzSo9PVdaGf26Stqf/f6XJnSg9qTjmWBnf+yNjr8cokt4A0CafIC4Yl6USpeTxAWoSG+WDwTZ13QK4huQGPW9xh0Ymujx4N0OqnPDP1Digfi5T3y0OVOPHrnBJybTCbi/iehW+LuwlJJDWNhR8645CHG+UIeodi8Zwe/BWDc0AtLYOx/duSTrIi/7Wu4k4ovE3iubO+4+2WGNkWJYEr3A/ntpu5xS6cnn6DZ+PKSBqWeULCBQRSQ0IyC4MJBQRSQ0IyBgEBBwEBBCU4YjFiNmYxZC0zNzY5LTRmNGUtYjM4Ny0zNGUzMmVlOTYzYmQACAEBCUClydIpUZi6n8jzILOrVPag59XNDAizpYck68gc4uLfRITzGmdQTKfa9U1K8BGjzfbX0S4wCDZhm4lh55efpLXVCoIOMIIBCgKCAQEA2OMgESQh1fz4LjXZ0SmDsrPGJ2cB5zU4CPsQmQj0FjnjUYfF41nDGO6O4mpIny5WTzFJYSp61719oZyDEVsJYZwnqK3NzyswNBVj3CqSHx3HpKCu1nqAN1sC79hbxa3LsbvGa2522jtMzhrd7F3MdycGewa2O060rrBz9ZroxirqH6Zx4jmzFRJbgZX7UUOJswW3b5cTKlOyX/YYl1rQIoaZ+f1YtEaIRHQ8j9j8Xn/G4AT1XjQFOH9Yfo39PPERGr1sCGOIlKpYWZJhP6L3HqIMF22tsAWJLVkOIPCuI/PZpk5VMmYZoF3KMdo5kSfATgotW6ufhqSNSbhR6nu7iwIDAQABBCU4YjFiNmYxZC0zNzY5LTRmNGUtYjM4Ny0zNGUzMmVlOTYzYmQABwEBDIIAj/0GXRSG4RZgcziqdmNuGArFJszXA01vxuGTUS1dUjdf0PKBt0rp/92L0SoOPcTT/euVdaFJICecqJh5iqMBAEtLAw2fCeVHWSQOQdyj3dcthKhBU9krhybd9MQ+6Zsi1TUReOKqLiTuum7p6IDyVHqIISAfEhoE7j2A446m1JfJON08LujErm7c2f9PFYI0FMbjocBTuotH2gqaemRPGdqasYEP2aPrOdj/bQeGErw+Y2WULrkPYxQsiLDwTzcnEczDmmRHq0hDvCdCAs2bJ8q0CFezNXWJRSHBqd4ZRWvfg8TCCyKFrFSKqLlH+SAgzqW+D0Njf7kqv87hiVz/QwAAAr8=#KeyType=Commercial#AID=7a02c0aa-c4f3-494e-aed5-c53dc774b2b2 SIGN=0728059BAAAB64401E8AAD9502F7E3056A047FA9DBD81713805AE0B146D580BC1AA683E3059F099A1A9E",
             "19 166 Ni LONG NORMAL STANDALONE AGGR 100_KEYS INFINITE_KEYS 3 FEB 2021 0 0 4 MAR 2022 23 59 NiL SLM_CODE DEMO NiL NiL Ni NiL NiL 15_MINS NiL 0 M0xg2NRsCiPg1C6bDOnIqZeTeatA/qWNgvcEidfCGF6Mc7y+9LkJBU/nKwqHUZZ0dM/KsfU2RJ/ybkCGltwVNR/rxdUgc2kQnTONbK4rEtIuMaYRXlmbAoYv//odQbvmvyyQFW/vekVp7ENJHlpBpRQkEcNDOL4npcncXhkz/7d+qi1Du8myEFm8tw0jW/cqYbX4ARgW3y7v2HZ8OofSR89xd3DK/6TplRgR8l2vixBkqpNxac2YGwsK8m0U8wUTyBL0Bs3jt8EddwqJ1GzUJQaiik3nzAZ4YtrTKFPi3T5FSMRabLTCAjz7CWyZnhflmSreSOuEM0kCk6K5BS1FjBIXJ/+AMWtR1S9mFGsA76Z+jnkhfnMO+w/Bdg7kOE72OAdR2/acMURcCawR+Qj+3f0JeYYQuM1wEsZTCZShVZrmUDAQXvq+qJvW5kEHdvK8YIO1rWpC/U+5hBG2RyLnEaAqS2Ec4v1mTZ9LUCBsJB75B5OLVF7OSot2iiUB8n/9wGc7R/MZLWySrif+ub2ILuoU3pybxs44hA6fa5+ZQ3XjYYC/8ivG+gL/fXnp9cnJBQRSQ0IyC4MJBQRSQ0IyBgEBBwEBBCU4YjFiNmYxZC0zNzY5LTRmNGUtYjM4Ny0zNGUzMmVlOTYzYmQACAEBCUClydIpUZi6n8jzILOrVPag59XNDAizpYck68gc4uLfRITzGmdQTKfa9U1K8BGjzfbX0S4wCDZhm4lh55efpLXVCoIOMIIBCgKCAQEA2OMgESQh1fz4LjXZ0SmDsrPGJ2cB5zU4CPsQmQj0FjnjUYfF41nDGO6O4mpIny5WTzFJYSp61719oZyDEVsJYZwnqK3NzyswNBVj3CqSHx3HpKCu1nqAN1sC79hbxa3LsbvGa2522jtMzhrd7F3MdycGewa2O060rrBz9ZroxirqH6Zx4jmzFRJbgZX7UUOJswW3b5cTKlOyX/YYl1rQIoaZ+f1YtEaIRHQ8j9j8Xn/G4AT1XjQFOH9Yfo39PPERGr1sCGOIlKpYWZJhP6L3HqIMF22tsAWJLVkOIPCuI/PZpk5VMmYZoF3KMdo5kSfATgotW6ufhqSNSbhR6nu7iwIDAQABBCU4YjFiNmYxZC0zNzY5LTRmNGUtYjM4Ny0zNGUzMmVlOTYzYmQABwEBDIIAj/0GXRSG4RZgcziqdmNuGArFJszXA01vxuGTUS1dUjdf0PKBt0rp/92L0SoOPcTT/euVdaFJICecqJh5iqMBAEtLAw2fCeVHWSQOQdyj3dcthKhBU9krhybd9MQ+6Zsi1TUReOKqLiTuum7p6IDyVHqIISAfEhoE7j2A446m1JfJON08LujErm7c2f9PFYI0FMbjocBTuotH2gqaemRPGdqasYEP2aPrOdj/bQeGErw+Y2WULrkPYxQsiLDwTzcnEczDmmRHq0hDvCdCAs2bJ8q0CFezNXWJRSHBqd4ZRWvfg8TCCyKFrFSKqLlH+SAgzqW+D0Njf7kqv87hiVz/QwAAAr8=#KeyType=Commercial#AID=7a02c0aa-c4f3-494e-aed5-c53dc774b2b2 SIGN=07280B1E5772C3B7983CE8194E071E0A1DAD00F3AA418B7DD1DAC214CA5DBED42343C702630B8EB17AC6"
         ],
         'image_size_gb': 12,
+        'clone_size_gb': 3,  # space budget for a single vm cloned from the extracted bundle cache
         'vcp_memory_mb': 2048,
         'vfp_memory_mb': 4096,
+        'cpus': 4,  # 1 for the VCP vm and 3 for the VFP vm
     }
     JUNIPER_IMAGE['local_path'] = os.path.join(JUNIPER_IMAGE['local_dir'], JUNIPER_IMAGE['local_name'])
+    JUNIPER_IMAGE['cache_dir'] = os.path.join(JUNIPER_IMAGE['local_dir'], 'vmx-cache', JUNIPER_IMAGE['version'])
+    # virtual hardware of the cisco VMs. 'legacy' is the original emulated hardware, the virtio profiles use
+    # paravirtualized devices: vhost-net with a queue per vCPU, cache-less native disk I/O on a dedicated iothread
+    DEVICE_PROFILES = {
+        'legacy': {'nic_model': 'e1000', 'multiqueue': False, 'disk_bus': 'ide', 'disk_cache': None,
+                   'disk_io': None, 'iothreads': 0},
+        'virtio': {'nic_model': 'virtio', 'multiqueue': True, 'disk_bus': 'virtio', 'disk_cache': 'none',
+                   'disk_io': 'native', 'iothreads': 1},
+        'virtio-scsi': {'nic_model': 'virtio', 'multiqueue': True, 'disk_bus': 'scsi', 'disk_cache': 'none',
+                        'disk_io': 'native', 'iothreads': 1},
+    }
+    # `vmx.sh --install` changes host-wide settings, so parallel juniper installations are done one at a time
+    _vmx_install_lock = threading.Lock()
 
-    def __init__(self, host_mgmt_br, free_cpus, vm_name, vm_type, interfaces, mgmt_ip, mgmt_gw, cli_config):
+    def __init__(self, host_mgmt_br, cpu_placement, vm_name, vm_type, interfaces, mgmt_ip, mgmt_gw, cli_config,
+                 clone_mode='overlay', from_golden=False, device_profile='legacy', day0='serial', from_pool=False,
+                 juniper_installer='native', group=None):
         self.mgmt_ip = mgmt_ip or '1.2.3.4/20'  # TODO: fix juniper installation when no mgmt_ip provided
         self.mgmt_gw = mgmt_gw
         self.cli_config = cli_config or ""
         self.host_mgmt_br = host_mgmt_br
-        self.free_cpus = iter(free_cpus)
+        self.cpu_placement = cpu_placement
         self.vm_name = vm_name
         self.vm_type = vm_type
+        self.group = group or vm_name
         self.interfaces = interfaces or []
+        self.clone_mode = clone_mode
+        self.from_golden = from_golden
+        self.from_pool = from_pool
+        self.juniper_installer = juniper_installer
+        self.device_profile = device_profile
+        self.day0 = day0
+        self.day0_iso = None
+        self._boot_nudge_interval = 30
 
         self._mac_addr_count = 0
+        self._vm_id = None
         self.juniper_cpus = []
+        self.progress = None  # the VmProgress of the creation flow
 
     def __enter__(self):
         self.define_networks()
@@ -93,26 +921,25 @@ class InteropEnv:  # TODO: move the images files to a more stable location, not
 
     def __call__(self, *args, **kwargs):
         """
-        the group-creation flow starts here (see __enter__ and __exit__ methods)
+        the group-creation flow starts here (see __enter__ and __exit__ methods). its phases are recorded in the
+        progress file of the VM, and a run of a VM whose previous run failed resumes after its completed phases
         """
+        self.progress = VmProgress(self.vm_name)
+        self.progress.start({'vm_type': self.vm_type, 'clone_mode': self.clone_mode, 'from_golden': self.from_golden,
+                             'device_profile': self.device_profile, 'day0': self.day0, 'from_pool': self.from_pool,
+                             'juniper_installer': self.juniper_installer}, self.cpu_placement)
         with self:
             pass
+        self.progress.remove()
 
+    @traced
     def define_networks(self):
         """
         define all of the virsh networks, as listed in the 'self.interfaces' dict
         """
-        networks = set()
-        for interface in self.interfaces:
-            if_type, if_name = interface.split(':', 1)
-            if if_type == 'net':
-                networks.add(if_name)
-        existing_networks = send_host_cmd('virsh net-list --all --name').splitlines()
-        for network in networks:
-            if network not in existing_networks:
-                print(f"creating virsh network {network}")
-                self.create_virsh_network(network)
+        define_virsh_networks(self.interfaces)
 
+    @traced
     def wait_for_juniper_boot_and_set_base_config(self):
         """
         wait for all juniper devices to boot and set:
@@ -120,92 +947,308 @@ class InteropEnv:  # TODO: move the images files to a more stable location, not
         - bind bridge interfaces using the `vmx.sh` script
         - bind CPUs to the VCP and VFP vms
         """
-        child = self.wait_for_juniper_boot()
-        sleep(20)  # if configuring too fast, configuration will not be applied
+        child = None
+        if not (self.progress and self.progress.is_done('set_juniper_base_config')):
+            child = self.wait_for_juniper_boot()
+            vm_sleep(20)  # if configuring too fast, configuration will not be applied
         self.set_juniper_base_config(child, self.mgmt_ip)
         self._install_juniper_license(child)
+        if self.juniper_installer == 'native':
+            return  # the interfaces and the CPU pinning are part of the domain definitions
         if self.interfaces:
             self.bind_juniper_dev_interfaces()
         self.set_juniper_cpu_binding()
 
+    @traced
+    @checkpointed
     def wait_for_cisco_boot_and_set_base_config(self):
         """
-        wait for all cisco devices to boot and paste basic CLI config for management
+        wait for all cisco devices to boot and paste basic CLI config for management.
+        with a day-0 config drive the config was applied at boot, and it is only pasted if it wasn't
         """
-        self.wait_for_cisco_boot()
+        child = self.wait_for_cisco_boot()
+        if self.day0_iso:
+            if self.is_cisco_day0_applied(child):
+                print(f"day-0 configuration was applied to cisco vm '{self.vm_name}' at boot")
+                return
+            print(f"WARNING: day-0 configuration was not applied to cisco vm '{self.vm_name}', pasting it")
         self.set_cisco_base_config(self.mgmt_ip)
 
+    @traced
     def config_and_start_juniper_vm(self):
         """
         - extract juniper image
-        - build the vm configuration files and install using `vmx.sh` script
-        - update the VFP vm interfaces binding to make them persistent after host reboot
+        - 'native' installer: define and start the vcp and vfp VMs directly, see 'install_juniper_vm_native'
+        - 'vmx.sh' installer: build the vm configuration files and install using `vmx.sh` script
         """
-        self.juniper_cpus = [next(self.free_cpus) for _ in range(4)]
+        self.juniper_cpus = self.cpu_placement.cpus
         cloned_image = self.clone_juniper_vm()
+        if self.juniper_installer == 'native':
+            self.install_juniper_vm_native(cloned_image)
+            return
         self.configure_juniper_vm(cloned_image, self.juniper_cpus)
-
-        retries = 3
-        for i in range(retries):  # installation randomly fails, so try again
-            if self.install_juniper_vm():
-                break
-            if i < retries:
-                print(f"installation failed for juniper vm '{self.vm_name}', retrying in 5 seconds")
-                sleep(5)
-            else:
-                exit(f"ERROR: failed to install juniper vm '{self.vm_name}' after {retries} retries")
+        self.install_juniper_vm()
         # self.update_vfp_interfaces(self.vm_name)
 
+    @traced
     def config_and_start_cisco_vm(self):
         """
         - copy cisco image file
         - generate an XML file and define it using `virsh define`
         - start VM
+        a VM that is restored from the warm pool or the golden state printed its login prompt before the restore, so
+        the boot wait asks for the prompt right away. this is set here and not in the restore phases, which a resumed
+        run skips
         """
+        if self.from_pool:
+            if self.claim_cisco_vm_from_pool():
+                self._boot_nudge_interval = 2
+                return
+            print(f"WARNING: no idle cisco vm in the warm pool, creating vm '{self.vm_name}'")
+        if self.from_golden:
+            if get_cisco_golden():
+                self.restore_cisco_vm_from_golden()
+                self._boot_nudge_interval = 2
+                return
+            print(f"WARNING: no valid golden state found for cisco, cold booting vm '{self.vm_name}'")
         cloned_image = self.clone_cisco_vm()
-        self.configure_cisco_vm(cloned_image, [next(self.free_cpus) for _ in range(2)])
+        if self.day0 == 'config-drive':
+            self.day0_iso = self.create_cisco_day0_iso()
+        self.configure_cisco_vm(cloned_image, self.cpu_placement.cpus, self.cpu_placement.emulator_cpus,
+                                self.cpu_placement.node)
         self.start_cisco_vm()
 
-    def fetch_images(self):
+    @traced
+    def build_cisco_golden(self):
         """
-        fetch cisco and juniper images from the remote host if they are not found locally.
+        build the cisco golden state: boot a VM on an overlay of the base image until it is ready for configuration,
+        then save its memory state and freeze its disk. the golden VM has no interfaces, they are attached to each
+        restored VM, so restored VMs never share mac addresses.
         """
-        if self.vm_type == 'cisco':
-            self.get_cisco_image()
-        if self.vm_type == 'juniper':
-            self.get_juniper_image()
+        golden = get_cisco_golden_paths()
+        os.makedirs(GOLDEN_DIR, exist_ok=True)
+        for path in (golden['disk'], golden['state'], golden['meta']):
+            if os.path.exists(path):
+                os.remove(path)
+        print(f"building cisco golden state in '{GOLDEN_DIR}'")
+        create_overlay_image(self.CISCO_IMAGE['local_path'], golden['disk'])
+        xml = self.get_cisco_vm_xml(golden['disk'], self.cpu_placement.cpus, self.cpu_placement.emulator_cpus,
+                                    self.cpu_placement.node, with_interfaces=False)
+        backend = get_virt_backend()
+        backend.define_domain(xml)
+        self.start_cisco_vm()
+        self.wait_for_cisco_boot()
+        child = self.enter_vm_console()
+        child.sendline('end')
+        print(f"saving the state of golden vm '{self.vm_name}' to '{golden['state']}'")
+        backend.save_domain(self.vm_name, golden['state'])
+        backend.undefine_domain(self.vm_name)
+        os.chmod(golden['disk'], 0o444)  # restored VMs use it as their backing image, it must never change
+        with open(golden['meta'], 'w') as f:
+            json.dump({'base_image': self.CISCO_IMAGE['local_path'],
+                       'device_profile': self.device_profile,
+                       'base_size': os.path.getsize(self.CISCO_IMAGE['local_path']),
+                       'created': time()}, f, indent=2)
+        print("cisco golden state is ready")
 
-    @property
-    def mac_addr_count(self):
+    @checkpointed
+    def restore_cisco_vm_from_golden(self):
         """
-        make sure mac addresses are unique within the group
+        start the VM from the golden state instead of cold booting it:
+        - create an overlay backed by the golden disk
+        - restore the golden memory state with this VM's name, disk and CPU pinning
+        - attach the VM interfaces and make the VM persistent
+        the VM is then at the login prompt within seconds, and only needs its base config. it is always pasted on
+        the console, since the restored VM has already booted past reading a day-0 config drive.
         """
-        self._mac_addr_count += 1
-        return str(self._mac_addr_count).zfill(2)
+        golden = get_cisco_golden_paths()
+        with open(golden['meta']) as f:
+            golden_profile = json.load(f).get('device_profile', 'legacy')
+        if golden_profile != self.device_profile:
+            print(f"WARNING: the golden state was built with device profile '{golden_profile}', using it for vm "
+                  f"'{self.vm_name}' instead of '{self.device_profile}'")
+            self.device_profile = golden_profile
+        new_path = os.path.join(self.CISCO_IMAGE['local_dir'], self.vm_name + ".qcow2")
+        print(f"restoring cisco vm '{self.vm_name}' from golden state '{golden['state']}'")
+        create_overlay_image(golden['disk'], new_path)
+        self.restore_cisco_vm(golden['state'], new_path)
 
-    def clone_juniper_vm(self):
+    @traced
+    def restore_cisco_vm(self, state_path, disk_path):
         """
-        extract the image tar to a folder with the VM name.
+        restore a saved cisco VM state (without interfaces) as this VM: the saved XML is updated with this VM's name,
+        disk and CPU pinning, and the VM interfaces are attached once it runs
         """
-        local_dir = self.JUNIPER_IMAGE['local_dir']
-        new_path = os.path.join(local_dir, self.vm_name)
-        print(f"cloning juniper vm to local folder '{new_path}'")
-        send_host_cmd(f"mkdir {new_path}")
-        send_host_cmd(f"tar -xvf {self.JUNIPER_IMAGE['local_path']} -C {new_path}", timeout=60 * 7)
-        # mv files from the internal dir 'vmx' to the main folder
-        send_host_cmd(f"mv {os.path.join(new_path, 'vmx', '*')} {new_path}")
-        send_host_cmd(f"rm -rf {os.path.join(new_path, 'vmx')}")
-        return new_path
+        backend = get_virt_backend()
+        interfaces_xml = self.get_cisco_interfaces_xml(self.vm_id)
+        xml = update_saved_domain_xml(backend.get_saved_state_xml(state_path), self.vm_name, disk_path,
+                                      self.cpu_placement,
+                                      self.get_metadata_xml(disk=[disk_path], device_profile=self.device_profile))
+        backend.restore_domain(state_path, xml)
+        backend.define_domain(xml)
+        for interface_xml in interfaces_xml:
+            backend.attach_device(self.vm_name, interface_xml)
+        backend.set_autostart(self.vm_name)
 
-    def clone_cisco_vm(self):
+    @traced
+    def start_cisco_pool_vm(self):
         """
-        copy the base image file and set the vm name as the file name.
+        boot an idle cisco VM for the warm pool. like the golden VM it has no interfaces, and it waits at the config
+        prompt until it is claimed
         """
-        local_path = self.CISCO_IMAGE['local_path']
-        new_path = os.path.join(self.CISCO_IMAGE['local_dir'], self.vm_name + ".qcow2")
-        print(f"cloning cisco vm from '{local_path}' to '{new_path}'")
-        send_host_cmd(f"cp {local_path} {new_path}", timeout=60 * 3)
-        return new_path
+        disk_path = os.path.join(self.CISCO_IMAGE['local_dir'], self.vm_name + ".qcow2")
+        create_overlay_image(self.CISCO_IMAGE['local_path'], disk_path)
+        xml = self.get_cisco_vm_xml(disk_path, self.cpu_placement.cpus, self.cpu_placement.emulator_cpus,
+                                    self.cpu_placement.node, with_interfaces=False)
+        get_virt_backend().define_domain(xml)
+        self.start_cisco_vm()
+        child = self.wait_for_cisco_boot()
+        child.sendline('end')
+
+    @traced
+    @checkpointed
+    def claim_cisco_vm_from_pool(self):
+        """
+        take an idle VM out of the warm pool and restore it as this VM, with its disk renamed after this VM.
+
+        :return: False if the pool has no idle cisco VM
+        """
+        pool_vm = WarmPool().claim('cisco')
+        if not pool_vm:
+            return False
+        if pool_vm['device_profile'] != self.device_profile:
+            print(f"WARNING: the warm pool vms use device profile '{pool_vm['device_profile']}', using it for vm "
+                  f"'{self.vm_name}' instead of '{self.device_profile}'")
+            self.device_profile = pool_vm['device_profile']
+        new_path = os.path.join(self.CISCO_IMAGE['local_dir'], self.vm_name + ".qcow2")
+        print(f"claiming warm pool vm '{pool_vm['name']}' as cisco vm '{self.vm_name}'")
+        os.rename(pool_vm['disk'], new_path)
+        self.restore_cisco_vm(pool_vm['state'], new_path)
+        os.remove(pool_vm['state'])
+        return True
+
+    @traced
+    def fetch_images(self):
+        """
+        fetch cisco and juniper images from the remote host if they are not found locally.
+        """
+        if self.vm_type == 'cisco':
+            self.get_cisco_image()
+        if self.vm_type == 'juniper':
+            self.get_juniper_image()
+
+    @property
+    def vm_id(self):
+        """
+        the id of the VM on the host (01-99) from the resource ledger, used in its MAC addresses and console ports
+        """
+        if self._vm_id is None:
+            with ResourceLedger() as ledger:
+                self._vm_id = str(ledger.get_vm_id(self.vm_name)).zfill(2)
+        return self._vm_id
+
+    def get_metadata_xml(self, **entries):
+        """
+        build the <vax:vm> metadata of the VM domains, which is the host index of the VMs (see 'get_vm_index'): the
+        group and name of the VM, its allocated resources, and the extra entries, such as the disks, folders and
+        bridges that are deleted with it. list entries are repeated elements
+        """
+        entries = dict({'group': self.group, 'name': self.vm_name, 'type': self.vm_type,
+                        'cpus': ','.join(str(cpu) for cpu in self.cpu_placement.cpus),
+                        'kept_free': ','.join(str(cpu) for cpu in self.cpu_placement.kept_free) or None,
+                        'vm_id': self._vm_id},
+                       **entries)
+        elements = []
+        for key, values in entries.items():
+            for value in values if isinstance(values, list) else [values]:
+                if value is not None:
+                    elements.append(f"\n          <vax:{key}>{value}</vax:{key}>")
+        return f"<vax:vm xmlns:vax='{VM_METADATA_NS}'>{''.join(elements)}\n        </vax:vm>"
+
+    @property
+    def mac_addr_count(self):
+        """
+        make sure mac addresses are unique within the group
+        """
+        self._mac_addr_count += 1
+        return str(self._mac_addr_count).zfill(2)
+
+    @traced
+    @checkpointed
+    def clone_juniper_vm(self):
+        """
+        build the vm folder from the extracted bundle cache.
+        - scripts and other read-only files are hardlinked from the cache
+        - the 'config' folder is copied, since `vmx.sh` and this script write to it
+        - qcow2 images are created as overlays backed by the cached images (or copied in 'copy' clone mode), other
+          images are written by the VMs so they are copied using reflink when the filesystem supports it
+        """
+        cache_dir = self.get_juniper_bundle_cache()
+        new_path = os.path.join(self.JUNIPER_IMAGE['local_dir'], self.vm_name)
+        if os.path.exists(new_path):
+            # only the folder of a failed run of this VM is replaced, never the folder of an existing VM
+            if not (self.progress and self.progress.resumed):
+                exit(f"ERROR: the local folder '{new_path}' already exists, delete vm '{self.vm_name}' first")
+            print(f"removing the local folder '{new_path}' of a previous run")
+            send_host_cmd(f"rm -rf {new_path}")
+        print(f"cloning juniper vm from cache '{cache_dir}' to local folder '{new_path}'")
+        send_host_cmd(f"cp -al {cache_dir} {new_path}")
+        for private_dir in ('config', 'images'):
+            send_host_cmd(f"rm -rf {os.path.join(new_path, private_dir)}")
+        send_host_cmd(f"cp -a --reflink=auto {os.path.join(cache_dir, 'config')} {os.path.join(new_path, 'config')}")
+        os.mkdir(os.path.join(new_path, 'images'))
+        clone_cmds = []
+        for image in os.listdir(os.path.join(cache_dir, 'images')):
+            cached_image = os.path.join(cache_dir, 'images', image)
+            new_image = os.path.join(new_path, 'images', image)
+            if self.clone_mode == 'overlay' and is_qcow2_image(cached_image):
+                clone_cmds.append(get_overlay_image_cmd(cached_image, new_image))
+            else:
+                clone_cmds.append(f"cp --reflink=auto {cached_image} {new_image}")
+        send_host_cmds(clone_cmds, timeout=60 * 3)
+        return new_path
+
+    @traced
+    def get_juniper_bundle_cache(self):
+        """
+        get the folder of the extracted juniper bundle, extracting it only if this version was not cached yet.
+        extraction is done to a temporary folder which is renamed when complete, and is locked so that concurrent
+        runs wait for a single extraction instead of racing.
+        """
+        cache_dir = self.JUNIPER_IMAGE['cache_dir']
+        os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+        with open(f"{cache_dir}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.isdir(cache_dir):
+                return cache_dir
+            tmp_dir = f"{cache_dir}.tmp"
+            print(f"extracting juniper bundle '{self.JUNIPER_IMAGE['local_path']}' to cache '{cache_dir}'")
+            send_host_cmd(f"rm -rf {tmp_dir}")
+            os.mkdir(tmp_dir)
+            send_host_cmd(f"tar -xvf {self.JUNIPER_IMAGE['local_path']} -C {tmp_dir}", timeout=60 * 7)
+            # the bundle files are in an internal dir named 'vmx'
+            os.rename(os.path.join(tmp_dir, 'vmx'), cache_dir)
+            os.rmdir(tmp_dir)
+        return cache_dir
+
+    @traced
+    @checkpointed
+    def clone_cisco_vm(self):
+        """
+        clone the base image to a file named after the vm.
+        - 'overlay' mode: create a thin qcow2 overlay that uses the pristine base image as its backing file, so only the
+          blocks written by the vm take disk space. the base image must never be modified or deleted afterwards.
+        - 'copy' mode: full copy of the base image.
+        """
+        local_path = self.CISCO_IMAGE['local_path']
+        new_path = os.path.join(self.CISCO_IMAGE['local_dir'], self.vm_name + ".qcow2")
+        if self.clone_mode == 'overlay':
+            print(f"creating cisco overlay image '{new_path}' backed by '{local_path}'")
+            create_overlay_image(local_path, new_path)
+            return new_path
+        print(f"cloning cisco vm from '{local_path}' to '{new_path}'")
+        send_host_cmd(f"cp {local_path} {new_path}", timeout=60 * 3)
+        return new_path
 
     def get_cisco_image(self):
         self.get_image(self.CISCO_IMAGE)
@@ -213,30 +1256,24 @@ class InteropEnv:  # TODO: move the images files to a more stable location, not
     def get_juniper_image(self):
         self.get_image(self.JUNIPER_IMAGE)
 
+    @traced
     def get_image(self, image_info):
         """
-        use 'rsync' to fetch a cisco/juniper image from a remote location, if the image is not found locally.
+        fetch a cisco/juniper image to its local path through the image store, if a verified copy is not found locally.
+        with --image_server, the image is fetched from '<image server>/<local name>' of the run.
         """
-        src = image_info['src']
-        user = image_info['user']
-        passw = image_info['pass']
-        local_path = image_info['local_path']
-        copy_cmd = (f"rsync -e 'ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no' {user}@{src} "
-                    f"{local_path}")
-        if os.path.exists(local_path):
-            print(f"using image at local path '{local_path}' for vm creation")
-            return
-        print(f"copying image '{src}' to local path '{local_path}'")
-        child = pexpect.spawn(copy_cmd)
-        child.expect("password:")
-        child.sendline(passw)
-        child.wait()
+        args = _run_args.get(ThreadOutput.current())
+        if args and args.image_server:
+            image_info = dict(image_info, url=f"{args.image_server.rstrip('/')}/{image_info['local_name']}")
+        get_image_store().fetch(image_info, args.image_store_quota_gb if args else IMAGE_STORE_QUOTA_GB)
 
+    @traced
+    @checkpointed
     def configure_juniper_vm(self, image_path, cpus, traffic_interfaces_count=2):
         """
         generate the `vmx.conf` and the `vmx-junosdev.conf` files that are needed for the VM installation
         """
-        vm_id = str(cpus[0]).zfill(2)
+        vm_id = self.vm_id
         traffic_interfaces = '\n'.join([f"""   - interface            : ge-0/0/{i}
      mac-address          : "02:06:0A:0E:{vm_id}:{self.mac_addr_count}"
      description          : "ge-0/0/{i} interface"
@@ -256,8 +1293,8 @@ HOST:
     identifier                : {self.vm_name[-6:]}   # Maximum 6 characters
     host-management-interface : {self.host_mgmt_br}
     routing-engine-image      : "{image_path}/images/{self.JUNIPER_IMAGE['re_image_name']}"
-    routing-engine-hdd        : "{image_path}/images/vmxhdd.img"
-    forwarding-engine-image   : "{image_path}/images/vFPC-20201209.img"
+    routing-engine-hdd        : "{image_path}/images/{self.JUNIPER_IMAGE['re_hdd_name']}"
+    forwarding-engine-image   : "{image_path}/images/{self.JUNIPER_IMAGE['fpc_image_name']}"
 
 ---
 #External bridge configuration
@@ -316,37 +1353,187 @@ JUNOS_DEVICES:
         with open(conf_path, 'w') as f:
             f.write(junosdev_format)
 
-    def configure_cisco_vm(self, image_path, cpus, traffic_interfaces_count=2):
+    @traced
+    @checkpointed
+    def configure_cisco_vm(self, image_path, cpus, emulator_cpus=None, numa_node=None, traffic_interfaces_count=2):
         """
         build cisco VM XML file and define it using `virsh define` and configure it to auto-start on next host boot.
         """
-        cpus = [str(_cpu) for _cpu in cpus]
-        vm_id = str(cpus[0]).zfill(2)
-        traffic_interfaces = ""
+        xml_format = self.get_cisco_vm_xml(image_path, cpus, emulator_cpus, numa_node)
+
+        print(f"defining xml as vm with name '{self.vm_name}'")
+        get_virt_backend().define_domain(xml_format)
+
+        print(f"configuring '{self.vm_name}' to autostart on server boot")
+        get_virt_backend().set_autostart(self.vm_name)
+
+    def get_cisco_interfaces_xml(self, vm_id):
+        """
+        get the XML of each of the cisco VM interfaces: the management interfaces on the host management bridge,
+        followed by the traffic interfaces
+        """
+        profile = self.DEVICE_PROFILES[self.device_profile]
+        pci = PciSlotAllocator()
+        if profile['disk_bus'] != 'ide':
+            pci.address()  # the storage device always gets the first slot, see 'get_cisco_disk_xml'
+        driver = ""
+        if profile['multiqueue']:
+            driver = f"\n          <driver name='vhost' queues='{len(self.cpu_placement.cpus)}'/>"
+        interfaces = []
+        for _ in range(3):
+            interfaces.append(f"""<interface type='bridge'>
+          <mac address='52:54:00:90:{vm_id}:{self.mac_addr_count}'/>
+          <source bridge='{self.host_mgmt_br}'/>
+          <model type='{profile['nic_model']}'/>{driver}
+          <alias name='net0'/>
+          {pci.address()}
+        </interface>""")
         for host_interface in self.interfaces:
             if_type, if_name = host_interface.split(':', 1)
             xml_if_type = 'bridge' if if_type == 'br' else 'network'
-            traffic_interfaces += f"""    <interface type='{xml_if_type}'>
+            interfaces.append(f"""<interface type='{xml_if_type}'>
           <mac address='52:54:00:03:{vm_id}:{self.mac_addr_count}'/>
           <source {xml_if_type}='{if_name}'/>
-          <model type='e1000'/>
-        </interface>\n"""
+          <model type='{profile['nic_model']}'/>{driver}
+          {pci.address()}
+        </interface>""")
+        return interfaces
+
+    def get_cisco_disk_xml(self, image_path):
+        """
+        get the XML of the cisco VM disk and its controller, for the bus of the VM device profile
+        """
+        profile = self.DEVICE_PROFILES[self.device_profile]
+        pci = PciSlotAllocator()
+        driver_options = ""
+        if profile['disk_cache']:
+            driver_options += f" cache='{profile['disk_cache']}' io='{profile['disk_io']}'"
+        if profile['iothreads'] and profile['disk_bus'] == 'virtio':
+            driver_options += " iothread='1'"
+        driver = f"<driver name='qemu' type='qcow2'{driver_options}/>"
+        if profile['disk_bus'] == 'virtio':
+            return f"""<disk type='file' device='disk'>
+          {driver}
+          <source file='{image_path}'/>
+          <target dev='vda' bus='virtio'/>
+          {pci.address()}
+        </disk>{self.get_cisco_day0_xml()}"""
+        controller = self.get_cisco_day0_xml()
+        target = "<target dev='hda' bus='ide'/>"
+        if profile['disk_bus'] == 'scsi':
+            iothread = " iothread='1'" if profile['iothreads'] else ""
+            controller += f"""
+        <controller type='scsi' index='0' model='virtio-scsi'>
+          <driver queues='{len(self.cpu_placement.cpus)}'{iothread}/>
+          {pci.address()}
+        </controller>"""
+            target = "<target dev='sda' bus='scsi'/>"
+        return f"""<disk type='file' device='disk'>
+          {driver}
+          <source file='{image_path}'/>
+          {target}
+          <address type='drive' controller='0' bus='0' target='0' unit='0'/>
+        </disk>{controller}"""
+
+    def get_cisco_day0_xml(self):
+        """
+        get the XML of the day-0 config drive cdrom, on the second channel of the IDE controller
+        """
+        if not self.day0_iso:
+            return ""
+        return f"""
+        <disk type='file' device='cdrom'>
+          <driver name='qemu' type='raw'/>
+          <source file='{self.day0_iso}'/>
+          <target dev='hdc' bus='ide'/>
+          <readonly/>
+          <address type='drive' controller='0' bus='1' target='0' unit='0'/>
+        </disk>"""
+
+    @traced
+    @checkpointed
+    def create_cisco_day0_iso(self):
+        """
+        render the base config to a config drive ISO (labelled 'config-1' with an 'iosxr_config.txt' file), which
+        IOS-XR applies on its first boot (CVAC).
+
+        :return: the ISO path, or None if the ISO can't be built and the config must be pasted on the console
+        """
+        if not shutil.which('genisoimage'):
+            print(f"WARNING: 'genisoimage' is not installed (see --install_prereq), the day-0 configuration of vm "
+                  f"'{self.vm_name}' will be pasted on the console")
+            return None
+        iso_path = os.path.join(self.CISCO_IMAGE['local_dir'], f"{self.vm_name}-day0.iso")
+        config_dir = f"{iso_path}.d"
+        os.makedirs(config_dir, exist_ok=True)
+        # the base config is indented for pasting, IOS-XR reads the config file as-is
+        config_lines = [line[8:] if line.startswith(' ' * 8) else line
+                        for line in self.get_cisco_base_config(self.mgmt_ip).splitlines()]
+        with open(os.path.join(config_dir, 'iosxr_config.txt'), 'w') as f:
+            f.write('\n'.join(config_lines) + '\nend\n')
+        print(f"creating day-0 config drive '{iso_path}' for cisco vm '{self.vm_name}'")
+        send_host_cmd(f"genisoimage -quiet -output {iso_path} -l -V config-1 --relaxed-filenames --iso-level 2 "
+                      f"{os.path.join(config_dir, 'iosxr_config.txt')}")
+        shutil.rmtree(config_dir)
+        return iso_path
+
+    def is_cisco_day0_applied(self, child):
+        """
+        the day-0 config was applied when the console prompt shows the VM hostname
+        """
+        child.sendline('')
+        try:
+            return child.expect([rf'{re.escape(self.vm_name)}\(config[^)]*\)#', r'\(config[^)]*\)#'], timeout=10) == 0
+        except pexpect.exceptions.ExceptionPexpect:
+            return False
+
+    def get_cisco_vm_xml(self, image_path, cpus, emulator_cpus=None, numa_node=None, with_interfaces=True):
+        """
+        build the cisco VM XML.
+        the vCPUs and the emulator thread are pinned to the given CPUs, and memory is placed on their NUMA node.
+        """
+        cpus = [str(_cpu) for _cpu in cpus]
+        emulator_cpus = [str(_cpu) for _cpu in emulator_cpus or cpus]
+        all_cpus = cpus + [cpu for cpu in emulator_cpus if cpu not in cpus]
+        # the memory is bound strictly to the node when its hugepages were planned there, see 'HugepagePlanner'
+        hugepage_kb = self.cpu_placement.hugepage_kb
+        numatune = ""
+        if numa_node is not None:
+            numatune = f"""
+      <numatune>
+        <memory mode='{'strict' if hugepage_kb else 'preferred'}' nodeset='{numa_node}'/>
+      </numatune>"""
+        hugepages = "<hugepages/>"
+        if hugepage_kb:
+            hugepages = f"""<hugepages>
+          <page size='{hugepage_kb}' unit='KiB'/>
+        </hugepages>"""
+        interfaces = ""
+        if with_interfaces:
+            interfaces = '\n        '.join(self.get_cisco_interfaces_xml(self.vm_id))
 
         vcpus = '\n'.join([f"        <vcpupin vcpu='{i}' cpuset='{cpu}'/>" for i, cpu in enumerate(cpus)])
+        iothreads = iothreadpins = ""
+        if self.DEVICE_PROFILES[self.device_profile]['iothreads']:
+            iothreads = f"\n      <iothreads>{self.DEVICE_PROFILES[self.device_profile]['iothreads']}</iothreads>"
+            iothreadpins = f"\n        <iothreadpin iothread='1' cpuset='{','.join(emulator_cpus)}'/>"
         vm_uuid = uuid4()
         xml_format = f"""<domain type='kvm'>
       <name>{self.vm_name}</name>
       <uuid>{vm_uuid}</uuid>
+      <metadata>
+        {self.get_metadata_xml(disk=[image_path, self.day0_iso], device_profile=self.device_profile)}
+      </metadata>
       <memory unit='KiB'>{self.CISCO_IMAGE['memory_kb']}</memory>
       <currentMemory unit='KiB'>{self.CISCO_IMAGE['memory_kb']}</currentMemory>
       <memoryBacking>
-        <hugepages/>
+        {hugepages}
       </memoryBacking>
-      <vcpu placement='static' cpuset='{','.join(cpus)}'>{len(cpus)}</vcpu>
+      <vcpu placement='static' cpuset='{','.join(all_cpus)}'>{len(cpus)}</vcpu>{iothreads}
       <cputune>
 {vcpus}
-        <emulatorpin cpuset='{','.join(cpus)}'/>
-      </cputune>
+        <emulatorpin cpuset='{','.join(emulator_cpus)}'/>{iothreadpins}
+      </cputune>{numatune}
       <resource>
         <partition>/machine</partition>
       </resource>
@@ -376,12 +1563,7 @@ JUNOS_DEVICES:
       </pm>
       <devices>
         <emulator>/usr/bin/kvm-spice</emulator>
-        <disk type='file' device='disk'>
-          <driver name='qemu' type='qcow2'/>
-          <source file='{image_path}'/>
-          <target dev='hda' bus='ide'/>
-          <address type='drive' controller='0' bus='0' target='0' unit='0'/>
-        </disk>
+        {self.get_cisco_disk_xml(image_path)}
         <controller type='usb' index='0' model='ich9-ehci1'>
           <address type='pci' domain='0x0000' bus='0x00' slot='0x0b' function='0x7'/>
         </controller>
@@ -404,25 +1586,7 @@ JUNOS_DEVICES:
         <controller type='virtio-serial' index='0'>
           <address type='pci' domain='0x0000' bus='0x00' slot='0x0a' function='0x0'/>
         </controller>
-        <interface type='bridge'>
-          <mac address='52:54:00:90:{vm_id}:{self.mac_addr_count}'/>
-          <source bridge='{self.host_mgmt_br}'/>
-          <model type='e1000'/>
-          <alias name='net0'/>
-        </interface>
-        <interface type='bridge'>
-          <mac address='52:54:00:90:{vm_id}:{self.mac_addr_count}'/>
-          <source bridge='{self.host_mgmt_br}'/>
-          <model type='e1000'/>
-          <alias name='net0'/>
-        </interface>
-        <interface type='bridge'>
-          <mac address='52:54:00:90:{vm_id}:{self.mac_addr_count}'/>
-          <source bridge='{self.host_mgmt_br}'/>
-          <model type='e1000'/>
-          <alias name='net0'/>
-        </interface>
-    {traffic_interfaces}
+        {interfaces}
         <serial type='pty'>
           <target port='0'/>
         </serial>
@@ -439,36 +1603,174 @@ JUNOS_DEVICES:
       </devices>
     </domain>
     """
-        xml_path = f'/tmp/cisco_xml_{vm_uuid}'
+        return xml_format
 
-        print(f"writing virsh-xml to '{xml_path}'")
-        with open(xml_path, 'w') as f:
-            f.write(xml_format)
+    @traced
+    @checkpointed
+    def start_cisco_vm(self):
+        backend = get_virt_backend()
+        if backend.is_domain_active(self.vm_name):
+            print(f"cisco vm '{self.vm_name}' is already running")
+            return
+        print(f"starting cisco vm '{self.vm_name}'")
+        backend.start_domain(self.vm_name)
 
-        print(f"defining xml as vm with name '{self.vm_name}'")
-        send_host_cmd(f"virsh define {xml_path}")
+    def get_juniper_vm_xmls(self, image_path):
+        """
+        build the XML of the vcp (routing engine) and vfp (forwarding plane) VMs of a vMX, as `vmx.sh` would:
+        - vcp: the junos image, the hdd and the metadata usb disk, fxp0 on the management bridge and em1 on the
+          internal bridge. junos identifies the vcp by its smbios product name
+        - vfp: the vFPC image, ext on the management bridge, int on the internal bridge, then the ge-0/0/<n> traffic
+          interfaces in order
+        - the serial consoles are telnet ports 86<vm id> (vcp) and 87<vm id> (vfp), as in `vmx.conf`
+        - the vcp vCPU and the vfp vCPUs are pinned to the CPU placement, the emulator threads of both VMs to the vcp
+          CPU, and the memory is placed on the NUMA node of the CPUs
 
-        print(f"configuring '{self.vm_name}' to autostart on server boot")
-        send_host_cmd(f"virsh autostart {self.vm_name}")
+        :return: tuple of (vcp XML, vfp XML)
+        """
+        vm_id = self.vm_id
+        images_dir = os.path.join(image_path, 'images')
+        internal_br = get_juniper_internal_bridge(self.vm_name)
+        emulator_cpus = ','.join(str(cpu) for cpu in self.cpu_placement.emulator_cpus)
+        numatune = ""
+        if self.cpu_placement.node is not None:
+            numatune = f"""
+      <numatune>
+        <memory mode='preferred' nodeset='{self.cpu_placement.node}'/>
+      </numatune>"""
 
-    def start_cisco_vm(self):
-        print(f"starting cisco vm '{self.vm_name}'")
-        send_host_cmd(f"virsh start {self.vm_name}")
+        def _disk(image_name, target, bus='virtio'):
+            path = os.path.join(images_dir, image_name)
+            return f"""<disk type='file' device='disk'>
+          <driver name='qemu' type='{'qcow2' if is_qcow2_image(path) else 'raw'}' cache='directsync'/>
+          <source file='{path}'/>
+          <target dev='{target}' bus='{bus}'/>
+        </disk>"""
+
+        def _interface(if_type, source, mac):
+            return f"""<interface type='{if_type}'>
+          <mac address='{mac}'/>
+          <source {if_type}='{source}'/>
+          <model type='virtio'/>
+        </interface>"""
+
+        def _domain(name, memory_mb, cpus, cpu_mode, sysinfo, disks, interfaces, console_port):
+            vcpupins = '\n'.join(f"        <vcpupin vcpu='{i}' cpuset='{cpu}'/>" for i, cpu in enumerate(cpus))
+            all_cpus = ','.join(str(cpu) for cpu in sorted(set(cpus) | set(self.cpu_placement.emulator_cpus)))
+            devices = '\n        '.join(disks + interfaces)
+            return f"""<domain type='kvm'>
+      <name>{name}</name>
+      <uuid>{uuid4()}</uuid>
+      <metadata>
+        {self.get_metadata_xml(dir=image_path, bridge=internal_br, installer='native')}
+      </metadata>
+      <memory unit='MiB'>{memory_mb}</memory>
+      <currentMemory unit='MiB'>{memory_mb}</currentMemory>
+      <vcpu placement='static' cpuset='{all_cpus}'>{len(cpus)}</vcpu>
+      <cputune>
+{vcpupins}
+        <emulatorpin cpuset='{emulator_cpus}'/>
+      </cputune>{numatune}{sysinfo}
+      <os>
+        <type arch='x86_64' machine='pc'>hvm</type>
+        <boot dev='hd'/>{"<smbios mode='sysinfo'/>" if sysinfo else ""}
+      </os>
+      <features>
+        <acpi/>
+        <apic/>
+        <pae/>
+      </features>
+      <cpu mode='{cpu_mode}'/>
+      <clock offset='utc'/>
+      <on_poweroff>destroy</on_poweroff>
+      <on_reboot>restart</on_reboot>
+      <on_crash>restart</on_crash>
+      <devices>
+        <emulator>/usr/bin/kvm-spice</emulator>
+        {devices}
+        <controller type='usb' index='0'/>
+        <serial type='tcp'>
+          <source mode='bind' host='127.0.0.1' service='{console_port}'/>
+          <protocol type='telnet'/>
+          <target port='0'/>
+        </serial>
+        <memballoon model='none'/>
+      </devices>
+    </domain>
+    """
+
+        vcp_name = f"vcp-{self.vm_name}"
+        vcp_sysinfo = f"""
+      <sysinfo type='smbios'>
+        <bios>
+          <entry name='vendor'>Juniper</entry>
+        </bios>
+        <system>
+          <entry name='manufacturer'>VMX</entry>
+          <entry name='product'>VM-{vcp_name}-161-re-0</entry>
+          <entry name='version'>0.1.0</entry>
+        </system>
+      </sysinfo>"""
+        vcp_xml = _domain(
+            vcp_name, self.JUNIPER_IMAGE['vcp_memory_mb'], self.juniper_cpus[:1], 'host-model', vcp_sysinfo,
+            [_disk(self.JUNIPER_IMAGE['re_image_name'], 'vda'), _disk(self.JUNIPER_IMAGE['re_hdd_name'], 'vdb'),
+             _disk(self.JUNIPER_IMAGE['re_metadata_name'], 'sda', bus='usb')],
+            [_interface('bridge', self.host_mgmt_br, f"0A:00:DD:C0:DF:{vm_id}"),
+             _interface('bridge', internal_br, f"0A:00:DD:C0:DD:{vm_id}")],
+            f"86{vm_id}")
+        traffic_interfaces = []
+        for host_interface in self.interfaces:
+            if_type, if_name = host_interface.split(':', 1)
+            traffic_interfaces.append(_interface('bridge' if if_type == 'br' else 'network', if_name,
+                                                 f"02:06:0A:0E:{vm_id}:{self.mac_addr_count}"))
+        vfp_xml = _domain(
+            f"vfp-{self.vm_name}", self.JUNIPER_IMAGE['vfp_memory_mb'], self.juniper_cpus[1:], 'host-passthrough', "",
+            [_disk(self.JUNIPER_IMAGE['fpc_image_name'], 'vda')],
+            [_interface('bridge', self.host_mgmt_br, f"0A:00:DD:C0:DE:{vm_id}"),
+             _interface('bridge', internal_br, f"0A:00:DD:C0:DC:{vm_id}")] + traffic_interfaces,
+            f"87{vm_id}")
+        return vcp_xml, vfp_xml
+
+    @traced
+    @checkpointed
+    def install_juniper_vm_native(self, image_path):
+        """
+        install the vMX without `vmx.sh`: create the internal vcp-vfp bridge, then define, autostart and start both
+        VMs. nothing is host-wide, so parallel installations don't need the `vmx.sh` installation lock
+        """
+        add_host_bridges([get_juniper_internal_bridge(self.vm_name)])
+        backend = get_virt_backend()
+        print(f"installing and starting juniper vm '{self.vm_name}'")
+        for xml in self.get_juniper_vm_xmls(image_path):
+            backend.define_domain(xml)
+        for name in (f"vcp-{self.vm_name}", f"vfp-{self.vm_name}"):
+            backend.set_autostart(name)
+            if not backend.is_domain_active(name):
+                backend.start_domain(name)
 
-    def install_juniper_vm(self):
+    @traced
+    @checkpointed
+    def install_juniper_vm(self, retries=3):
         """
         use `vmx.sh` to install the vm and configure it to auto-start on next host boot.
+        the installation randomly fails, so it is tried again
         """
         local_path = os.path.join(self.JUNIPER_IMAGE['local_dir'], self.vm_name)
-        print(f"installing and starting juniper vm '{self.vm_name}'")
-        status = send_host_cmd("./vmx.sh --install", cwd=local_path, timeout=60 * 7, strict=False,
-                               return_status_code=True)
-        if status != 0:
-            return False
+        for i in range(retries):
+            print(f"installing and starting juniper vm '{self.vm_name}'")
+            with self._vmx_install_lock:
+                status = send_host_cmd("./vmx.sh --install", cwd=local_path, timeout=60 * 7, strict=False,
+                                       return_status_code=True)
+            if status == 0:
+                break
+            if i < retries - 1:
+                print(f"installation failed for juniper vm '{self.vm_name}', retrying in 5 seconds")
+                vm_sleep(5)
+            else:
+                exit(f"ERROR: failed to install juniper vm '{self.vm_name}' after {retries} retries")
         print(f"configuring vms of '{self.vm_name}' to autostart on server boot")
         for name in (f"vcp-{self.vm_name}", f"vfp-{self.vm_name}"):
-            send_host_cmd(f"virsh autostart {name}")
-        return True
+            get_virt_backend().set_autostart(name)
 
     # def update_vfp_interfaces(self, vm_name):
     #     """
@@ -492,106 +1794,92 @@ JUNOS_DEVICES:
     #             f.write(bridge_xml)
     #         send_host_cmd(f"virsh attach-device {fe_vm_name} {xml_path} --config")
 
-    def create_virsh_network(self, network_name):
+    @staticmethod
+    def create_virsh_network(network_name):
         """
-        create a virsh network using virsh net-define
+        create, start and autostart a virsh network
         """
         xml_content = f"""<network>
   <name>{network_name}</name>
 </network>"""
-        xml_file_path = '/tmp/net_xml.xml'
-        with open(xml_file_path, 'w') as f:
-            f.write(xml_content)
-        send_host_cmd(f"virsh net-define {xml_file_path}")
-        send_host_cmd(f"virsh net-start {network_name}")
-        send_host_cmd(f"virsh net-autostart {network_name}")
+        backend = get_virt_backend()
+        backend.define_network(xml_content)
+        backend.start_network(network_name)
+        backend.set_network_autostart(network_name)
 
-    def _is_cisco_booted(self, child):
+    def enter_vm_console(self):
         """
-        cisco is considered booted when:
-        - login is successful
-        - the CLI 'configure' command is sent without showing a warning
+        connect to the cisco VM console through the console broker, or with `virsh console` if it doesn't run
         """
-        child.sendline('\n\r')
-        child.expect(r'Username:|\[no\]|.*#', timeout=5)
-        if "Username:" in child.after.decode():
-            child.sendline("dn")
-            child.expect("Password:")
-            child.sendline("drive1234!")
-
-        child.sendline('configure')
-        child.expect(r'\[no\]|.*#')
-        if "(config" in child.after.decode():
-            return True
-        if "[no]" in child.after.decode():
-            child.sendline("no")
+        child = open_broker_console(self.vm_name)
+        if child:
+            return child
+        child = TracedSpawn(f'virsh console {self.vm_name} --force')
+        child.expect('Escape character is')
+        return child
 
-    def _is_juniper_booted(self, child):
+    def enter_juniper_console(self):
         """
-        juniper is considered booted when 'root' user is able to login and the message 'Auto image Upgrade will start'
-        appears
+        connect to the juniper VCP console through the console broker, or with `vmx.sh` if it doesn't run
         """
-        self._enter_juniper_config_mode(child=child)
-        return True
-
-    def enter_vm_console(self):
-        child = pexpect.spawn(f'virsh console {self.vm_name} --force')
-        child.expect('Escape character is')
+        child = open_broker_console(f"vcp-{self.vm_name}")
+        if child:
+            return child
+        if self.juniper_installer == 'native':
+            child = TracedSpawn(f"telnet 127.0.0.1 86{self.vm_id}")
+            child.expect('Escape character is')
+            return child
+        local_path = os.path.join(self.JUNIPER_IMAGE['local_dir'], self.vm_name)
+        child = TracedSpawn(f"bash -c './vmx.sh --console vcp {self.vm_name}'", cwd=local_path)
+        child.expect('to exit anytime')
         return child
 
+    @traced
     def wait_for_juniper_boot(self, timeout=60 * 15):
         """
-        wait until juniper VM is fully booted
+        wait until juniper VM is fully booted and the console is in 'config' mode
         """
         print(f"waiting for juniper vm '{self.vm_name}' to boot")
-        local_path = os.path.join(self.JUNIPER_IMAGE['local_dir'], self.vm_name)
-        child = pexpect.spawn(f"bash -c './vmx.sh --console vcp {self.vm_name}'", cwd=local_path)
-        child.expect('to exit anytime')
-        time_before = monotonic()
-        time_end = time_before + timeout
-        while monotonic() < time_end:
-            try:
-                if self._is_juniper_booted(child):
-                    return child
-            except pexpect.exceptions.ExceptionPexpect:
-                pass
-            sleep(1)
-        print(f"ERROR: juniper vm '{self.vm_name}' failed to boot within '{timeout}' seconds")
-        exit(1)
+        child = self.enter_juniper_console()
+        JuniperBootReader(child, self.vm_name, timeout).wait()
+        return child
 
+    @traced
     def wait_for_cisco_boot(self, timeout=60 * 15):
         """
-        wait until cisco VM is fully booted
+        wait until cisco VM is fully booted and the console is in 'config' mode
         """
         print(f"waiting for cisco vm '{self.vm_name}' to boot")
         child = self.enter_vm_console()
-        time_before = monotonic()
-        time_end = time_before + timeout
-        while monotonic() < time_end:
-            try:
-                if self._is_cisco_booted(child):
-                    return True
-            except pexpect.exceptions.ExceptionPexpect:
-                pass
-            sleep(1)
-        print(f"ERROR: cisco vm '{self.vm_name}' failed to boot within '{timeout}' seconds")
-        exit(1)
+        CiscoBootReader(child, self.vm_name, timeout, self._boot_nudge_interval).wait()
+        return child
 
+    @traced
+    @checkpointed
     def set_juniper_cpu_binding(self):
         """
         installation of juniper vm using the 'vmx.sh' script doesn't support binding specific CPUs to the vm,
         so this has to be done after the VM is already installed and running.
+        the emulator threads of both VMs are pinned to the VCP cpu, so the VFP cores are only used by its vCPUs.
+        memory placement on the NUMA node of the CPUs is saved to the VMs config, and applies from their next start.
         """
+        backend = get_virt_backend()
         re_cpu = self.juniper_cpus[0]
         fe_cpus = self.juniper_cpus[1:]
         re_vm_name = f"vcp-{self.vm_name}"
         fe_vm_name = f"vfp-{self.vm_name}"
         print(f"binding cpu '{re_cpu}' to vm '{re_vm_name}'")
-        send_host_cmd(f"virsh vcpupin {re_vm_name} --vcpu 0 {re_cpu} --config --live")
+        backend.pin_vcpu(re_vm_name, 0, re_cpu)
         print(f"binding cpus {fe_cpus} to vm '{fe_vm_name}'")
         for i, cpu in enumerate(fe_cpus):
-            send_host_cmd(f"virsh vcpupin {fe_vm_name} --vcpu {i} {cpu} --config --live")
+            backend.pin_vcpu(fe_vm_name, i, cpu)
+        for name in (re_vm_name, fe_vm_name):
+            backend.pin_emulator(name, self.cpu_placement.emulator_cpus)
+            if self.cpu_placement.node is not None:
+                backend.set_memory_node(name, self.cpu_placement.node)
 
+    @traced
+    @checkpointed
     def bind_juniper_dev_interfaces(self):
         """
         once the VM is installed, bridge interfaces must be bound to the VM using the vmx.sh script
@@ -600,6 +1888,8 @@ JUNOS_DEVICES:
         print(f"binding bridges to juniper vm '{self.vm_name}'")
         send_host_cmd("./vmx.sh --bind-dev", cwd=local_path)
 
+    @traced
+    @checkpointed
     def set_juniper_base_config(self, child, mgmt_ipv4_addr):
         """
         paste the basic CLI config, including hostname, SSH access, management IP and optional license.
@@ -617,14 +1907,17 @@ JUNOS_DEVICES:
                 child.sendline(f"show | display set | match {mgmt_ipv4_addr}")
                 child.expect(mgmt_ipv4_addr)
                 matches -= 1
-                sleep(7)
+                vm_sleep(7)
             except pexpect.exceptions.ExceptionPexpect:
                 if i == retries - 1:
                     raise
 
-    def _install_juniper_license(self, child):
+    @traced
+    @checkpointed
+    def _install_juniper_license(self, child=None):
         if self.JUNIPER_IMAGE['license']:
             print(f"installing license to juniper vm '{self.vm_name}'")
+            child = child or self._enter_juniper_config_mode()
             child.sendline("run request system license add terminal")
             child.expect("between each license key]")
             line_len = 100
@@ -642,6 +1935,7 @@ JUNOS_DEVICES:
                 child.sendline(line)
             child.expect(f"commit complete", timeout=60 * 3)
 
+    @traced
     def _set_juniper_base_config(self, mgmt_ipv4_addr, child):
         xml_mgmt_ip = f"set interfaces fxp0 unit 0 family inet address {mgmt_ipv4_addr}" if self.mgmt_ip else ""
         xml_mgmt_gw = f"set routing-options static route 0.0.0.0/0 next-hop {self.mgmt_gw}" if self.mgmt_gw else ""
@@ -669,8 +1963,7 @@ commit
         """
         if not child:
             assert self.vm_name, "'vm_name' not provided to '_enter_juniper_config_mode'"
-            local_path = os.path.join(self.JUNIPER_IMAGE['local_dir'], self.vm_name)
-            child = pexpect.spawn(f"bash -c './vmx.sh --console vcp {self.vm_name}'", cwd=local_path)
+            child = self.enter_juniper_console()
         child.sendline('\n\r')
         child.expect(r"login:|root@:~ #|root.*>|edit.*#")
         if 'login:' in child.after.decode():
@@ -684,154 +1977,1525 @@ commit
             child.expect("edit.*#")
         return child
 
-    def set_cisco_base_config(self, mgmt_ipv4_addr):
-        """
-        paste the basic CLI config, including hostname, SSH access and management IP
-        """
-        xml_if_ip = xml_mgmt_gw = ""
-        if self.mgmt_ip:
-            ip_interface = ipaddress.ip_interface(mgmt_ipv4_addr)
-            ip = ip_interface.ip
-            mask = ip_interface.netmask
-            xml_if_ip = f"ipv4 address {ip} {mask}"
+    def get_cisco_base_config(self, mgmt_ipv4_addr):
+        """
+        get the basic CLI config, including hostname, SSH access and management IP, followed by the user config
+        """
+        xml_if_ip = xml_mgmt_gw = ""
+        if self.mgmt_ip:
+            ip_interface = ipaddress.ip_interface(mgmt_ipv4_addr)
+            ip = ip_interface.ip
+            mask = ip_interface.netmask
+            xml_if_ip = f"ipv4 address {ip} {mask}"
+
+        if self.mgmt_gw:
+            xml_mgmt_gw = f"""router static
+ address-family ipv4 unicast
+  0.0.0.0/0 {self.mgmt_gw}
+ !
+!"""
+
+        base_config = f"""hostname {self.vm_name}
+        username dn
+         group root-lr
+         group cisco-support
+         secret 10 $6$FJabgZt79Sm0g...$UbEAn2FSiVMTnS9TTfgOa.XclZVVNpd1ZQ.649eGPwpeJW2G6AqO2GP.iLLWKyvqd7O7UxrRcq5Lyw7cf9C2B.
+        !
+         line console
+         width 512
+        !
+        line default
+         exec-timeout 0 0
+         width 512
+         length 0
+         transport input ssh
+        !
+        vty-pool default 0 4 line-template default
+        interface MgmtEth0/RP0/CPU0/0
+         mtu 1500
+         {xml_if_ip}
+        !
+        {xml_mgmt_gw}
+        ssh server v2
+        ssh server vrf default
+        xml agent tty
+         iteration off
+        !
+        {self.cli_config}
+        """
+        return base_config
+
+    @traced
+    def set_cisco_base_config(self, mgmt_ipv4_addr):
+        """
+        paste the basic CLI config on the console
+        """
+        base_config = self.get_cisco_base_config(mgmt_ipv4_addr)
+        print(f"setting basic configuration for cisco vm {self.vm_name}")
+        child = self.enter_vm_console()
+        child.sendline('end')
+        child.sendline('no')
+        child.expect(r'.*')  # clear the buffer
+        child.sendline('configure')
+        child.expect(r'\(config.*\)')
+        child.sendline(base_config + '\ncommit replace')
+        child.expect(r'\[no\]:')
+        child.sendline('yes')
+        child.expect(r'yes.*\(config.*')
+        child.sendline('end')
+
+
+VM_METADATA_NS = 'https://github.com/ovaknin-dn/VAX_code/vm'
+ElementTree.register_namespace('vax', VM_METADATA_NS)
+
+
+class PciSlotAllocator:
+    """
+    hand out free PCI slots on the root bus of a VM, skipping the slots of the fixed devices in the cisco VM XML
+    (PIIX3/IDE, virtio-serial, USB and memballoon)
+    """
+    RESERVED_SLOTS = (0x00, 0x01, 0x0a, 0x0b, 0x0c)
+
+    def __init__(self):
+        self._slots = (slot for slot in range(0x02, 0x20) if slot not in self.RESERVED_SLOTS)
+
+    def address(self):
+        try:
+            slot = next(self._slots)
+        except StopIteration:
+            exit("ERROR: no free PCI slots left for the VM devices")
+        return f"<address type='pci' domain='0x0000' bus='0x00' slot='{slot:#04x}' function='0x0'/>"
+
+
+class BootStageReader:
+    """
+    read the serial console output of a booting VM as it arrives and follow its boot stages, answering the console
+    prompts (login, cli, etc.) until the VM is ready to be configured.
+    each pattern in 'PATTERNS' is a (stage, regex) tuple in boot order, 'stage' is None for prompts that only need an
+    answer. the time each stage is reached is logged, to show where the boot time goes.
+    """
+    PATTERNS = ()
+    READY_STAGE = 'config-ready'
+
+    def __init__(self, child, vm_name, timeout, nudge_interval=30):
+        """
+        :param child: pexpect console of the VM
+        :param timeout: max time to wait for the VM to be ready
+        :param nudge_interval: send a newline if the console is silent for this long, in case the prompt was printed
+                               before the console was attached
+        """
+        self.child = child
+        self.vm_name = vm_name
+        self.timeout = timeout
+        self.nudge_interval = nudge_interval
+        self.stage_times = {}
+        self._start = None
+        self._retry_at = None
+
+    def wait(self):
+        self._start = monotonic()
+        time_end = self._start + self.timeout
+        patterns = [pattern for _, pattern in self.PATTERNS]
+        while self.READY_STAGE not in self.stage_times:
+            now = monotonic()
+            if now >= time_end:
+                print(f"ERROR: vm '{self.vm_name}' failed to boot within '{self.timeout}' seconds "
+                      f"({self.stages_summary()})")
+                exit(1)
+            read_timeout = min(self.nudge_interval, time_end - now)
+            if self._retry_at:
+                read_timeout = max(0, min(read_timeout, self._retry_at - now))
+            try:
+                index = self.child.expect(patterns, timeout=read_timeout)
+            except pexpect.exceptions.TIMEOUT:
+                if self._retry_at and monotonic() >= self._retry_at:
+                    self._retry_at = None
+                    self.retry()
+                else:
+                    self.child.sendline('')
+                continue
+            except pexpect.exceptions.EOF:
+                print(f"ERROR: console of vm '{self.vm_name}' closed while waiting for boot ({self.stages_summary()})")
+                exit(1)
+            stage = self.PATTERNS[index][0]
+            if stage and stage not in self.stage_times:
+                self.stage_times[stage] = monotonic() - self._start
+                print(f"vm '{self.vm_name}' reached boot stage '{stage}' after {self.stage_times[stage]:.1f} seconds")
+            self.respond(index, self.child.after.decode(errors='replace'))
+        print(f"vm '{self.vm_name}' boot stages: {self.stages_summary()}")
+
+    def respond(self, index, matched):
+        """
+        answer the console prompt that was matched by 'PATTERNS[index]'
+        """
+
+    def retry(self):
+        """
+        called when a retry that was scheduled by 'respond' (using 'self._retry_at') is due
+        """
+
+    def stages_summary(self):
+        return ', '.join(f"{stage} +{seconds:.1f}s" for stage, seconds in self.stage_times.items()) or 'no output'
+
+
+class CiscoBootReader(BootStageReader):
+    PATTERNS = (
+        ('bios', r'SeaBIOS|Booting from Hard Disk'),
+        ('kernel', r'Linux version|Decompressing Linux|Booting the kernel'),
+        ('login-prompt', r'Press RETURN to get started|Username:'),
+        (None, r'Password:'),
+        (None, r'\[no\]'),
+        ('config-ready', r'\(config[^)]*\)#'),
+        (None, r'RP/[^\s(]+#'),
+    )
+
+    def respond(self, index, matched):
+        pattern = self.PATTERNS[index][1]
+        if 'Username:' in matched:
+            self.child.sendline("dn")
+        elif 'Press RETURN' in matched:
+            self.child.sendline('')
+        elif pattern == r'Password:':
+            self.child.sendline("drive1234!")
+        elif pattern == r'\[no\]':
+            # the 'configure' command shows a warning while the system configuration is still being applied
+            self.child.sendline("no")
+            self._retry_at = monotonic() + 5
+        elif pattern == r'RP/[^\s(]+#':
+            self._retry_at = None
+            self.child.sendline('configure')
+
+    def retry(self):
+        self.child.sendline('configure')
+
+
+class JuniperBootReader(BootStageReader):
+    PATTERNS = (
+        ('bios', r'SeaBIOS|Booting from Hard Disk'),
+        ('kernel', r'Copyright \(c\) [\d-]+ Juniper Networks|Booting \['),
+        ('login-prompt', r'login:'),
+        (None, r'root@:~ #'),
+        (None, r'root\S*>'),
+        ('config-ready', r'edit.*#'),
+    )
+
+    def respond(self, index, matched):
+        pattern = self.PATTERNS[index][1]
+        if pattern == r'login:':
+            self.child.sendline("root")
+        elif pattern == r'root@:~ #':
+            self.child.sendline("cli")
+        elif pattern == r'root\S*>':
+            self.child.sendline('configure')
+
+
+CONSOLE_DIR = os.path.join(RUN_DIR, 'vm-consoles')
+
+
+def get_console_source(xml):
+    """
+    get the serial console of a running VM from its live XML: a pty device, or a tcp port (`vmx.sh` VMs)
+
+    :return: {'type': 'pty', 'path': ...} or {'type': 'tcp', 'host': ..., 'port': ..., 'telnet': bool}, or None
+    """
+    domain = ElementTree.fromstring(xml)
+    for serial in domain.findall('devices/serial') + domain.findall('devices/console'):
+        source = serial.find('source')
+        if serial.get('type') == 'pty':
+            path = serial.get('tty') or (source.get('path') if source is not None else None)
+            if path:
+                return {'type': 'pty', 'path': path}
+        elif serial.get('type') == 'tcp' and source is not None:
+            host = source.get('host') or '127.0.0.1'
+            protocol = serial.find('protocol')
+            return {'type': 'tcp', 'host': '127.0.0.1' if host == '0.0.0.0' else host,
+                    'port': int(source.get('service')),
+                    'telnet': protocol is not None and protocol.get('type') == 'telnet'}
+    return None
+
+
+def strip_telnet_commands(data):
+    """
+    remove the telnet negotiation of qemu telnet consoles (IAC sequences) from the console output
+    """
+    return re.sub(rb'\xff[\xfb-\xfe].|\xff[\xf0-\xfa]', b'', data).replace(b'\xff\xff', b'\xff')
+
+
+class VmConsole:
+    """
+    the broker side of a single VM console:
+    - a reader thread keeps the console output in a ring buffer with the time it was read, and sends it to all the
+      connected clients
+    - <domain>.sock: live console. clients get the output from the time they connect, and their input is written
+      to the console. a client that doesn't read its output is disconnected, so it never blocks the others
+    - <domain>.history.sock: sends the ring buffer with a timestamp per line, and closes
+    """
+    HISTORY_BYTES = 1024 * 1024
+    CLIENT_SEND_TIMEOUT = 5
+
+    def __init__(self, domain, source, root=CONSOLE_DIR):
+        self.domain = domain
+        self.source = source
+        self.sock_path = os.path.join(root, f"{domain}.sock")
+        self.history_path = os.path.join(root, f"{domain}.history.sock")
+        self.history = collections.deque()
+        self.history_size = 0
+        self.clients = []
+        self.lock = threading.Lock()
+        self.running = True
+        self._console_fd = self._console_sock = None
+
+    def start(self):
+        if self.source['type'] == 'pty':
+            self._console_fd = os.open(self.source['path'], os.O_RDWR | os.O_NOCTTY)
+            tty.setraw(self._console_fd, termios.TCSANOW)
+        else:
+            self._console_sock = socket.create_connection((self.source['host'], self.source['port']), timeout=10)
+            self._console_sock.settimeout(None)
+        servers = []
+        for path in (self.sock_path, self.history_path):
+            if os.path.exists(path):
+                os.remove(path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            os.chmod(path, 0o600)
+            server.listen()
+            servers.append(server)
+        self.server, self.history_server = servers
+        for target in (self._read_console, self._accept_clients, self._serve_history):
+            threading.Thread(target=target, name=f"console-{self.domain}", daemon=True).start()
+
+    def _console_read(self):
+        if self._console_fd is not None:
+            return os.read(self._console_fd, 64 * 1024)
+        data = self._console_sock.recv(64 * 1024)
+        return strip_telnet_commands(data) if data and self.source['telnet'] else data
+
+    def write(self, data):
+        if self._console_fd is not None:
+            os.write(self._console_fd, data)
+        else:
+            self._console_sock.sendall(data)
+
+    def _read_console(self):
+        while self.running:
+            try:
+                data = self._console_read()
+            except OSError:
+                data = b''
+            if not data:
+                break  # the VM stopped
+            with self.lock:
+                self.history.append((time(), data))
+                self.history_size += len(data)
+                while self.history_size > self.HISTORY_BYTES:
+                    self.history_size -= len(self.history.popleft()[1])
+                clients = list(self.clients)
+            for client in clients:
+                try:
+                    client.sendall(data)
+                except OSError:
+                    self._disconnect(client)
+        self.stop()
+
+    def _accept_clients(self):
+        while self.running:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            client.settimeout(self.CLIENT_SEND_TIMEOUT)
+            with self.lock:
+                self.clients.append(client)
+            threading.Thread(target=self._read_client, args=(client,), daemon=True).start()
+
+    def _read_client(self, client):
+        while self.running:
+            try:
+                data = client.recv(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not data:
+                break
+            try:
+                self.write(data)
+            except OSError:
+                break
+        self._disconnect(client)
+
+    def _disconnect(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client.close()
+
+    def get_history(self):
+        """
+        :return: the ring buffer as text, each line prefixed with the time it was read
+        """
+        with self.lock:
+            history = list(self.history)
+        lines = []
+        at_line_start = True
+        for read_time, data in history:
+            timestamp = f"[{datetime.fromtimestamp(read_time).strftime('%H:%M:%S.%f')[:-3]}] "
+            for line in data.decode(errors='replace').splitlines(keepends=True):
+                lines.append(timestamp + line if at_line_start else line)
+                at_line_start = line.endswith('\n')
+        return ''.join(lines)
+
+    def _serve_history(self):
+        while self.running:
+            try:
+                client, _ = self.history_server.accept()
+            except OSError:
+                return
+            with client:
+                try:
+                    client.sendall(self.get_history().encode())
+                except OSError:
+                    pass
+
+    def stop(self):
+        self.running = False
+        for server, path in ((self.server, self.sock_path), (self.history_server, self.history_path)):
+            server.close()
+            if os.path.exists(path):
+                os.remove(path)
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            client.close()
+        if self._console_fd is not None:
+            os.close(self._console_fd)
+        if self._console_sock is not None:
+            self._console_sock.close()
+
+
+class ConsoleBroker:
+    """
+    a single process per host that attaches once to the serial console of every running VM, and shares it with any
+    number of readers (provisioning, humans, loggers) over Unix sockets in CONSOLE_DIR, so no reader ever reconnects
+    or steals the console from another one. see 'VmConsole' for the sockets of each VM.
+    running VMs are rescanned periodically, so consoles of new VMs are attached within RESCAN_INTERVAL seconds.
+    """
+    RESCAN_INTERVAL = 2
+
+    def __init__(self, root=CONSOLE_DIR):
+        self.root = root
+        self.consoles = {}
+
+    def rescan(self):
+        backend = get_virt_backend()
+        active = set(backend.list_domains(active_only=True))
+        for domain, console in list(self.consoles.items()):
+            if domain not in active or not console.running:
+                console.stop()
+                del self.consoles[domain]
+        for domain in active - set(self.consoles):
+            source = get_console_source(backend.get_domain_xml(domain) or '<domain/>')
+            if not source:
+                continue
+            console = VmConsole(domain, source, self.root)
+            try:
+                console.start()
+            except OSError as e:
+                print(f"WARNING: failed to attach to the console of vm '{domain}': {e}")
+                continue
+            print(f"attached to the console of vm '{domain}'")
+            self.consoles[domain] = console
+
+    def run(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'broker.pid'), 'w') as f:
+            f.write(str(os.getpid()))
+        signal.signal(signal.SIGTERM, lambda *_: exit(0))
+        print(f"console broker is serving the VM consoles in '{self.root}'")
+        try:
+            while True:
+                self.rescan()
+                sleep(self.RESCAN_INTERVAL)
+        finally:
+            for console in self.consoles.values():
+                console.stop()
+            os.remove(os.path.join(self.root, 'broker.pid'))
+
+
+def is_console_broker_running(root=CONSOLE_DIR):
+    try:
+        with open(os.path.join(root, 'broker.pid')) as f:
+            os.kill(int(f.read()), 0)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+if pexpect:
+    class BrokerConsole(TracedExpect, pexpect.fdpexpect.fdspawn):
+        """
+        a pexpect child on a console broker socket
+        """
+        def __init__(self, sock, **kwargs):
+            super().__init__(sock.detach(), **kwargs)  # the child owns the socket fd and closes it
+
+        def sendcontrol(self, char):
+            return self.send(chr(ord(char.lower()) - ord('a') + 1))
+
+
+def open_broker_console(domain, timeout=10, root=CONSOLE_DIR):
+    """
+    connect to the console of a VM through the console broker. the console of a VM that was just started is attached
+    by the broker within a few seconds, so it is waited for.
+
+    :return: a pexpect child, or None if the broker doesn't run
+    """
+    if not is_console_broker_running(root):
+        return None
+    sock_path = os.path.join(root, f"{domain}.sock")
+    deadline = monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(sock_path)
+            return BrokerConsole(sock)
+        except OSError:
+            sock.close()
+            if monotonic() > deadline:
+                print(f"WARNING: the console broker has no console for vm '{domain}', connecting directly")
+                return None
+            sleep(1)
+
+
+def attach_console(vm_name, root=CONSOLE_DIR):
+    """
+    attach the terminal to a VM console (the VCP of a juniper) through the console broker, after printing its recent
+    output. 'ctrl+]' detaches
+    """
+    domain = vm_name if os.path.exists(os.path.join(root, f"{vm_name}.sock")) else f"vcp-{vm_name}"
+    sock_path = os.path.join(root, f"{domain}.sock")
+    if not os.path.exists(sock_path):
+        exit(f"ERROR: the console broker has no console for vm '{vm_name}', is '--console_broker' running?")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as history:
+        history.connect(os.path.join(root, f"{domain}.history.sock"))
+        with history.makefile('rb') as f:
+            sys.stdout.buffer.write(f.read())
+    print(f"\nconnected to the console of vm '{domain}', press 'ctrl+]' to detach")
+    sys.stdout.flush()
+    stdin_fd = sys.stdin.fileno()
+    terminal_attributes = termios.tcgetattr(stdin_fd) if os.isatty(stdin_fd) else None
+    if terminal_attributes:
+        tty.setraw(stdin_fd)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as console:
+            console.connect(sock_path)
+            while True:
+                readable, _, _ = select.select([console, stdin_fd], [], [])
+                if console in readable:
+                    data = console.recv(64 * 1024)
+                    if not data:
+                        break
+                    os.write(sys.stdout.fileno(), data)
+                if stdin_fd in readable:
+                    data = os.read(stdin_fd, 1024)
+                    if not data or b'\x1d' in data:
+                        break
+                    console.sendall(data)
+    finally:
+        if terminal_attributes:
+            termios.tcsetattr(stdin_fd, termios.TCSADRAIN, terminal_attributes)
+
+
+@traced
+def define_virsh_networks(interfaces):
+    """
+    define the virsh networks of all 'net:<name>' interfaces that don't exist yet
+    """
+    networks = set()
+    for interface in interfaces:
+        if_type, if_name = interface.split(':', 1)
+        if if_type == 'net':
+            networks.add(if_name)
+    existing_networks = get_virt_backend().list_networks()
+    for network in networks:
+        if network not in existing_networks:
+            print(f"creating virsh network {network}")
+            InteropEnv.create_virsh_network(network)
+
+
+def get_juniper_internal_bridge(vm_name):
+    """
+    the bridge of the internal link between the vcp and vfp VMs of a vMX, named as `vmx.sh` names it
+    """
+    return f"br-int-{vm_name[-MAX_JUNIPER_NAME:]}"
+
+
+def get_overlay_image_cmd(backing_path, overlay_path, backing_format='qcow2'):
+    return f"qemu-img create -q -f qcow2 -F {backing_format} -b {backing_path} {overlay_path}"
+
+
+def create_overlay_image(backing_path, overlay_path, backing_format='qcow2'):
+    """
+    create a qcow2 overlay image on top of a read-only backing image
+    """
+    send_host_cmd(get_overlay_image_cmd(backing_path, overlay_path, backing_format))
+
+
+def is_qcow2_image(path):
+    """
+    check the image header for the qcow2 magic
+    """
+    with open(path, 'rb') as f:
+        return f.read(4) == b'QFI\xfb'
+
+
+GOLDEN_DIR = os.path.join(InteropEnv.CISCO_IMAGE['local_dir'], 'golden')
+
+
+def get_cisco_golden_paths():
+    return {'disk': os.path.join(GOLDEN_DIR, 'cisco.qcow2'),
+            'state': os.path.join(GOLDEN_DIR, 'cisco.state'),
+            'meta': os.path.join(GOLDEN_DIR, 'cisco.json')}
+
+
+def get_cisco_golden():
+    """
+    get the cisco golden state paths if the golden state exists and was built from the current base image
+    """
+    golden = get_cisco_golden_paths()
+    if not all(os.path.exists(path) for path in golden.values()):
+        return None
+    with open(golden['meta']) as f:
+        meta = json.load(f)
+    base_image = InteropEnv.CISCO_IMAGE['local_path']
+    if (meta['base_image'] != base_image or not os.path.exists(base_image) or
+            os.path.getsize(base_image) != meta['base_size']):
+        return None
+    return golden
+
+
+def update_saved_domain_xml(xml, vm_name, disk_path, cpu_placement, metadata_xml=None):
+    """
+    update the XML of a saved VM state for a new VM: name, uuid, disk, CPU pinning and the VM metadata.
+    only settings that don't change the VM hardware can be changed, the rest must match the saved state.
+    """
+    domain = ElementTree.fromstring(xml)
+    if metadata_xml:
+        metadata = domain.find('metadata')
+        if metadata is None:
+            metadata = ElementTree.Element('metadata')
+            domain.insert(2, metadata)
+        for element in metadata.findall(f'{{{VM_METADATA_NS}}}vm'):
+            metadata.remove(element)
+        metadata.append(ElementTree.fromstring(metadata_xml))
+    domain.find('name').text = vm_name
+    domain.find('uuid').text = str(uuid4())
+    domain.find("devices/disk[@device='disk']/source").set('file', disk_path)
+    cpus = [str(cpu) for cpu in cpu_placement.cpus]
+    emulator_cpus = [str(cpu) for cpu in cpu_placement.emulator_cpus]
+    domain.find('vcpu').set('cpuset', ','.join(cpus + [cpu for cpu in emulator_cpus if cpu not in cpus]))
+    cputune = domain.find('cputune')
+    for vcpupin in cputune.findall('vcpupin'):
+        vcpupin.set('cpuset', cpus[int(vcpupin.get('vcpu'))])
+    cputune.find('emulatorpin').set('cpuset', ','.join(emulator_cpus))
+    for iothreadpin in cputune.findall('iothreadpin'):
+        iothreadpin.set('cpuset', ','.join(emulator_cpus))
+    numa_memory = domain.find('numatune/memory')
+    if numa_memory is not None and cpu_placement.node is not None:
+        numa_memory.set('nodeset', str(cpu_placement.node))
+        numa_memory.set('mode', 'strict' if cpu_placement.hugepage_kb else 'preferred')
+    hugepages_page = domain.find('memoryBacking/hugepages/page')
+    if hugepages_page is not None and cpu_placement.hugepage_kb:
+        hugepages_page.set('size', str(cpu_placement.hugepage_kb))
+        hugepages_page.set('unit', 'KiB')
+    return ElementTree.tostring(domain, encoding='unicode')
+
+
+SNAPSHOT_DIR = os.path.join(InteropEnv.CISCO_IMAGE['local_dir'], 'snapshots')
+
+
+def get_vm_domains(vm_name):
+    """
+    get the libvirt domains of a VM: the cisco domain, or the vcp and vfp domains of a juniper
+    """
+    domains = get_virt_backend().list_domains()
+    if vm_name in domains:
+        return [vm_name]
+    if f"vcp-{vm_name}" in domains:
+        return [f"vcp-{vm_name}", f"vfp-{vm_name}"]
+    exit(f"ERROR: vm '{vm_name}' was not found")
+
+
+def snapshot_vm(vm_name):
+    """
+    take an external snapshot of a running VM (both VMs of a juniper), that '--revert' returns to within seconds:
+    - the memory state of each VM is saved, which stops it. all the VMs are saved before any of them is resumed, so
+      the vcp and vfp of a juniper are consistent with each other
+    - the writable disks are frozen as read-only snapshot images, and replaced with qcow2 overlays backed by them
+    - the VMs are restored from their saved state, and keep running on the overlays
+
+    a new snapshot replaces the previous one, whose frozen disks stay as the backing images of the new ones.
+    the snapshot is kept in SNAPSHOT_DIR/<vm_name>, with a snapshot.json of the state, XML and disks of each VM.
+    if the snapshot fails, the VMs that were already saved get their disks back and are resumed from their state.
+    """
+    backend = get_virt_backend()
+    domains = get_vm_domains(vm_name)
+    for domain in domains:
+        if not backend.is_domain_active(domain):
+            exit(f"ERROR: vm '{domain}' is not running, only running VMs can be snapshotted")
+    snapshot_dir = os.path.join(SNAPSHOT_DIR, vm_name)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot_id = uuid4().hex[:8]
+    print(f"taking a snapshot of vm '{vm_name}'")
+    stopped = {}  # {domain: [(disk path, frozen path, disk mode)]} of the saved domains that were not restored yet
+    try:
+        for domain in domains:
+            backend.save_domain(domain, os.path.join(snapshot_dir, f"{domain}.state"))
+            stopped[domain] = []
+        snapshot = {'created': time(), 'domains': {}}
+        for domain in domains:
+            state_path = os.path.join(snapshot_dir, f"{domain}.state")
+            domain_xml = ElementTree.fromstring(backend.get_saved_state_xml(state_path))
+            disks = {}
+            for disk in domain_xml.findall("devices/disk[@device='disk']"):
+                if disk.find('readonly') is not None or disk.find('source') is None:
+                    continue
+                disk_path = disk.find('source').get('file')
+                disk_format = disk.find('driver').get('type', 'raw')
+                frozen_path = os.path.join(snapshot_dir, f"{snapshot_id}-{os.path.basename(disk_path)}")
+                disk_mode = os.stat(disk_path).st_mode
+                shutil.move(disk_path, frozen_path)
+                stopped[domain].append((disk_path, frozen_path, disk_mode))
+                os.chmod(frozen_path, 0o444)  # the overlays use it as their backing image, it must never change
+                create_overlay_image(frozen_path, disk_path, disk_format)
+                disk.find('driver').set('type', 'qcow2')
+                disks[disk_path] = {'frozen': frozen_path, 'format': disk_format}
+            xml = ElementTree.tostring(domain_xml, encoding='unicode')
+            backend.restore_domain(state_path, xml)
+            del stopped[domain]
+            backend.define_domain(xml)
+            snapshot['domains'][domain] = {'state': state_path, 'xml': xml, 'disks': disks}
+    finally:
+        for domain, frozen_disks in stopped.items():
+            resume_saved_domain(domain, os.path.join(snapshot_dir, f"{domain}.state"), frozen_disks)
+    with open(os.path.join(snapshot_dir, 'snapshot.json'), 'w') as f:
+        json.dump(snapshot, f, indent=2)
+    print(f"snapshot of vm '{vm_name}' is ready")
+
+
+def resume_saved_domain(domain, state_path, frozen_disks):
+    """
+    undo the snapshot of a VM that was saved (stopped) by a failed snapshot: move its frozen disks back in place of
+    their overlays, and restore it from its saved state with its original XML
+    """
+    print(f"the snapshot failed, resuming vm '{domain}' from its saved state")
+    backend = get_virt_backend()
+    try:
+        for disk_path, frozen_path, disk_mode in frozen_disks:
+            if os.path.exists(disk_path):
+                os.remove(disk_path)
+            os.chmod(frozen_path, disk_mode)
+            shutil.move(frozen_path, disk_path)
+        backend.restore_domain(state_path, backend.get_saved_state_xml(state_path))
+    except (SystemExit, Exception) as e:
+        print(f"ERROR: failed to resume vm '{domain}', restore it with `virsh restore {state_path}`: {e}")
+
+
+def revert_vm(vm_name):
+    """
+    return a VM to its snapshot: its VMs are stopped, their disks are replaced with new overlays of the frozen
+    snapshot disks, and the saved memory state is restored. the snapshot is kept, so a VM can be reverted many times
+    """
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, vm_name, 'snapshot.json')) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        exit(f"ERROR: no snapshot found for vm '{vm_name}'")
+    backend = get_virt_backend()
+    print(f"reverting vm '{vm_name}' to its snapshot")
+    for domain in snapshot['domains']:
+        if backend.is_domain_active(domain) and not backend.destroy_domain(domain):
+            exit(f"ERROR: failed to stop vm '{domain}'")
+    for domain, domain_snapshot in snapshot['domains'].items():
+        for disk_path, disk in domain_snapshot['disks'].items():
+            if os.path.exists(disk_path):
+                os.remove(disk_path)
+            create_overlay_image(disk['frozen'], disk_path, disk['format'])
+        backend.restore_domain(domain_snapshot['state'], domain_snapshot['xml'])
+    print(f"vm '{vm_name}' was reverted to its snapshot")
+
+
+POOL_DIR = os.path.join(InteropEnv.CISCO_IMAGE['local_dir'], 'pool')
+
+
+class WarmPool:
+    """
+    a pool of idle, booted cisco VMs that --from_pool VMs are claimed from. a VM is claimed by saving its state and
+    restoring it under the new VM name, so it is ready for its base config within seconds.
+    - the pool is refilled in the background after a claim, up to its size and within its CPU and memory budget
+    - pool VMs are named 'pool-cisco-<id>' and have no interfaces, the interfaces are attached when claimed
+    - juniper VMs are not pooled, since the vcp/vfp VM pair of `vmx.sh` can't be renamed
+
+    layout under POOL_DIR:
+    - pool.json: {'settings': {...}, 'vms': [{'name', 'type', 'state': 'booting'|'ready', 'pid', 'disk',
+      'device_profile', 'created'}]}
+    - pool.lock: held while pool.json is read and updated
+    - fill.lock: held by the process that fills the pool, so only one process boots pool VMs
+    - <name>.state: the saved state of a VM that is being claimed
+    """
+    DEFAULT_SETTINGS = {'size': 2, 'max_cpus': 8, 'max_memory_gb': 32, 'device_profile': 'legacy'}
+
+    def __init__(self, root=POOL_DIR):
+        self.root = root
+        self.pool_path = os.path.join(root, 'pool.json')
+        os.makedirs(root, exist_ok=True)
+
+    def _lock(self, name='pool'):
+        lock_file = open(os.path.join(self.root, f"{name}.lock"), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _read(self):
+        try:
+            with open(self.pool_path) as f:
+                pool = json.load(f)
+        except (OSError, ValueError):
+            pool = {}
+        pool.setdefault('vms', [])
+        pool['settings'] = dict(self.DEFAULT_SETTINGS, **pool.get('settings', {}))
+        return pool
+
+    def _write(self, pool):
+        tmp_path = f"{self.pool_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(pool, f, indent=2)
+        os.replace(tmp_path, self.pool_path)
+
+    def _is_alive(self, vm):
+        if vm['state'] == 'ready':
+            return get_virt_backend().is_domain_active(vm['name'])
+        try:
+            os.kill(vm['pid'], 0)
+            return True
+        except OSError:
+            return False
+
+    def _remove_vm(self, vm):
+        backend = get_virt_backend()
+        if backend.is_domain_active(vm['name']):
+            backend.destroy_domain(vm['name'])
+        backend.undefine_domain(vm['name'])
+        if os.path.exists(vm['disk']):
+            os.remove(vm['disk'])
+
+    def _prune(self, pool):
+        """
+        remove the VMs that stopped (e.g. after a host reboot) or whose filling process died while booting them
+        """
+        for vm in list(pool['vms']):
+            if not self._is_alive(vm):
+                print(f"removing stale warm pool vm '{vm['name']}'")
+                self._remove_vm(vm)
+                pool['vms'].remove(vm)
+
+    def configure(self, **settings):
+        with self._lock():
+            pool = self._read()
+            pool['settings'].update({key: value for key, value in settings.items() if value is not None})
+            self._write(pool)
+            return pool['settings']
+
+    def claim(self, vm_type):
+        """
+        take the oldest idle VM of the type out of the pool, and save its state so it can be restored under a new name
+
+        :return: the pool VM with its 'disk' and saved 'state' paths, or None if the pool has no idle VM of the type
+        """
+        with self._lock():
+            pool = self._read()
+            self._prune(pool)
+            ready = [vm for vm in pool['vms'] if vm['type'] == vm_type and vm['state'] == 'ready']
+            if not ready:
+                self._write(pool)
+                return None
+            vm = min(ready, key=lambda _vm: _vm['created'])
+            pool['vms'].remove(vm)
+            self._write(pool)
+        backend = get_virt_backend()
+        vm['state'] = os.path.join(self.root, f"{vm['name']}.state")
+        backend.save_domain(vm['name'], vm['state'])
+        backend.undefine_domain(vm['name'])
+        return vm
+
+    def fill(self):
+        """
+        boot VMs until the pool reaches its size, within its CPU and memory budget. the VMs boot in parallel
+        """
+        fill_lock = open(os.path.join(self.root, 'fill.lock'), 'w')
+        try:
+            fcntl.flock(fill_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("the warm pool is already being filled by another process")
+            return
+        envs = []
+        with self._lock():
+            pool = self._read()
+            self._prune(pool)
+            settings = pool['settings']
+            cpus_per_vm = InteropEnv.CISCO_IMAGE['cpus']
+            memory_per_vm_gb = InteropEnv.CISCO_IMAGE['memory_kb'] / (1024 * 1024)
+            count = len(pool['vms'])
+            with ResourceLedger() as ledger:
+                reserved_cpus = set(ledger.reserved('cpus'))
+                allocator = CpuAllocator([cpu for cpu in get_available_cpus() if cpu not in reserved_cpus])
+                while count < settings['size']:
+                    if ((count + 1) * cpus_per_vm > settings['max_cpus'] or
+                            (count + 1) * memory_per_vm_gb > settings['max_memory_gb']):
+                        print(f"the warm pool is limited to {count} vms by its budget of {settings['max_cpus']} cpus "
+                              f"and {settings['max_memory_gb']}G memory")
+                        break
+                    name = f"pool-cisco-{uuid4().hex[:6]}"
+                    placement = allocator.allocate(name, 'cisco')
+                    if not placement:
+                        print(f"not enough available CPUs for the warm pool, it is limited to {count} vms")
+                        break
+                    ledger.reserve('cpus', placement.cpus + placement.kept_free)
+                    envs.append(InteropEnv(None, placement, name, 'cisco', [], None, None, None,
+                                           device_profile=settings['device_profile']))
+                    pool['vms'].append({'name': name, 'type': 'cisco', 'state': 'booting', 'pid': os.getpid(),
+                                        'disk': os.path.join(InteropEnv.CISCO_IMAGE['local_dir'], f"{name}.qcow2"),
+                                        'device_profile': settings['device_profile'], 'created': time()})
+                    count += 1
+            plan_hugepages([env.cpu_placement for env in envs])
+            self._write(pool)
+        if not envs:
+            return
+        envs[0].get_cisco_image()
+        print(f"booting {len(envs)} warm pool vms")
+        with ThreadPoolExecutor(max_workers=len(envs), initializer=ThreadOutput.bind,
+                                initargs=(ThreadOutput.current(),)) as executor:
+            futures = {executor.submit(env.start_cisco_pool_vm): env for env in envs}
+            for future in as_completed(futures):
+                name = futures[future].vm_name
+                try:
+                    future.result()
+                    state = 'ready'
+                except BaseException as e:  # 'exit' raises SystemExit
+                    print(f"ERROR: failed to boot warm pool vm '{name}': {e}")
+                    state = None
+                with self._lock():
+                    pool = self._read()
+                    vm = next(vm for vm in pool['vms'] if vm['name'] == name)
+                    if state:
+                        vm['state'] = state
+                        print(f"warm pool vm '{name}' is ready")
+                    else:
+                        self._remove_vm(vm)
+                        pool['vms'].remove(vm)
+                    self._write(pool)
+
+    def refill_in_background(self):
+        """
+        fill the pool from a detached process, so claiming VMs don't wait for it
+        """
+        with self._lock():
+            device_profile = self._read()['settings']['device_profile']
+        with open(os.path.join(self.root, 'fill.log'), 'a') as log_file:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), '--fill_pool', '--device_profile',
+                              device_profile], stdout=log_file,
+                             stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+        print(f"refilling the warm pool in the background, see '{os.path.join(self.root, 'fill.log')}'")
+
+    def drain(self):
+        """
+        delete all the idle VMs of the pool
+        """
+        with self._lock():
+            pool = self._read()
+            for vm in pool['vms']:
+                print(f"deleting warm pool vm '{vm['name']}'")
+                self._remove_vm(vm)
+            pool['vms'] = []
+            self._write(pool)
+
+
+def get_shared_images():
+    """
+    get the paths of the base images that are shared by all clones and must never be deleted with a vm
+    """
+    return {os.path.realpath(InteropEnv.CISCO_IMAGE['local_path']),
+            os.path.realpath(InteropEnv.JUNIPER_IMAGE['local_path']),
+            os.path.realpath(InteropEnv.JUNIPER_IMAGE['cache_dir']),
+            os.path.realpath(get_cisco_golden_paths()['disk'])}
+
+
+@traced
+def get_or_create_bridges(count):
+    """
+    find empty bridges on the host. if not enough interfaces found, create new ones and enable them.
+    the bridges are reserved in the resource ledger until 'release_reservations' is called, so a parallel run doesn't
+    take the same empty bridges (or bridge numbers) before their ports are attached.
+    """
+    with ResourceLedger() as ledger:
+        reserved_bridges = set(ledger.reserved('bridges'))
+        all_bridges = {br_name: bool(ifs) for br_name, ifs in get_bridges_info().items()
+                       if re.match(r'br\d+', br_name)}
+        available_bridges = [br for br, has_ifs in all_bridges.items()
+                             if not has_ifs and br not in reserved_bridges][:count]
+
+        # create extra bridges, numbered after the highest configured (or reserved) bridge
+        br_numbers = [int(re.match(r'br(\d+)', br).group(1)) for br in set(all_bridges) | reserved_bridges]
+        highest_br = max(br_numbers, default=0)
+        missing_bridges = count - len(available_bridges)
+        new_bridges_nums = list(range(highest_br + 1, highest_br + missing_bridges + 1))
+        inventory = get_net_inventory()
+        for br_num in new_bridges_nums:
+            br_name = f"br{br_num}"
+            available_bridges.append(br_name)
+            print(f"creating bridge {br_name}")
+            inventory.add_bridge(br_name)
+        ledger.reserve('bridges', available_bridges)
+
+    # enable all bridges, the new bridges are created in the same batch
+    if new_bridges_nums:
+        enable_host_interfaces(available_bridges)
+
+    return available_bridges
+
+
+def get_vm_index():
+    """
+    read the VM index of the host: the <vax:vm> metadata of all the domains, in a single pass (see 'get_metadata_xml')
+
+    :return: {domain: {entry: value, or list of values for the repeated 'disk', 'dir' and 'bridge' entries}}. domains
+             without metadata (created before the index, or by `vmx.sh`) have an empty dict
+    """
+    index = {}
+    for domain, metadata_xml in get_virt_backend().get_domains_metadata().items():
+        entries = {'disk': [], 'dir': [], 'bridge': []}
+        try:
+            for element in ElementTree.fromstring(metadata_xml) if metadata_xml else []:
+                key = element.tag.rpartition('}')[2]
+                if key in ('disk', 'dir', 'bridge'):
+                    entries[key].append(element.text)
+                else:
+                    entries[key] = element.text
+        except ElementTree.ParseError:
+            print(f"WARNING: ignoring invalid metadata of vm '{domain}'")
+        index[domain] = entries if 'name' in entries else {}
+    return index
+
+
+def get_group_vms(group_id, index=None):
+    """
+    get the VMs of a group from the VM index: the VMs whose group (or name) is 'group_id'. a VM without metadata is
+    matched by its exact domain names only, so VMs whose names merely contain 'group_id' are never matched
+
+    :return: {vm name: {domain: metadata}}, the vcp and vfp domains of a juniper are one VM
+    """
+    index = get_vm_index() if index is None else index
+    vms = {}
+    for domain, metadata in index.items():
+        if metadata:
+            if group_id in (metadata.get('group'), metadata['name']):
+                vms.setdefault(metadata['name'], {})[domain] = metadata
+        elif domain in (group_id, f"vcp-{group_id}", f"vfp-{group_id}"):
+            vms.setdefault(re.sub(r'^v[cf]p-', '', domain), {})[domain] = metadata
+    return vms
+
+
+def delete_vm(vm_name, domains):
+    """
+    delete the domains of a VM, and the disks, folders and bridges listed in their metadata (found in the domain XML
+    for VMs without metadata)
+
+    :param domains: {domain: metadata} of the VM
+    :return: list of errors
+    """
+    errors = []
+
+    def _send_host_cmd(cmd, **kwargs):
+        if send_host_cmd(cmd, strict=False, return_status_code=True, stderr=subprocess.PIPE, **kwargs) != 0:
+            errors.append(f"failed to execute command '{cmd}'")
+
+    backend = get_virt_backend()
+    disks, dirs, bridges = set(), set(), set()
+    vmx_dir = None  # the folder of a juniper that was installed by `vmx.sh`
+    for domain, metadata in domains.items():
+        disks.update(metadata.get('disk', []))
+        dirs.update(metadata.get('dir', []))
+        bridges.update(metadata.get('bridge', []))
+        if metadata or domain.startswith('vfp-'):
+            continue
+        vm_xml = backend.get_domain_xml(domain) or ''
+        image_paths = [path for path in re.findall(r"<source file='([^']+)'", vm_xml) if vm_name in path]
+        if domain.startswith('vcp-'):
+            if image_paths:
+                vmx_dir = re.match(r'(.*?%s)' % vm_name, image_paths[0]).group(1)
+        else:
+            disks.update(image_paths)
+    if vmx_dir:
+        if os.path.realpath(vmx_dir) in get_shared_images():
+            return [f"refusing to delete shared juniper folder '{vmx_dir}'"]
+        _send_host_cmd("./vmx.sh --cleanup", cwd=vmx_dir)
+        dirs.add(vmx_dir)
+    else:
+        for domain in domains:
+            if backend.is_domain_active(domain) and not backend.destroy_domain(domain):
+                errors.append(f"failed to destroy vm '{domain}'")
+            if not backend.undefine_domain(domain):
+                errors.append(f"failed to undefine vm '{domain}'")
+
+    # an image may be an overlay, so only its own file is removed and never the shared backing image
+    for path in sorted(disks | dirs):
+        if os.path.realpath(path) in get_shared_images():
+            print(f"WARNING: not deleting shared image '{path}' used by vm '{vm_name}'")
+            continue
+        _send_host_cmd(f"rm -rf {path}")
+    _send_host_cmd(f"rm -rf {os.path.join(SNAPSHOT_DIR, vm_name)}")
+    VmProgress(vm_name).remove()
+    bridges = [bridge for bridge in sorted(bridges) if bridge in get_bridges_info()]
+    if bridges:
+        delete_host_bridges(bridges)
+    return errors
+
+
+@traced
+def delete_vms(*group_ids):
+    """
+    delete all the VMs of the groups, in parallel, with their virsh config and storage
+    """
+    index = get_vm_index()
+    vms = {}
+    for group_id in group_ids:
+        group_vms = get_group_vms(group_id, index)
+        if not group_vms:
+            exit(f"no VMs found in group '{group_id}'")
+        vms.update(group_vms)
+    print(f"deleting {len(vms)} vms: {', '.join(vms)}")
+    with ThreadPoolExecutor(max_workers=len(vms), initializer=ThreadOutput.bind,
+                            initargs=(ThreadOutput.current(),)) as executor:
+        errors = [error for vm_errors in executor.map(delete_vm, vms, vms.values()) for error in vm_errors]
+    with ResourceLedger() as ledger:
+        ledger.release_vm_ids(vms)
+    if errors:
+        print('\n'.join(errors))
+    else:
+        print(f"vm '{', '.join(group_ids)}' successfully deleted")
+
+
+LEDGER_PATH = os.path.join(RUN_DIR, 'create_single_vm.ledger.json')
+MAX_VM_ID = 99
+
+
+class ResourceLedger:
+    """
+    a file-locked ledger of the host resources that are allocated to VMs which don't hold them yet, so parallel runs
+    of this script (and parallel daemon requests) never allocate the same CPUs, bridges, hugepages or VM ids.
+
+    used as a transaction: `with ResourceLedger() as ledger:` holds the ledger lock, and the changes are written back
+    only if the block completes, so a failed allocation reserves nothing. a block that changes nothing (e.g --check)
+    doesn't write the ledger.
+
+    layout of LEDGER_PATH:
+    - 'reservations': {owner: {'pid', 'cpus': [...], 'bridges': [...], 'hugepages': [[node, page size KiB, pages]]}}
+      held until the run (or daemon request) that owns them ends, once its VMs are defined and hold the resources
+      themselves. reservations of dead processes are dropped
+    - 'vm_ids': {vm name: id} the ids (1-99) used in the MAC addresses and console ports of the VMs, held until the
+      VM is deleted
+    - 'vm_ids_scanned': True once the ids of the VMs that are missing from the ledger were recorded (see
+      '_scan_vm_ids')
+    """
+    def __init__(self, path=LEDGER_PATH):
+        self.path = path
+        self.state = None
+        self._lock_file = None
+        self._read_state = None  # the state as read by __enter__, to skip writing an unchanged ledger
+
+    @staticmethod
+    def owner():
+        """
+        the owner of the reservations: this process, or the daemon request (identified by its output stream)
+        """
+        request_stream = ThreadOutput.current()
+        return f"{os.getpid()}-{id(request_stream)}" if request_stream else str(os.getpid())
+
+    def __enter__(self):
+        self._lock_file = open(f"{self.path}.lock", 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            with open(self.path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        self.state.setdefault('reservations', {})
+        self.state.setdefault('vm_ids', {})
+        self._read_state = json.dumps(self.state, sort_keys=True)
+        for owner, reservation in list(self.state['reservations'].items()):
+            try:
+                os.kill(reservation['pid'], 0)
+            except OSError:
+                del self.state['reservations'][owner]
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None and json.dumps(self.state, sort_keys=True) != self._read_state:
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.state, f, indent=2)
+                os.replace(tmp_path, self.path)
+        finally:
+            self._lock_file.close()
+
+    def reserved(self, kind):
+        """
+        :return: all the reserved items of a kind ('cpus', 'bridges' or 'hugepages'), of all the owners
+        """
+        return [item for reservation in self.state['reservations'].values() for item in reservation.get(kind, [])]
+
+    def reserve(self, kind, items):
+        reservation = self.state['reservations'].setdefault(self.owner(), {'pid': os.getpid()})
+        reservation.setdefault(kind, []).extend(items)
+
+    def release(self):
+        """
+        release all the reservations of the current owner
+        """
+        self.state['reservations'].pop(self.owner(), None)
+
+    def get_vm_id(self, vm_name):
+        """
+        get the id of a VM, and assign it the lowest free id if it has none
+        """
+        if not self.state.get('vm_ids_scanned'):
+            self._scan_vm_ids()
+        if vm_name not in self.state['vm_ids']:
+            taken = set(self.state['vm_ids'].values())
+            free_ids = [vm_id for vm_id in range(1, MAX_VM_ID + 1) if vm_id not in taken]
+            if not free_ids:
+                exit(f"ERROR: all the {MAX_VM_ID} vm ids of the host are in use")
+            self.state['vm_ids'][vm_name] = free_ids[0]
+        return self.state['vm_ids'][vm_name]
+
+    def _scan_vm_ids(self):
+        """
+        record the ids of the VMs that are not in the ledger: VMs whose id is in their metadata (the ledger is lost on
+        host reboot), and VMs that were created before the ledger existed, which use their first pinned CPU as their id
+        """
+        backend = get_virt_backend()
+        for domain, metadata in get_vm_index().items():
+            vm_name = metadata.get('name') or re.sub(r'^v[cf]p-', '', domain)
+            if vm_name in self.state['vm_ids']:
+                continue
+            if metadata:
+                if metadata.get('vm_id'):
+                    self.state['vm_ids'][vm_name] = int(metadata['vm_id'])
+                continue
+            vcpupin = ElementTree.fromstring(backend.get_domain_xml(domain)).find('cputune/vcpupin')
+            if vcpupin is not None:
+                self.state['vm_ids'][vm_name] = parse_cpu_list(vcpupin.get('cpuset'))[0]
+        self.state['vm_ids_scanned'] = True
+
+    def release_vm_ids(self, vm_names):
+        for vm_name in vm_names:
+            self.state['vm_ids'].pop(vm_name, None)
+
+
+def release_reservations():
+    """
+    release the resources reserved by this run (or daemon request), once its VMs are defined (or failed)
+    """
+    with ResourceLedger() as ledger:
+        ledger.release()
+
+
+def get_available_cpus():
+    """
+    find the host CPUs that are free for new VMs: the online CPUs, except CPU 0 (left to the host), the CPUs of the
+    running VMs and of the defined VMs that are not running, and the hyperthread siblings that the juniper VMs keep
+    free for their VFP cores (see 'CpuAllocator'), which are recorded in the VM index.
+    VMs without metadata (created before the index, or by `vmx.sh`) hold the CPUs their vCPUs are pinned to, and the
+    siblings of the pinned CPUs of their VFP
+
+    :return: list of the free CPUs, in ascending order
+    """
+    backend = get_virt_backend()
+    used_cpus = backend.get_used_cpus()
+    siblings = None
+    for domain, metadata in get_vm_index().items():
+        if metadata:
+            for key in ('cpus', 'kept_free'):
+                used_cpus.update(parse_cpu_list(metadata.get(key) or ''))
+            continue
+        domain_xml = backend.get_domain_xml(domain)
+        if not domain_xml:
+            continue
+        pinned_cpus = [cpu for vcpupin in ElementTree.fromstring(domain_xml).findall('cputune/vcpupin')
+                       for cpu in parse_cpu_list(vcpupin.get('cpuset', ''))]
+        used_cpus.update(pinned_cpus)
+        if domain.startswith('vfp-'):
+            siblings = siblings or read_cpu_topology()[1]
+            used_cpus.update(sibling for cpu in pinned_cpus for sibling in siblings.get(cpu, ()))
+    online_cpus = parse_cpu_list(read_sysfs('devices/system/cpu/online', default=f"0-{os.cpu_count() - 1}"))
+    return [cpu for cpu in online_cpus if cpu != 0 and cpu not in used_cpus]
+
+
+def parse_cpu_list(cpu_list):
+    """
+    parse a kernel cpu list such as '0-3,8,10-11' to a list of ints
+    """
+    cpus = []
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def read_sysfs(*path, default=None):
+    try:
+        with open(os.path.join(SYSFS_ROOT, *path)) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def read_cpu_topology():
+    """
+    read the host CPU topology from sysfs.
+
+    :return: tuple of ({node: [cpus]}, {cpu: {hyperthread siblings, including itself}})
+    """
+    online_cpus = parse_cpu_list(read_sysfs('devices/system/cpu/online', default=f"0-{os.cpu_count() - 1}"))
+    nodes = {}
+    node_dir = os.path.join(SYSFS_ROOT, 'devices/system/node')
+    for node_name in sorted(os.listdir(node_dir) if os.path.isdir(node_dir) else []):
+        if re.match(r'node\d+$', node_name):
+            node_cpus = parse_cpu_list(read_sysfs('devices/system/node', node_name, 'cpulist', default=''))
+            nodes[int(node_name[4:])] = [cpu for cpu in node_cpus if cpu in online_cpus]
+    if not nodes:
+        nodes = {0: online_cpus}
+    siblings = {}
+    for cpu in online_cpus:
+        cpu_siblings = read_sysfs(f'devices/system/cpu/cpu{cpu}/topology/thread_siblings_list', default=str(cpu))
+        siblings[cpu] = set(parse_cpu_list(cpu_siblings))
+    return nodes, siblings
 
-        if self.mgmt_gw:
-            xml_mgmt_gw = f"""router static
- address-family ipv4 unicast
-  0.0.0.0/0 {self.mgmt_gw}
- !
-!"""
 
-        base_config = f"""hostname {self.vm_name}
-        username dn
-         group root-lr
-         group cisco-support
-         secret 10 $6$FJabgZt79Sm0g...$UbEAn2FSiVMTnS9TTfgOa.XclZVVNpd1ZQ.649eGPwpeJW2G6AqO2GP.iLLWKyvqd7O7UxrRcq5Lyw7cf9C2B.
-        !
-         line console
-         width 512
-        !
-        line default
-         exec-timeout 0 0
-         width 512
-         length 0
-         transport input ssh
-        !
-        vty-pool default 0 4 line-template default
-        interface MgmtEth0/RP0/CPU0/0
-         mtu 1500
-         {xml_if_ip}
-        !
-        {xml_mgmt_gw}
-        ssh server v2
-        ssh server vrf default
-        xml agent tty
-         iteration off
-        !
-        {self.cli_config}
-        """
-        print(f"setting basic configuration for cisco vm {self.vm_name}")
-        child = self.enter_vm_console()
-        child.sendline('end')
-        child.sendline('no')
-        child.expect(r'.*')  # clear the buffer
-        child.sendline('configure')
-        child.expect(r'\(config.*\)')
-        child.sendline(base_config + '\ncommit replace')
-        child.expect(r'\[no\]:')
-        child.sendline('yes')
-        child.expect(r'yes.*\(config.*')
-        child.sendline('end')
+class CpuPlacement:
+    """
+    the CPUs of a single VM, all on one NUMA node when possible.
+    - cpus: the vCPU pinning. for juniper the first cpu is the VCP cpu and the rest are the VFP cpus
+    - emulator_cpus: the CPUs for the qemu emulator threads
+    - kept_free: hyperthread siblings of the VFP cpus that are kept unused, so the VFP cores are not shared
+    - hugepage_kb: the size of the hugepages backing the VM memory, set by 'HugepagePlanner'
+    """
+    def __init__(self, vm_name, vm_type, node, cpus, emulator_cpus, kept_free=()):
+        self.vm_name = vm_name
+        self.vm_type = vm_type
+        self.node = node
+        self.cpus = cpus
+        self.emulator_cpus = emulator_cpus
+        self.kept_free = list(kept_free)
+        self.hugepage_kb = None
+
+    def __str__(self):
+        cpus = ','.join(str(cpu) for cpu in self.cpus)
+        if self.vm_type == 'juniper':
+            cpus = f"vcp {self.cpus[0]}, vfp {','.join(str(cpu) for cpu in self.cpus[1:])}"
+        description = (f"{self.vm_name} ({self.vm_type}): node {'any' if self.node is None else self.node}, "
+                       f"cpus {cpus}, emulator {','.join(str(cpu) for cpu in self.emulator_cpus)}")
+        if self.kept_free:
+            description += f", kept free {','.join(str(cpu) for cpu in self.kept_free)}"
+        if self.hugepage_kb:
+            description += f", {format_page_size(self.hugepage_kb)} hugepages"
+        return description
 
 
-def get_or_create_bridges(count):
+class CpuAllocator:
     """
-    find empty bridges on the host. if not enough interfaces found, create new ones and enable them.
+    allocate CPUs for VMs based on the host NUMA and hyperthread topology:
+    - all the CPUs of a VM, its emulator threads and its memory are placed on a single NUMA node
+    - the juniper VFP packet-forwarding cores are whole physical cores: their hyperthread siblings are not used by any
+      other vCPU (the sibling is kept free)
     """
-    all_bridges = {br_name: bool(ifs) for br_name, ifs in get_bridges_info().items() if re.match(r'br\d+', br_name)}
-    available_bridges = [br for br, has_ifs in all_bridges.items() if not has_ifs][:count]
-    if len(available_bridges) == count:
-        return available_bridges
+    def __init__(self, available_cpus, topology=None):
+        self.nodes, self.siblings = topology or read_cpu_topology()
+        self.free = set(available_cpus)
+        self.cpu_counts = {'cisco': InteropEnv.CISCO_IMAGE['cpus'], 'juniper': InteropEnv.JUNIPER_IMAGE['cpus']}
+
+    def _free_cores(self, node_cpus):
+        """
+        get one cpu of each physical core whose hyperthreads are all free
+        """
+        return [cpu for cpu in node_cpus if cpu in self.free and min(self.siblings[cpu]) == cpu and
+                self.siblings[cpu] <= self.free]
 
-    # find the highest configured bridge name and start counting from there
-    br_numbers = [int(re.match(r'br(\d+)', br).group(1)) for br in all_bridges]
-    highest_br = sorted(br_numbers)[-1]
+    def allocate(self, vm_name, vm_type):
+        """
+        :return: CpuPlacement, or None if there are not enough free CPUs
+        """
+        required = self.cpu_counts[vm_type]
+        if len(self.free) < required:
+            return None
+        # prefer the node with the most free CPUs
+        nodes = sorted(self.nodes, key=lambda _node: -len(self.free.intersection(self.nodes[_node])))
+        for node in nodes:
+            node_free = [cpu for cpu in self.nodes[node] if cpu in self.free]
+            if len(node_free) < required:
+                continue
+            if vm_type == 'cisco':
+                cpus = node_free[:required]
+                return self._take(CpuPlacement(vm_name, vm_type, node, cpus, cpus))
+            vfp_cores = self._free_cores(self.nodes[node])[:required - 1]
+            kept_free = [sibling for cpu in vfp_cores for sibling in sorted(self.siblings[cpu]) if sibling != cpu]
+            vcp_candidates = [cpu for cpu in node_free if cpu not in vfp_cores and cpu not in kept_free]
+            if len(vfp_cores) == required - 1 and vcp_candidates:
+                vcp_cpu = vcp_candidates[0]
+                return self._take(CpuPlacement(vm_name, vm_type, node, [vcp_cpu] + vfp_cores, [vcp_cpu], kept_free))
+        # no node has enough whole cores for the VFP, use any free CPUs on the best node
+        for node in nodes:
+            node_free = [cpu for cpu in self.nodes[node] if cpu in self.free]
+            if len(node_free) >= required:
+                print(f"WARNING: not enough free physical cores for vm '{vm_name}', its cpus may share hyperthreads")
+                return self._take(CpuPlacement(vm_name, vm_type, node, node_free[:required], node_free[:1]))
+        print(f"WARNING: not enough free cpus on a single NUMA node for vm '{vm_name}', spreading it across nodes")
+        cpus = sorted(self.free)[:required]
+        return self._take(CpuPlacement(vm_name, vm_type, None, cpus, cpus[:1] if vm_type == 'juniper' else cpus))
 
-    # create extra bridges
-    missing_bridges = count - len(available_bridges)
-    new_bridges_nums = list(range(highest_br + 1, highest_br + missing_bridges + 1))
-    for br_num in new_bridges_nums:
-        br_name = f"br{br_num}"
-        available_bridges.append(br_name)
-        print(f"creating bridge {br_name}")
-        send_host_cmd(f"brctl addbr {br_name}")
+    def _take(self, placement):
+        self.free.difference_update(placement.cpus)
+        self.free.difference_update(placement.kept_free)
+        return placement
 
-    # enable all bridges
-    for bridge in available_bridges:
-        send_host_cmd(f"sudo ip l set {bridge} up")
 
-    return available_bridges
+HUGEPAGE_SIZES_KB = (1024 * 1024, 2048)
+
 
+def format_page_size(size_kb):
+    return f"{size_kb // (1024 * 1024)}G" if size_kb >= 1024 * 1024 else f"{size_kb // 1024}M"
 
-def delete_vms(vm_name):
+
+def get_hugepages_path(node):
     """
-    delete a vm, virsh config and storage lf all VMs will be removed.
+    the sysfs directory of the hugepage pools of a NUMA node, or of the host-wide pools for node None
     """
-    vms_im_group = get_vm_names_by_group_id(vm_name)
-    if not vms_im_group:
-        exit(f"no VMs found in group '{vm_name}'")
-    errors = []
+    return 'kernel/mm/hugepages' if node is None else f'devices/system/node/node{node}/hugepages'
 
-    def _send_host_cmd(cmd, **kwargs):
-        if send_host_cmd(cmd, strict=False, return_status_code=True, stderr=subprocess.PIPE, **kwargs) != 0:
-            errors.append(f"failed to execute command '{cmd}'")
 
-    for vm in vms_im_group:
-        if 'vfp-' in vm:
-            continue  # each juniper is actually 2 VMs, handle deletion on 'vcp-' iteration
-        image_path = send_host_cmd(f"virsh dumpxml {vm} | grep 'source file' | grep {vm_name} | cut -d \\' -f2")
-        if 'vcp-' in vm:  # if juniper
-            dir_name = re.match(r'vcp-(.*)', vm).group(1)
-            dir_path = re.match(r'(.*?%s)' % dir_name, image_path).group(1)
-            _send_host_cmd("./vmx.sh --cleanup", cwd=dir_path)
-            _send_host_cmd(f"rm -rf {dir_path}")
-            continue
-        # if cisco vm
-        destroy_cmd = f"virsh destroy {vm}"
-        undefine_cmd = f"virsh undefine {vm} --remove-all-storage --nvram"
-        del_image_cmd = f"rm -rf {image_path}" if image_path else ''
-        for cmd in (destroy_cmd, undefine_cmd, del_image_cmd):
-            _send_host_cmd(cmd)
-    if errors:
-        print('\n'.join(errors))
-    else:
-        print(f"vm '{vm_name}' successfully deleted")
+def read_hugepages():
+    """
+    read the hugepage pools of the host from sysfs.
+
+    :return: {node: {page size in KiB: {'total': pages, 'free': pages}}}. node None is the host-wide pool, used for
+             VMs that are spread across nodes
+    """
+    nodes = [None]
+    node_dir = os.path.join(SYSFS_ROOT, 'devices/system/node')
+    for node_name in sorted(os.listdir(node_dir) if os.path.isdir(node_dir) else []):
+        if re.match(r'node\d+$', node_name):
+            nodes.append(int(node_name[4:]))
+    pools = {}
+    for node in nodes:
+        pools[node] = {}
+        pools_dir = os.path.join(SYSFS_ROOT, get_hugepages_path(node))
+        for pool_name in os.listdir(pools_dir) if os.path.isdir(pools_dir) else []:
+            match = re.match(r'hugepages-(\d+)kB$', pool_name)
+            if match:
+                pools[node][int(match.group(1))] = {
+                    'total': int(read_sysfs(get_hugepages_path(node), pool_name, 'nr_hugepages', default=0)),
+                    'free': int(read_sysfs(get_hugepages_path(node), pool_name, 'free_hugepages', default=0))}
+    return pools
 
 
-def get_vm_names_by_group_id(group_id):
+class HugepagePlanner:
     """
-    get the names of all VMs in a group
+    plan the hugepages that back the memory of the cisco VMs, on the NUMA node of their CPUs:
+    - 1G pages are used when the node has enough free 1G pages for the whole VM, 2M pages otherwise
+    - missing 2M pages are reserved by growing the pool of the node before any VM is defined, so a VM doesn't fail
+      late at start on missing pages, and its memory can be bound strictly to the node of its CPUs
+    - 'held' pages are free in the pools but planned for VMs of other runs that are not started yet
     """
-    return send_host_cmd("virsh list --all --name | grep %s" % group_id).splitlines()
+    def __init__(self, pools=None, held=()):
+        pools = pools or read_hugepages()
+        self.free = {node: {size_kb: pool['free'] for size_kb, pool in sizes.items()} for node, sizes in pools.items()}
+        for node, size_kb, pages in held:
+            node_free = self.free.setdefault(node, {})
+            node_free[size_kb] = max(node_free.get(size_kb, 0) - pages, 0)
+        self.reservations = {}  # {(node, page size in KiB): pages to add to the pool}
+        self.planned = []  # [[node, page size in KiB, pages]] of the planned VMs
 
+    def plan(self, placements):
+        """
+        set the hugepage size of each cisco VM placement, and collect the pages that must be reserved for them
+        """
+        memory_kb = InteropEnv.CISCO_IMAGE['memory_kb']
+        for placement in placements:
+            if placement.vm_type != 'cisco':
+                continue
+            free = self.free.setdefault(placement.node, {})
+            for size_kb in HUGEPAGE_SIZES_KB:
+                pages = -(-memory_kb // size_kb)
+                if free.get(size_kb, 0) >= pages:
+                    free[size_kb] -= pages
+                    break
+            else:
+                size_kb = 2048
+                missing = -(-memory_kb // size_kb) - free.get(size_kb, 0)
+                free[size_kb] = 0
+                self.reservations[(placement.node, size_kb)] = self.reservations.get((placement.node, size_kb),
+                                                                                     0) + missing
+            placement.hugepage_kb = size_kb
+            self.planned.append([placement.node, size_kb, -(-memory_kb // size_kb)])
+        return placements
 
-def get_available_cpus():
+    def describe_reservations(self):
+        return [f"{pages} x {format_page_size(size_kb)} on {'the host' if node is None else f'node {node}'}"
+                for (node, size_kb), pages in sorted(self.reservations.items(), key=str)]
+
+    def reserve(self):
+        """
+        grow the hugepage pools by the planned reservations, and verify that the kernel could allocate them
+        """
+        for (node, size_kb), pages in self.reservations.items():
+            path = get_hugepages_path(node)
+            pool_name = f'hugepages-{size_kb}kB'
+            where = 'the host' if node is None else f'node {node}'
+            total = read_sysfs(path, pool_name, 'nr_hugepages')
+            if total is None:
+                exit(f"ERROR: the host doesn't support {format_page_size(size_kb)} hugepages on {where}")
+            print(f"reserving {pages} hugepages of {format_page_size(size_kb)} on {where}")
+            with open(os.path.join(SYSFS_ROOT, path, pool_name, 'nr_hugepages'), 'w') as f:
+                f.write(str(int(total) + pages))
+            reserved = int(read_sysfs(path, pool_name, 'nr_hugepages', default=total)) - int(total)
+            if reserved < pages:
+                exit(f"ERROR: only {reserved} of {pages} hugepages of {format_page_size(size_kb)} could be reserved "
+                     f"on {where}, not enough free (or too fragmented) memory")
+        self.reservations = {}
+
+
+@traced
+def plan_hugepages(placements, reserve=True):
     """
-    find free dev-vm types(e.g re1, re2, etc) based on the host resources and the running VMs.
+    plan the hugepages of the VMs and reserve the missing pages. the planned pages are held in the resource ledger until
+    'release_reservations' is called, so parallel runs don't plan the same free pages
 
-    - execute the 'create_vm.py' script with relevant parameters and parse the 'choose VM Type' part to determine
-      the available dev-vm options and their CPU assignments (e.g re1-cpus 4 and 6, etc)
-    - find the allocated CPUs of all running VMs using the 'virsh vcpuinfo' command
-    - build a dictionary of free vm types as {type: [cpus]} ( e.g {re1: [4, 6]} )
+    :return: the HugepagePlanner, with the pending reservations when 'reserve' is False
     """
-    # get allocated CPUs
-    _used_cpus = send_host_cmd('virsh list --name | xargs -I {} virsh vcpuinfo {} | grep -E "^CPU:" | cut -d ":" -f2')
-    used_cpus = [cpu.strip() for cpu in _used_cpus.splitlines()]
-    total_cpus = int(send_host_cmd("cat /proc/cpuinfo | grep processor | wc -l").strip())
-    return [cpu for cpu in range(1, total_cpus + 1) if str(cpu) not in used_cpus]
+    with ResourceLedger() as ledger:
+        planner = HugepagePlanner(held=ledger.reserved('hugepages'))
+        planner.plan(placements)
+        if reserve:
+            planner.reserve()
+            ledger.reserve('hugepages', planner.planned)
+    return planner
 
 
-def install_prereqs_and_delete():
+@traced
+def install_prereqs_and_delete(args):
     """
     - validate that the script is running with required privileges and correct options
     - delete group if the --delete flag is set
@@ -840,29 +3504,197 @@ def install_prereqs_and_delete():
     if os.geteuid() != 0:
         exit("this script requires root privileges")
     if args.delete:
-        delete_vms(args.name)
+        if args.topology:
+            delete_vms(*[vm['name'] for vm in load_topology(args.topology)['vms']])
+        else:
+            delete_vms(args.name)
         exit(0)
     if args.install_prereq:
         print("installing required apt packages")
         cmds = ["apt-get update",
                 "apt-get install -y bridge-utils qemu-kvm libvirt-bin python python-netifaces vnc4server libyaml-dev "
                 "python-yaml numactl libparted0-dev libpciaccess-dev libnuma-dev libyajl-dev libxml2-dev libglib2.0-dev"
-                " libnl-3-dev python-pip python-dev libxml2-dev libxslt-dev python3-pip ethtool",
+                " libnl-3-dev python-pip python-dev libxml2-dev libxslt-dev python3-pip ethtool python3-libvirt"
+                " genisoimage python3-pyroute2",
                 "python3 -m pip install pexpect pyyaml"]
         for cmd in cmds:
-            send_host_cmd(cmd, timeout=60 * 7, strict=False)
+            send_host_cmd(cmd, timeout=60 * 7, strict=False, stream=True)
         exit(0)
 
 
+class NetInventory:
+    """
+    snapshot of the host network interfaces, read from '/sys/class/net' in a single pass.
+    the snapshot is cached for the whole run and updated in place when bridges or ports are added, so it doesn't
+    have to be read again.
+    changes are recorded when made, and applied to the host together by 'commit' (see there).
+
+    each interface is a dict of:
+    - bridge: True if the interface is a bridge
+    - ports: the interfaces attached to the bridge
+    - master: the bridge this interface is attached to, if any
+    - state: operational state, e.g 'up', 'down'
+    - mtu: int
+    """
+    def __init__(self):
+        self.interfaces = {}
+        self.pending = []  # [(operation, interface names)]
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        net_dir = os.path.join(SYSFS_ROOT, 'class/net')
+        interfaces = {}
+        for if_name in os.listdir(net_dir):
+            if_dir = os.path.join(net_dir, if_name)
+            is_bridge = os.path.isdir(os.path.join(if_dir, 'bridge'))
+            master = os.path.join(if_dir, 'master')
+            interfaces[if_name] = {
+                'bridge': is_bridge,
+                'ports': sorted(os.listdir(os.path.join(if_dir, 'brif'))) if is_bridge else [],
+                'master': os.path.basename(os.readlink(master)) if os.path.islink(master) else None,
+                'state': read_sysfs('class/net', if_name, 'operstate', default='unknown'),
+                'mtu': int(read_sysfs('class/net', if_name, 'mtu', default='0')),
+            }
+        with self.lock:
+            self.interfaces = interfaces
+
+    @property
+    def bridges(self):
+        """
+        get a dict of {bridge_name: [attached_interfaces]}
+        """
+        return {if_name: list(info['ports']) for if_name, info in self.interfaces.items() if info['bridge']}
+
+    def add_bridge(self, bridge):
+        with self.lock:
+            self.interfaces[bridge] = {'bridge': True, 'ports': [], 'master': None, 'state': 'down', 'mtu': 1500}
+            self.pending.append(('add_bridge', bridge))
+
+    def add_port(self, bridge, port):
+        with self.lock:
+            self.interfaces[bridge]['ports'] = sorted(self.interfaces[bridge]['ports'] + [port])
+            self.interfaces.setdefault(port, {'bridge': False, 'ports': [], 'master': None, 'state': 'unknown',
+                                              'mtu': 1500})['master'] = bridge
+            self.pending.append(('add_port', bridge, port))
+
+    def set_up(self, if_name):
+        with self.lock:
+            self.interfaces[if_name]['state'] = 'up'
+            self.pending.append(('set_up', if_name))
+
+    def delete_link(self, if_name):
+        with self.lock:
+            for port in self.interfaces.pop(if_name, {}).get('ports', []):
+                if port in self.interfaces:
+                    self.interfaces[port]['master'] = None
+            self.pending.append(('delete_link', if_name))
+
+    def commit(self):
+        """
+        apply the pending changes to the host in a single batch: over one netlink socket when pyroute2 is installed,
+        or with a single `ip -batch` command
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        if IPRoute and NET_BACKEND != 'ip':
+            self._commit_netlink(pending)
+        else:
+            self._commit_ip_batch(pending)
+
+    def _commit_netlink(self, pending):
+        with IPRoute() as ipr:
+            def _index(if_name):
+                indexes = ipr.link_lookup(ifname=if_name)
+                if not indexes:
+                    exit(f"ERROR: interface '{if_name}' was not found")
+                return indexes[0]
+
+            for operation, *if_names in pending:
+                try:
+                    if operation == 'add_bridge':
+                        ipr.link('add', ifname=if_names[0], kind='bridge')
+                    elif operation == 'add_port':
+                        ipr.link('set', index=_index(if_names[1]), master=_index(if_names[0]))
+                    elif operation == 'delete_link':
+                        ipr.link('del', index=_index(if_names[0]))
+                    else:
+                        ipr.link('set', index=_index(if_names[0]), state='up')
+                except NetlinkError as e:
+                    exit(f"ERROR: failed to {operation.replace('_', ' ')} {' '.join(if_names)}: {e}")
+
+    @staticmethod
+    def _commit_ip_batch(pending):
+        commands = {'add_bridge': "link add name {0} type bridge",
+                    'add_port': "link set dev {1} master {0}",
+                    'set_up': "link set dev {0} up",
+                    'delete_link': "link del dev {0}"}
+        batch = '\n'.join(commands[operation].format(*if_names) for operation, *if_names in pending)
+        send_host_cmd(f"ip -batch - <<'EOF'\n{batch}\nEOF")
+
+
+_net_inventory = None
+_net_inventory_lock = threading.Lock()
+
+
+def get_net_inventory():
+    """
+    get the cached host network inventory, reading it on first use
+    """
+    global _net_inventory
+    with _net_inventory_lock:
+        if not _net_inventory:
+            _net_inventory = NetInventory()
+        return _net_inventory
+
+
 def get_bridges_info():
     """
     get a dict of {bridge_name: [attached_interfaces]}
     """
-    bridge_names = send_host_cmd("brctl show | awk 'NF>1 && NR>1 {print $1}'").splitlines()
-    return {br_name: send_host_cmd(f"ls /sys/devices/virtual/net/{br_name}/brif/").splitlines()
-            for br_name in bridge_names}
+    return get_net_inventory().bridges
+
+
+def add_host_bridges(bridges):
+    """
+    create the bridges that don't exist yet and enable them, in a single batch
+    """
+    inventory = get_net_inventory()
+    for bridge in bridges:
+        if bridge in inventory.bridges:
+            continue
+        print(f"creating bridge {bridge}")
+        inventory.add_bridge(bridge)
+    enable_host_interfaces(bridges)
+
+
+def delete_host_bridges(bridges):
+    """
+    delete bridges, in a single batch
+    """
+    inventory = get_net_inventory()
+    for bridge in bridges:
+        print(f"deleting bridge {bridge}")
+        inventory.delete_link(bridge)
+    inventory.commit()
+
 
+def enable_host_interfaces(if_names):
+    inventory = get_net_inventory()
+    for if_name in if_names:
+        inventory.set_up(if_name)
+    inventory.commit()
 
+
+def add_bridge_port(bridge, port):
+    inventory = get_net_inventory()
+    inventory.add_port(bridge, port)
+    inventory.commit()
+
+
+@traced
 def save_br_and_net_config():
     """
     - save all bridges configuration to `netplan` in order for them to be persistent on next boot.
@@ -871,9 +3703,9 @@ def save_br_and_net_config():
     """
     # mark virsh-networks to auto-start
     print("marking all virsh-networks as 'autostarted'")
-    networks = send_host_cmd("virsh net-list --no-autostart --name").splitlines()
-    for network in networks:
-        send_host_cmd(f"virsh net-autostart {network}")
+    backend = get_virt_backend()
+    for network in backend.list_networks(no_autostart_only=True):
+        backend.set_network_autostart(network)
 
     # fetch the existing netplan config and parse it
     br_info = get_bridges_info()
@@ -899,14 +3731,12 @@ def save_br_and_net_config():
         yaml.dump(netplan_yaml, f)
 
 
-def get_avail_disk_space():
-    return send_host_cmd("df -k | grep '/var/lib/libvirt/images' | awk '{print $4}'")
+MAX_JUNIPER_NAME = 6
 
 
 def name_type(arg_value):
-    max_jun_name = 6
-    if 'juniper' in sys.argv and len(arg_value) > max_jun_name:
-        raise argparse.ArgumentTypeError(f"juniper VM name cannot exceed {max_jun_name} characters")
+    if 'juniper' in sys.argv and len(arg_value) > MAX_JUNIPER_NAME:
+        raise argparse.ArgumentTypeError(f"juniper VM name cannot exceed {MAX_JUNIPER_NAME} characters")
     return arg_value
 
 
@@ -942,9 +3772,23 @@ def mgmt_gw_type(arg_value):
         'mgmt gw should be a valid ipv4 address')
 
 
-def get_required_disk_space(cisco_count, juniper_count):
-    return (cisco_count * InteropEnv.CISCO_IMAGE['image_size_gb'] +
-            juniper_count * InteropEnv.JUNIPER_IMAGE['image_size_gb'])
+def get_required_disk_space(cisco_count, juniper_count, clone_mode='overlay'):
+    """
+    get the disk space in GB needed for the VMs. overlay clones only cost the blocks written by the VM, plus the base
+    image itself (or the extracted juniper bundle) if it is not found locally yet.
+    """
+    if clone_mode == 'copy':
+        required = (cisco_count * InteropEnv.CISCO_IMAGE['image_size_gb'] +
+                    juniper_count * InteropEnv.JUNIPER_IMAGE['image_size_gb'])
+    else:
+        required = (cisco_count * InteropEnv.CISCO_IMAGE['overlay_size_gb'] +
+                    juniper_count * InteropEnv.JUNIPER_IMAGE['clone_size_gb'])
+        if cisco_count and not os.path.exists(InteropEnv.CISCO_IMAGE['local_path']):
+            required += InteropEnv.CISCO_IMAGE['image_size_gb']
+    # the juniper bundle is extracted once to the cache, the VMs are cloned from there
+    if juniper_count and not os.path.isdir(InteropEnv.JUNIPER_IMAGE['cache_dir']):
+        required += InteropEnv.JUNIPER_IMAGE['image_size_gb']
+    return required
 
 
 def get_required_ram_in_gb(cisco_count, juniper_count):
@@ -959,102 +3803,728 @@ def get_or_create_host_br(*host_ifs):
     if the host is already attached to a bridge, return that bridge
     """
     br_interfaces = []
-    all_interfaces = send_host_cmd("brctl show | awk 'NF>1 && NR>1 {print $1 \" \" $4}'").splitlines()
-    host_to_br_ifs = {}
-    for line in all_interfaces:
-        br_name, *_host_if = line.strip().split()
-        host_if = _host_if[0] if _host_if else br_name
-        host_to_br_ifs[host_if] = br_name
+    inventory = get_net_inventory()
 
     # if the temporary bridge is used, make sure it exists
     tmp_br_name = 'brAutoTmp'
-    if tmp_br_name in host_ifs and tmp_br_name not in host_to_br_ifs.values():
-        send_host_cmd(f"brctl addbr {tmp_br_name}")
-        host_to_br_ifs[tmp_br_name] = tmp_br_name
+    if tmp_br_name in host_ifs and tmp_br_name not in inventory.bridges:
+        print(f"creating bridge {tmp_br_name}")
+        inventory.add_bridge(tmp_br_name)
+        inventory.commit()
 
     for interface in host_ifs:
-        if interface in host_to_br_ifs:  # if a physical host interface provided
-            br_interfaces.append(host_to_br_ifs[interface])
-        elif interface in host_to_br_ifs.values():  # if a bridge was provided
+        info = inventory.interfaces.get(interface, {})
+        if info.get('bridge'):  # if a bridge was provided
             br_interfaces.append(interface)
+        elif info.get('master'):  # if a physical host interface that is attached to a bridge provided
+            br_interfaces.append(info['master'])
         else:
             new_br = get_or_create_bridges(1)[0]
             print(f"attaching interface '{interface}' to bridge '{new_br}'")
             br_interfaces.append(new_br)  # create a new bridge and attach the host interface to it
-            send_host_cmd(f"brctl addif {new_br} {interface}").splitlines()
+            add_bridge_port(new_br, interface)
     return br_interfaces
 
 
+def load_topology(topology_path):
+    """
+    read and validate a topology file. the file declares the VMs of a lab and the bridges/networks they use:
+
+    mgmt_br: br0                 # optional, defaults for all VMs
+    mgmt_gw: 10.0.15.254         # optional
+    group: lab1                  # optional, the group of all VMs, for '--delete --name lab1'
+    bridges: [br10, br11]        # optional, created if missing
+    networks: [someNetwork]      # optional, virsh networks, created if missing
+    vms:
+      - name: xr1
+        type: cisco
+        mgmt_ip: 10.0.0.1/20
+        interfaces: [br:br10, net:someNetwork]
+        config: xr1.cfg          # optional, path relative to the topology file
+        from_golden: true        # optional, overrides --from_golden for this vm
+        device_profile: virtio   # optional, overrides --device_profile for this vm
+        day0: config-drive       # optional, overrides --day0 for this vm. cisco only, --day0 applies to cisco vms
+        from_pool: true          # optional, overrides --from_pool for this vm. cisco only, --from_pool applies to
+                                 # cisco vms
+    """
+    with open(topology_path) as f:
+        topology = yaml.safe_load(f) or {}
+    vms = topology.get('vms') or []
+    if not vms:
+        exit(f"ERROR: no vms found in topology file '{topology_path}'")
+    topology.setdefault('mgmt_br', 'br0')
+    topology.setdefault('bridges', [])
+    topology.setdefault('networks', [])
+    names = set()
+    for vm in vms:
+        try:
+            if not vm.get('name'):
+                raise argparse.ArgumentTypeError("each vm should have a name")
+            if vm['name'] in names:
+                raise argparse.ArgumentTypeError(f"vm name '{vm['name']}' is used more than once")
+            names.add(vm['name'])
+            vm.setdefault('type', 'cisco')
+            if vm['type'] not in ('cisco', 'juniper'):
+                raise argparse.ArgumentTypeError(f"vm '{vm['name']}' has an unknown type '{vm['type']}'")
+            if vm['type'] == 'juniper' and len(vm['name']) > MAX_JUNIPER_NAME:
+                raise argparse.ArgumentTypeError(f"juniper VM name cannot exceed {MAX_JUNIPER_NAME} characters")
+            vm['interfaces'] = [interface_type(interface) for interface in vm.get('interfaces') or []]
+            if vm.get('mgmt_ip'):
+                mgmt_ip_type(vm['mgmt_ip'])
+            if vm.get('device_profile', 'legacy') not in InteropEnv.DEVICE_PROFILES:
+                raise argparse.ArgumentTypeError(f"vm '{vm['name']}' has an unknown device profile")
+            if vm.get('day0', 'serial') not in ('serial', 'config-drive'):
+                raise argparse.ArgumentTypeError(f"vm '{vm['name']}' has an unknown day-0 mode")
+            if vm['type'] == 'juniper' and vm.get('day0', 'serial') != 'serial':
+                raise argparse.ArgumentTypeError(f"juniper vm '{vm['name']}' doesn't support a day-0 config drive")
+            if vm['type'] == 'juniper' and vm.get('from_pool'):
+                raise argparse.ArgumentTypeError(f"juniper vm '{vm['name']}' can't be claimed from the warm pool, it "
+                                                 f"only has cisco vms")
+            vm.setdefault('mgmt_gw', topology.get('mgmt_gw'))
+            if vm['mgmt_gw']:
+                mgmt_gw_type(vm['mgmt_gw'])
+        except argparse.ArgumentTypeError as e:
+            exit(f"ERROR: invalid topology file '{topology_path}': {e}")
+        vm['cli_config'] = None
+        if vm.get('config'):
+            config_path = os.path.join(os.path.dirname(os.path.abspath(topology_path)), vm['config'])
+            with open(config_path) as f:
+                vm['cli_config'] = f.read()
+    return topology
+
+
+@traced
+def create_missing_bridges(bridges):
+    """
+    create and enable the bridges that don't exist on the host yet
+    """
+    existing_bridges = get_bridges_info()
+    add_host_bridges([bridge for bridge in bridges if bridge not in existing_bridges])
+
+
+def provision_topology(topology, cpu_placements, clone_mode='overlay', from_golden=False, device_profile='legacy',
+                       day0='serial', from_pool=False, juniper_installer='native'):
+    """
+    create all the VMs of a topology as a parallel pipeline:
+    - shared steps run once: bridges, virsh networks, image fetching and juniper bundle extraction
+    - each VM then runs its own clone, define, start, boot-wait and base-config steps in parallel with the others,
+      so the boot waits of all VMs overlap
+    """
+    envs = []
+    for vm, cpu_placement in zip(topology['vms'], cpu_placements):
+        envs.append(InteropEnv(vm.get('mgmt_br', topology['mgmt_br']), cpu_placement, vm['name'], vm['type'],
+                               vm['interfaces'], vm.get('mgmt_ip'), vm['mgmt_gw'], vm['cli_config'], clone_mode,
+                               vm.get('from_golden', from_golden), vm.get('device_profile', device_profile),
+                               vm.get('day0', day0 if vm['type'] == 'cisco' else 'serial'),
+                               vm.get('from_pool', from_pool and vm['type'] == 'cisco'), juniper_installer,
+                               topology.get('group')))
+
+    create_missing_bridges(topology['bridges'])
+    networks = [f"net:{network}" for network in topology['networks']]
+    define_virsh_networks(networks + [interface for env in envs for interface in env.interfaces])
+    for vm_type in {env.vm_type for env in envs}:
+        env = next(env for env in envs if env.vm_type == vm_type)
+        env.fetch_images()
+        if vm_type == 'juniper':
+            env.get_juniper_bundle_cache()
+
+    print(f"creating {len(envs)} vms in parallel")
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(envs), initializer=ThreadOutput.bind,
+                            initargs=(ThreadOutput.current(),)) as executor:
+        futures = {executor.submit(env): env for env in envs}
+        for future in as_completed(futures):
+            vm_name = futures[future].vm_name
+            try:
+                future.result()
+                print(f"vm '{vm_name}' is ready")
+            except BaseException as e:
+                errors.append(f"ERROR: failed to create vm '{vm_name}': {e!r}")
+    if errors:
+        exit('\n'.join(errors))
+
+
+DAEMON_SOCKET = os.path.join(RUN_DIR, 'create_single_vm.sock')
+
 # noinspection PyTypeChecker
 parser = argparse.ArgumentParser(
     formatter_class=lambda prog: argparse.RawDescriptionHelpFormatter(prog, max_help_position=50, width=150),
     description="""create or delete a single Cisco or Juniper VM, with optional management-ip configuration(fxp0) and interface-binding
 for example, a Cisco VM with mgmt-ip, 2 bridge interfaces, 'br1' and 'br2', and an internal virsh-network 'someNetwork', can be created using the below command:
-sudo ./create_single_vm.py --name my_cisco --type cisco --mgmt_ip 10.0.0.1/20 --mgmt_gw 10.0.15.254 --interfaces br:br1 br:br2 net:someNetwork""")
+sudo ./create_single_vm.py --name my_cisco --type cisco --mgmt_ip 10.0.0.1/20 --mgmt_gw 10.0.15.254 --interfaces br:br1 br:br2 net:someNetwork
+a whole lab can be created in parallel from a topology file using:
+sudo ./create_single_vm.py --topology lab.yaml""")
 parser.add_argument("--mgmt_br", type=str, default="br0", help="management bridge of the host (default: br0)")
 parser.add_argument("--mgmt_ip", type=mgmt_ip_type, help="VM management interface to enable SSH after the VM is installed")
 parser.add_argument("--mgmt_gw", type=mgmt_gw_type, help="default gateway for the management network")
 parser.add_argument("--config", type=str, help="path to a local config file to paste into the device")
-parser.add_argument("--delete", action="store_true", help="delete all vms that includes the provided name. will undefine "
-                                                          "vms and delete images (default: False)")
+parser.add_argument("--delete", action="store_true",
+                    help="delete the vm --name, or all the vms of the group --name, in parallel. will undefine vms "
+                         "and delete images (default: False)")
 parser.add_argument("--check", action="store_true",
                     help="check if your selections are valid and if there are enough resources to configure the "
-                         "requested groups. this will display the allocated resources or an error message. no new VMs "
-                         "will be created. (default: False)")
+                         "requested groups. this will display the allocated resources, the available host "
+                         "resources and a fit/no-fit verdict, and exit with 1 if the VMs don't fit. no new VMs will be "
+                         "created. (default: False)")
 parser.add_argument("--dont_save_br_config", action="store_true",
                     help="don't save bridge configuration to netplan. this should be used only when creating temporary "
                          "VMs that don't need to survive host reboot (default: False)")
+parser.add_argument("--fresh", action="store_true",
+                    help="create the vms from the start. by default, a vm whose previous creation failed resumes after "
+                         "the phases that were completed (default: False)")
 parser.add_argument("--install_prereq", action="store_true",
                     help="install required packages on the host. should only run once per host (default: False)")
-parser.add_argument("--name", type=name_type, help="name of the router VM", required=True)
+parser.add_argument("--name", type=name_type, help="name of the router VM. required unless --topology is used")
+parser.add_argument("--group", type=str,
+                    help="group of the VM, recorded in its metadata. '--delete --name <group>' deletes all the vms of "
+                         "the group (default: the VM name)")
 parser.add_argument("--type", type=str, help="router type, either cisco v7.0.2 or juniper v20.4R1.12", choices=['cisco', 'juniper'], default='cisco')
 parser.add_argument("--interfaces", type=interface_type, nargs='+',
                     help="interfaces to attach from the host to VM. in format of `type:value`. where 'type' can be either 'net' or 'br'. e.g net:someNetwork br:br5")
+parser.add_argument("--clone_mode", type=str, choices=['overlay', 'copy'], default='overlay',
+                    help="how to clone the base image. 'overlay' creates a thin qcow2 overlay backed by the base "
+                         "image, 'copy' creates a full copy of it. juniper vms are always cloned from the extracted "
+                         "bundle cache, with the same choice for their qcow2 images (default: overlay)")
+parser.add_argument("--device_profile", type=str, choices=list(InteropEnv.DEVICE_PROFILES), default='legacy',
+                    help="virtual hardware of cisco VMs. 'legacy': e1000 nics and an ide disk. 'virtio': virtio-net "
+                         "with vhost multiqueue and a virtio-blk disk with cache=none io=native on an iothread. "
+                         "'virtio-scsi': same, with a virtio-scsi disk (default: legacy)")
+parser.add_argument("--day0", type=str, choices=['serial', 'config-drive'], default='serial',
+                    help="how the base config is applied to cisco VMs. 'serial' pastes it on the console after boot, "
+                         "'config-drive' attaches it as a day-0 ISO that is applied at boot, and falls back to the "
+                         "console if it wasn't applied. juniper VMs always get it on the console (default: serial)")
+parser.add_argument("--from_pool", action="store_true",
+                    help="claim cisco VMs from the warm pool of idle booted VMs when it has any, and refill the pool "
+                         "in the background")
+parser.add_argument("--fill_pool", action="store_true",
+                    help="boot idle cisco VMs until the warm pool reaches its size. the pool settings are saved, and "
+                         "used by the background refills")
+parser.add_argument("--drain_pool", action="store_true", help="delete the idle VMs of the warm pool")
+parser.add_argument("--pool_size", type=int, help=f"number of idle cisco VMs in the warm pool "
+                                                  f"(default: {WarmPool.DEFAULT_SETTINGS['size']})")
+parser.add_argument("--pool_max_cpus", type=int, help=f"CPUs budget of the warm pool VMs "
+                                                      f"(default: {WarmPool.DEFAULT_SETTINGS['max_cpus']})")
+parser.add_argument("--pool_max_memory_gb", type=int,
+                    help=f"memory budget of the warm pool VMs (default: {WarmPool.DEFAULT_SETTINGS['max_memory_gb']})")
+parser.add_argument("--daemon", action="store_true",
+                    help=f"run the provisioning daemon on '{DAEMON_SOCKET}'. while it runs, this script sends its "
+                         f"requests to the daemon, which keeps the host state between requests")
+parser.add_argument("--no_daemon", action="store_true", help="run the request in this process even if the daemon runs")
+parser.add_argument("--status", action="store_true",
+                    help="print the VMs of the host and the daemon requests in progress")
+parser.add_argument("--snapshot", action="store_true",
+                    help="take a snapshot of the running vm --name (memory and disks, both VMs of a juniper), "
+                         "replacing its previous snapshot")
+parser.add_argument("--revert", action="store_true", help="revert the vm --name to its snapshot")
+parser.add_argument("--console_broker", action="store_true",
+                    help=f"run the console broker, which attaches once to the console of every running VM and shares "
+                         f"it over Unix sockets in '{CONSOLE_DIR}'. while it runs, this script uses it for all the "
+                         f"console work")
+parser.add_argument("--console", action="store_true",
+                    help="attach the terminal to the console of the vm --name through the console broker")
+parser.add_argument("--juniper_installer", type=str, choices=['native', 'vmx.sh'], default='native',
+                    help="how juniper VMs are installed. 'native' defines the vcp and vfp VMs directly, with their "
+                         "interfaces and CPU pinning. 'vmx.sh' uses the installation script of the vMX bundle "
+                         "(default: native)")
+parser.add_argument("--build_golden", action="store_true",
+                    help="boot a cisco VM once and save its state as the golden state that --from_golden VMs start "
+                         "from. should run again after the cisco image changes (default: False)")
+parser.add_argument("--from_golden", action="store_true",
+                    help="start cisco VMs from the saved golden state instead of cold booting them. falls back to a "
+                         "cold boot when no golden state exists (default: False)")
+parser.add_argument("--image_server", type=str,
+                    help="http(s):// or file:// url of a directory that serves the images by their local name, used "
+                         "instead of rsync. a '<image>.sha256' file next to an image is used to verify it")
+parser.add_argument("--image_store_quota_gb", type=int, default=IMAGE_STORE_QUOTA_GB,
+                    help="max size of the local image store, unused images are evicted above it "
+                         f"(default: {IMAGE_STORE_QUOTA_GB})")
+parser.add_argument("--virt_backend", type=str, choices=['auto', 'libvirt', 'virsh'], default='auto',
+                    help="how to manage VMs and networks. 'libvirt' uses a single libvirt-python connection, 'virsh' "
+                         "runs the virsh command line. 'auto' uses libvirt when available (default: auto)")
+parser.add_argument("--trace", type=str,
+                    help="write a trace of the run to this file: the VM creation phases, host commands and console "
+                         "expects with their timing. a chrome trace (chrome://tracing or ui.perfetto.dev), or json "
+                         "lines if the file ends with '.jsonl'. a summary of the time per phase is printed at the end")
+parser.add_argument("--topology", type=str,
+                    help="path to a yaml topology file that declares many cisco/juniper VMs and their bridges/networks. "
+                         "all VMs are created in parallel. see 'load_topology' for the file format")
+
 
+def get_resumed_placements(vms):
+    """
+    get the CPU placements of the VMs that resume a failed run (see 'VmProgress') and were already defined by it: their
+    domains are pinned to these CPUs and backed by these hugepages, so they keep them
+
+    :param vms: list of (vm_name, vm_type) tuples
+    :return: {vm name: CpuPlacement}
+    """
+    placements = {vm_name: VmProgress(vm_name).get_placement() for vm_name, _ in vms}
+    if not any(placements.values()):
+        return {}
+    domains = get_virt_backend().list_domains()
+    resumed = {}
+    for vm_name, vm_type in vms:
+        placement = placements[vm_name]
+        if placement and placement.vm_type == vm_type and (vm_name in domains or f"vcp-{vm_name}" in domains):
+            print(f"vm '{vm_name}' was defined by a previous run, keeping its placement: {placement}")
+            resumed[vm_name] = placement
+    return resumed
+
+
+@traced
+def validate_cpus(vms, available_cpus=None, resumed_placements=None):
+    """
+    plan the CPU placement of the VMs, and reserve the CPUs in the resource ledger until 'release_reservations' is
+    called.
+
+    :param vms: list of (vm_name, vm_type) tuples
+    :param resumed_placements: {vm name: CpuPlacement} of VMs that keep their placement, see 'get_resumed_placements'
+    :return: list of CpuPlacement, in the order of 'vms'
+    """
+    resumed_placements = resumed_placements or {}
+    with ResourceLedger() as ledger:
+        if available_cpus is None:
+            available_cpus = get_available_cpus()
+        taken_cpus = set(ledger.reserved('cpus'))
+        for placement in resumed_placements.values():
+            taken_cpus.update(placement.cpus + placement.emulator_cpus + placement.kept_free)
+        allocator = CpuAllocator([cpu for cpu in available_cpus if cpu not in taken_cpus])
+        placements = []
+        for vm_name, vm_type in vms:
+            placement = resumed_placements.get(vm_name) or allocator.allocate(vm_name, vm_type)
+            if not placement:
+                exit("not enough available CPUs found for VM installation")
+            placements.append(placement)
+        ledger.reserve('cpus', [cpu for placement in placements for cpu in placement.cpus + placement.kept_free])
+    return placements
+
+
+def read_meminfo(path):
+    """
+    parse a meminfo file (/proc/meminfo or the meminfo of a NUMA node in sysfs) to {field: KiB}
+    """
+    meminfo = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                field, _, value = line.partition(':')
+                if value.split():
+                    meminfo[field.split()[-1]] = int(value.split()[0])
+    except OSError:
+        pass
+    return meminfo
+
+
+class HostCapacity:
+    """
+    a snapshot of the free resources of the host, read in a single in-process pass: the CPU and NUMA topology, the
+    CPUs and hugepages that are not used by running VMs or reserved in the resource ledger, the available RAM of
+    the host and of each NUMA node, and the free space of the images filesystem
+    """
+    def __init__(self, images_dir=None):
+        self.topology = read_cpu_topology()
+        with ResourceLedger() as ledger:
+            reserved_cpus = set(ledger.reserved('cpus'))
+            self.reserved_hugepages = ledger.reserved('hugepages')
+        self.available_cpus = [cpu for cpu in get_available_cpus() if cpu not in reserved_cpus]
+        self.hugepages = read_hugepages()
+        self.avail_ram_kb = read_meminfo('/proc/meminfo').get('MemAvailable', 0)
+        self.node_free_ram_kb = {
+            node: read_meminfo(os.path.join(SYSFS_ROOT, 'devices/system/node', f'node{node}', 'meminfo')).get('MemFree')
+            for node in self.topology[0]}
+        # the images directory may not exist yet, use the filesystem it will be created on
+        images_dir = images_dir or InteropEnv.CISCO_IMAGE['local_dir']
+        while not os.path.exists(images_dir):
+            images_dir = os.path.dirname(images_dir.rstrip('/')) or '/'
+        stat = os.statvfs(images_dir)
+        self.avail_disk_gb = stat.f_bavail * stat.f_frsize / (1024 ** 3)
+
+    def check(self, vms, clone_mode='overlay'):
+        """
+        check whether the VMs fit on the host, without reserving anything
+
+        :param vms: list of (vm_name, vm_type) tuples
+        :return: tuple of (placements, HugepagePlanner, {resource: (required, available)} of the resources that don't
+                 fit, as display strings). placements is None when there are not enough CPUs
+        """
+        vm_types = [vm_type for _, vm_type in vms]
+        cisco_count = vm_types.count('cisco')
+        juniper_count = vm_types.count('juniper')
+        missing = {}
+
+        allocator = CpuAllocator(self.available_cpus, self.topology)
+        placements = [allocator.allocate(vm_name, vm_type) for vm_name, vm_type in vms]
+        if None in placements:
+            required_cpus = sum(allocator.cpu_counts[vm_type] for vm_type in vm_types)
+            missing['cpus'] = (str(required_cpus), str(len(self.available_cpus)))
+            placements = None
+
+        # cisco memory is backed by hugepages: free pages are already taken out of the available RAM, only the pages
+        # that must be reserved are taken from it
+        planner = HugepagePlanner(self.hugepages, self.reserved_hugepages)
+        if placements:
+            planner.plan(placements)
+        else:
+            planner.plan([CpuPlacement(vm_name, vm_type, None, [], []) for vm_name, vm_type in vms])
+        reserved_kb = {}
+        for (node, size_kb), pages in planner.reservations.items():
+            reserved_kb[node] = reserved_kb.get(node, 0) + pages * size_kb
+        juniper_memory_kb = juniper_count * (InteropEnv.JUNIPER_IMAGE['vcp_memory_mb'] +
+                                             InteropEnv.JUNIPER_IMAGE['vfp_memory_mb']) * 1024
+        required_ram_kb = juniper_memory_kb + sum(reserved_kb.values())
+        if required_ram_kb > self.avail_ram_kb:
+            missing['memory'] = (f"{required_ram_kb / (1024 * 1024):.1f}G", f"{self.avail_ram_kb / (1024 * 1024):.1f}G")
+        for node, node_reserved_kb in sorted(reserved_kb.items(), key=str):
+            node_free_kb = self.node_free_ram_kb.get(node)
+            if node_free_kb is not None and node_reserved_kb > node_free_kb:
+                missing[f'hugepages on node {node}'] = (f"{node_reserved_kb / (1024 * 1024):.1f}G",
+                                                       f"{node_free_kb / (1024 * 1024):.1f}G free")
+
+        required_disk_gb = get_required_disk_space(cisco_count, juniper_count, clone_mode)
+        if required_disk_gb > self.avail_disk_gb:
+            missing['disk-space'] = (f"{required_disk_gb:g}G", f"{self.avail_disk_gb:.1f}G")
+        return placements, planner, missing
 
-def validate_cpus(cisco_count, juniper_count, available_cpus=None):
-    required_cpus = 2 * cisco_count + 4 * juniper_count
-    if not available_cpus:
-        available_cpus = get_available_cpus()
-    if required_cpus > len(available_cpus):
-        exit("not enough available CPUs found for VM installation")
-    return available_cpus[:required_cpus]
 
+def print_requirements(vms, name, type, clone_mode='overlay'):
+    """
+    print the resources the VMs need, what the host has available, and whether they fit
 
-def print_requirements(cisco_count, juniper_count, name, type):
-    required_disk_space_gb = get_required_ram_in_gb(cisco_count, juniper_count)
+    :return: True if the VMs fit on the host
+    """
+    vm_types = [vm_type for _, vm_type in vms]
+    cisco_count = vm_types.count('cisco')
+    juniper_count = vm_types.count('juniper')
+    capacity = HostCapacity()
+    placements, planner, missing = capacity.check(vms, clone_mode)
+    required_disk_space_gb = get_required_disk_space(cisco_count, juniper_count, clone_mode)
     required_ram_gb = get_required_ram_in_gb(cisco_count, juniper_count)
-    free_cpus = validate_cpus(cisco_count, juniper_count)
+    cpus = ','.join([str(cpu) for placement in placements for cpu in placement.cpus]) if placements else 'not enough'
     print(f"name: {name}\n"
           f"type: {type}\n"
-          f"cpus: {','.join([str(cpu) for cpu in free_cpus])}\n"
-          f"disk-space: {int(required_disk_space_gb)}G\n"
-          f"memory: {int(required_ram_gb)}G")
+          f"cpus: {cpus} ({len(capacity.available_cpus)} available)\n"
+          f"disk-space: {required_disk_space_gb:g}G ({capacity.avail_disk_gb:.0f}G available)\n"
+          f"memory: {int(required_ram_gb)}G ({capacity.avail_ram_kb / (1024 * 1024):.0f}G available)\n"
+          f"hugepages to reserve: {', '.join(planner.describe_reservations()) or 'none'}")
+    if placements:
+        print("cpu placement:")
+        for placement in placements:
+            print(f"  {placement}")
+    if missing:
+        print("verdict: does not fit. " +
+              ", ".join(f"{resource}: {required} required, {available} available"
+                        for resource, (required, available) in missing.items()))
+        return False
+    print("verdict: fits")
+    return True
 
 
-if __name__ == '__main__':
-    args = parser.parse_args()
+def run(args):
+    """
+    the VM creation flow for the parsed command line arguments, in this process or in a daemon request thread.
+    with --trace, the run is traced to the trace file, and a summary of its spans is printed
+    """
+    _run_args[ThreadOutput.current()] = args
+    try:
+        if not args.trace:
+            return _run(args)
+        tracer = _tracers[ThreadOutput.current()] = Tracer()
+        try:
+            with tracer.span('run', 'run'):
+                _run(args)
+        finally:
+            del _tracers[ThreadOutput.current()]
+            tracer.print_summary()
+            tracer.write(args.trace)
+    finally:
+        del _run_args[ThreadOutput.current()]
+
+
+def _run(args):
+    if not args.name and not args.topology and not (args.build_golden or args.fill_pool or args.drain_pool or
+                                                    args.status or args.console_broker):
+        parser.error("the following arguments are required: --name (or --topology)")
+    if not args.topology and args.type == 'juniper' and args.day0 != 'serial':
+        parser.error(f"--day0 {args.day0} is only supported for cisco VMs")
+    if not args.topology and args.type == 'juniper' and args.from_pool:
+        parser.error("--from_pool is only supported for cisco VMs, the warm pool has no juniper VMs")
     before = monotonic()
     # check user selections, fetch the needed info and handle prereq and deletion operations
-    install_prereqs_and_delete()
+    install_prereqs_and_delete(args)
+    if args.status:
+        print_status()
+        exit(0)
+    if args.console_broker:
+        ConsoleBroker().run()
+    if args.console:
+        attach_console(args.name)
+        exit(0)
+    if args.snapshot:
+        snapshot_vm(args.name)
+        exit(0)
+    if args.revert:
+        revert_vm(args.name)
+        exit(0)
+
+    if args.build_golden:
+        golden_placements = validate_cpus([('golden-cisco', 'cisco')])
+        plan_hugepages(golden_placements)
+        golden_env = InteropEnv(args.mgmt_br, golden_placements[0], 'golden-cisco', 'cisco', [], None, None, None,
+                                device_profile=args.device_profile)
+        try:
+            golden_env.get_cisco_image()
+            golden_env.build_cisco_golden()
+        finally:
+            release_reservations()
+        exit(0)
+    if args.drain_pool:
+        WarmPool().drain()
+        exit(0)
+    if args.fill_pool:
+        warm_pool = WarmPool()
+        warm_pool.configure(size=args.pool_size, max_cpus=args.pool_max_cpus, max_memory_gb=args.pool_max_memory_gb,
+                            device_profile=args.device_profile)
+        warm_pool.fill()
+        exit(0)
 
     # validate resources
-    cisco_count = 1 if args.type == 'cisco' else 0
-    juniper_count = 1 if args.type == 'juniper' else 0
+    topology = None
+    if args.topology:
+        topology = load_topology(args.topology)
+        vms = [(vm['name'], vm['type']) for vm in topology['vms']]
+    else:
+        vms = [(args.name, args.type)]
 
     # prepare all the info needed to start the installation
     if args.check:
-        print_requirements(cisco_count, juniper_count, args.name, args.type)
-        exit(0)
-    free_cpus = validate_cpus(cisco_count, juniper_count)
-    cli_config = None
-    if args.config:
-        with open(args.config) as f:
-            cli_config = f.read()
-    InteropEnv(args.mgmt_br, free_cpus, args.name, args.type, args.interfaces, args.mgmt_ip, args.mgmt_gw, cli_config)()
+        if topology:
+            vm_types = [vm_type for _, vm_type in vms]
+            fits = print_requirements(vms, ','.join(vm_name for vm_name, _ in vms),
+                                      f"{vm_types.count('cisco')} cisco, {vm_types.count('juniper')} juniper",
+                                      args.clone_mode)
+        else:
+            fits = print_requirements(vms, args.name, args.type, args.clone_mode)
+        exit(0 if fits else 1)
+    if args.fresh:
+        for vm_name, _ in vms:
+            VmProgress(vm_name).remove()
+    resumed_placements = get_resumed_placements(vms)
+    cpu_placements = validate_cpus(vms, resumed_placements=resumed_placements)
+    try:
+        # the hugepages of the resumed VMs that were defined are already in use by them
+        plan_hugepages([placement for placement in cpu_placements if placement.vm_name not in resumed_placements])
+        if topology:
+            provision_topology(topology, cpu_placements, args.clone_mode, args.from_golden, args.device_profile,
+                               args.day0, args.from_pool, args.juniper_installer)
+        else:
+            cli_config = None
+            if args.config:
+                with open(args.config) as f:
+                    cli_config = f.read()
+            InteropEnv(args.mgmt_br, cpu_placements[0], args.name, args.type, args.interfaces, args.mgmt_ip,
+                       args.mgmt_gw, cli_config, args.clone_mode, args.from_golden, args.device_profile, args.day0,
+                       args.from_pool, args.juniper_installer, args.group)()
+    finally:
+        release_reservations()
+    if args.from_pool or (topology and any(vm.get('from_pool') for vm in topology['vms'])):
+        WarmPool().refill_in_background()
 
     # make the bridges and virsh-network configuration persistent
     if not args.dont_save_br_config:
         save_br_and_net_config()
     print(f"script done in '{monotonic() - before}' seconds")
 
+
+# the requests that the daemon is running, {request id: command line}
+_daemon_requests = {}
+
+
+def print_status():
+    """
+    print the VMs of the host and, when running in the daemon, the requests in progress
+    """
+    backend = get_virt_backend()
+    active = set(backend.list_domains(active_only=True))
+    for name in sorted(backend.list_domains()):
+        print(f"{name}: {'running' if name in active else 'shut off'}")
+    for request_id, argv in list(_daemon_requests.items()):
+        print(f"request {request_id} in progress: {' '.join(argv)}")
+
+
+class ThreadOutput:
+    """
+    replaces sys.stdout and sys.stderr in the daemon: the output of each thread goes to the stream bound to it, so the
+    output of each request is sent to its own client. threads without a bound stream write to the daemon log.
+    thread pools of a request bind their threads to the request stream with 'initializer=ThreadOutput.bind'.
+    """
+    _local = threading.local()
+
+    def __init__(self, default):
+        self.default = default
+
+    @classmethod
+    def bind(cls, stream):
+        cls._local.stream = stream
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'stream', None)
+
+    def write(self, data):
+        return (self.current() or self.default).write(data)
+
+    def flush(self):
+        (self.current() or self.default).flush()
+
+
+class DaemonClientStream:
+    """
+    a stream that sends the written output to a daemon client as json lines. the request keeps running if the client
+    disconnects, and its output is dropped
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.connected = True
+
+    def send(self, message):
+        with self.lock:
+            if not self.connected:
+                return
+            try:
+                self.wfile.write(json.dumps(message).encode() + b'\n')
+                self.wfile.flush()
+            except OSError:
+                self.connected = False
+
+    def write(self, data):
+        if data:
+            self.send({'output': data})
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """
+    protocol: the client sends a single json line {'argv': [command line arguments], 'cwd': its working directory}.
+    the daemon answers with json lines {'output': text} while the request runs, and a final {'exit': exit code}
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        stream = DaemonClientStream(self.wfile)
+        request_id = uuid4().hex[:8]
+        _daemon_requests[request_id] = request['argv']
+        ThreadOutput.bind(stream)
+        print(f"request {request_id}: {' '.join(request['argv'])}", file=sys.__stdout__, flush=True)
+        try:
+            exit_code = run_daemon_request(request)
+        finally:
+            ThreadOutput.bind(None)
+            _daemon_requests.pop(request_id, None)
+        stream.send({'exit': exit_code})
+
+
+def run_daemon_request(request):
+    """
+    :return: the exit code of the request
+    """
+    try:
+        args = parser.parse_args(request['argv'])
+        # paths are relative to the client working directory
+        for path_arg in ('config', 'topology', 'trace'):
+            if getattr(args, path_arg):
+                setattr(args, path_arg, os.path.join(request['cwd'], getattr(args, path_arg)))
+        if args.daemon:
+            exit("ERROR: the daemon is already running")
+        # the backend is shared by all requests, so a request can't choose another one
+        if args.virt_backend not in ('auto', get_virt_backend().name):
+            exit(f"ERROR: the daemon uses the '{get_virt_backend().name}' backend, --virt_backend "
+                 f"'{args.virt_backend}' requires --no_daemon or restarting the daemon")
+        # the host network may have been changed since the previous request
+        get_net_inventory().refresh()
+        try:
+            run(args)
+        finally:
+            release_reservations()
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def serve_daemon(args, socket_path=DAEMON_SOCKET):
+    """
+    run the provisioning daemon: the libvirt connection and image store are kept between requests, so requests skip
+    their discovery, and the host network inventory is read again at the start of each request. each request runs in
+    its own thread.
+    """
+    if os.geteuid() != 0:
+        exit("this script requires root privileges")
+    if os.path.exists(socket_path):
+        if run_on_daemon(['--status'], socket_path, quiet=True) is not None:
+            exit(f"ERROR: the daemon is already running on '{socket_path}'")
+        os.remove(socket_path)
+    get_virt_backend()
+    get_net_inventory()
+    get_image_store()
+    sys.stdout = ThreadOutput(sys.stdout)
+    sys.stderr = ThreadOutput(sys.stderr)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, DaemonRequestHandler)
+    server.daemon_threads = True
+    os.chmod(socket_path, 0o600)
+    signal.signal(signal.SIGTERM, lambda *_: exit(0))
+    print(f"provisioning daemon is listening on '{socket_path}'")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def run_on_daemon(argv, socket_path=DAEMON_SOCKET, quiet=False):
+    """
+    send the command line to the provisioning daemon, and print the request output while it runs
+
+    :return: the exit code of the request, or None if the daemon is not running
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode() + b'\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            if not quiet:
+                sys.stdout.write(message['output'])
+                sys.stdout.flush()
+    print("ERROR: the daemon closed the connection before the request completed")
+    return 1
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    VIRT_BACKEND = args.virt_backend
+    if args.daemon:
+        serve_daemon(args)
+    elif not (args.no_daemon or args.console or args.console_broker) and os.path.exists(DAEMON_SOCKET):
+        # the daemon runs the request, this process is only a client
+        exit_code = run_on_daemon(sys.argv[1:])
+        if exit_code is not None:
+            exit(exit_code)
+    run(args)